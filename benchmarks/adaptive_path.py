@@ -0,0 +1,56 @@
+"""Benchmark: adaptive density of q-points along the single-crystal path.
+
+Seekpath path with q_spacing 0.005 1/A, at 100 K. For each tolerance, the number of computed
+q-points and the time are compared to the uniform path; the map error is the relative
+difference sum|S_adaptive - S_uniform| / sum|S_uniform| of the maps as plotted, i.e. with each
+column of the uniform path taking the closest computed column.
+
+    python benchmarks/adaptive_path.py
+
+Model system: see systems.py.
+"""
+
+import time
+
+import numpy as np
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+    parameters_single_crystal,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+    enablePrint,
+    produce_bands_weigthed_data,
+)
+
+from systems import diamond_force_constants
+
+PARAMETERS = dict(parameters_single_crystal, q_spacing=0.005, temperature=100)
+
+
+def main():
+    fc = diamond_force_constants(supercell=4)
+    # the Debye-Waller factor is cached per fc: compute it before timing.
+    produce_bands_weigthed_data(dict(PARAMETERS, q_spacing=0.1), fc)
+    start = time.perf_counter()
+    uniform, _ = produce_bands_weigthed_data(PARAMETERS, fc)
+    enablePrint()
+    elapsed = time.perf_counter() - start
+    exact = uniform.z_data.magnitude
+    print(f"{'tolerance':>10} {'q-points':>9} {'time (s)':>9} {'map error':>10}")
+    print(f"{'uniform':>10} {len(exact):>9} {elapsed:>9.2f}")
+    for tolerance in [0.1, 0.03, 0.01, 0.003]:
+        start = time.perf_counter()
+        adaptive, _ = produce_bands_weigthed_data(
+            dict(PARAMETERS, path_tolerance=tolerance), fc
+        )
+        enablePrint()
+        elapsed = time.perf_counter() - start
+        path_indices = np.array(adaptive.metadata["path_indices"])
+        closest = np.abs(np.arange(len(exact))[:, None] - path_indices).argmin(axis=1)
+        plotted = adaptive.z_data.magnitude[closest]
+        error = np.sum(np.abs(plotted - exact)) / np.sum(np.abs(exact))
+        print(f"{tolerance:>10} {len(path_indices):>9} {elapsed:>9.2f} {error:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
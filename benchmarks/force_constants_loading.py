@@ -0,0 +1,74 @@
+"""Benchmark: ForceConstants from a Phonopy instance, in memory vs via phonopy.yaml/fc.hdf5.
+
+The file route is the one used before by generate_force_constant_from_phonopy: the Phonopy
+instance is written in a temporary directory and read back with euphonic.
+
+    python benchmarks/force_constants_loading.py [supercell sizes, default: 2 4 6 8]
+
+Model system: see systems.py.
+"""
+
+import pathlib
+import sys
+import tempfile
+import time
+
+import numpy as np
+from phonopy.file_IO import write_force_constants_to_hdf5
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
+    generate_force_constant_from_phonopy_instance,
+    generate_force_constant_instance_temporary_fix,
+)
+
+from systems import diamond_phonopy
+
+
+def file_route(ph):
+    with tempfile.TemporaryDirectory() as dirpath:
+        ph.save(
+            pathlib.Path(dirpath) / "phonopy.yaml", settings={"force_constants": False}
+        )
+        write_force_constants_to_hdf5(
+            force_constants=ph.force_constants,
+            filename=pathlib.Path(dirpath) / "fc.hdf5",
+            p2s_map=ph.primitive.p2s_map,
+        )
+        return generate_force_constant_instance_temporary_fix(path=dirpath)
+
+
+def timed(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(sizes):
+    qpts = np.random.default_rng(0).random((50, 3))
+    print(
+        f"{'supercell':>10} {'atoms':>6} {'files (s)':>10} {'memory (s)':>11} {'max |dfreq| (meV)':>18}"
+    )
+    for size in sizes:
+        ph = diamond_phonopy(size)
+        ph.produce_force_constants()
+        t_file, fc_file = timed(file_route, ph)
+        t_memory, fc_memory = timed(generate_force_constant_from_phonopy_instance, ph)
+
+        assert np.allclose(
+            fc_file.force_constants.magnitude, fc_memory.force_constants.magnitude
+        )
+        freqs = [
+            fc.calculate_qpoint_phonon_modes(qpts, asr="reciprocal").frequencies
+            for fc in (fc_file, fc_memory)
+        ]
+        diff = np.max(np.abs((freqs[0] - freqs[1]).to("meV").magnitude))
+        print(
+            f"{size}x{size}x{size:<6} {len(ph.supercell):>6} {t_file:>10.3f} {t_memory:>11.4f} {diff:>18.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [2, 4, 6, 8])
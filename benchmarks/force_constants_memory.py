@@ -0,0 +1,57 @@
+"""Benchmark: peak memory of the INS loading path, with full vs compact force constants.
+
+From the forces of a Phonopy instance (i.e. the phonopy_data input of PhonopyCalculation)
+to the euphonic ForceConstants, producing the full (n_sc, n_sc, 3, 3) or the compact
+(n_prim, n_sc, 3, 3) force constants. The peak is measured with tracemalloc, which tracks
+the NumPy allocations (also those of the phonopy C extension).
+
+    python benchmarks/force_constants_memory.py [supercell sizes, default: 4 6 8]
+
+Model system: see systems.py.
+"""
+
+import sys
+import tracemalloc
+
+import numpy as np
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
+    generate_force_constant_from_phonopy_instance,
+)
+
+from systems import diamond_phonopy
+
+
+def load(ph, compact):
+    ph.produce_force_constants(calculate_full_force_constants=not compact)
+    return generate_force_constant_from_phonopy_instance(ph)
+
+
+def peak_memory(ph, compact):
+    ph.force_constants = None
+    tracemalloc.start()
+    fc = load(ph, compact)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, fc
+
+
+def main(sizes):
+    print(
+        f"{'supercell':>10} {'atoms':>6} {'full (MB)':>10} {'compact (MB)':>13} {'fc array (MB)':>14}"
+    )
+    for size in sizes:
+        ph = diamond_phonopy(size)
+        peak_full, fc_full = peak_memory(ph, compact=False)
+        peak_compact, fc_compact = peak_memory(ph, compact=True)
+        assert np.allclose(
+            fc_full.force_constants.magnitude, fc_compact.force_constants.magnitude
+        )
+        print(
+            f"{size}x{size}x{size:<6} {len(ph.supercell):>6} {peak_full / 1e6:>10.1f} "
+            f"{peak_compact / 1e6:>13.1f} {fc_compact._force_constants.nbytes / 1e6:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [4, 6, 8])
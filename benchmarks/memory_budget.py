@@ -0,0 +1,61 @@
+"""Benchmark: peak memory of the Q-plane structure factors within a memory budget.
+
+The modes of a 201 x 201 Q-plane are computed once; then the per-mode intensities
+(produce_Q_section_intensities) are computed without budget, and with budgets leaving room
+for chunks of fewer and fewer q-points. The peak is measured with tracemalloc, on top of the
+modes; "estimate" is the memory estimated for the same calculation (kernels.structure_factor_memory,
+without the modes, which are already allocated).
+
+    python benchmarks/memory_budget.py
+
+Model system: see systems.py.
+"""
+
+import time
+import tracemalloc
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.execution import memory_chunk_size
+from aiidalab_qe_vibroscopy.utils.euphonic.data.kernels import structure_factor_memory
+from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+    produce_Q_section_intensities,
+    produce_Q_section_modes,
+)
+
+from systems import diamond_force_constants
+
+N = 200
+
+
+def main():
+    fc = diamond_force_constants()
+    modes, *_, dw = produce_Q_section_modes(
+        fc, h=[1, 0, 0], k=[0, 1, 0], n_h=N, n_k=N, temperature=100
+    )
+    n_qpts, n_atoms = modes.n_qpts, fc.crystal.n_atoms
+    held, per_qpt = structure_factor_memory(n_qpts, n_atoms, 0)
+    held += 6 * 8 * n_qpts * 3 * n_atoms
+    modes_bytes = n_qpts * (8 * 3 * n_atoms + 16 * (3 * n_atoms) ** 2)
+
+    print(
+        f"{'budget (MB)':>11} {'chunk':>7} {'estimate (MB)':>13} {'peak (MB)':>10} "
+        f"{'time (s)':>9}"
+    )
+    # budgets leaving room for all the q-points at once, half of them, ...
+    for fraction in [1, 0.5, 0.1, 0.01]:
+        budget = (held + fraction * n_qpts * per_qpt) / 1024**2
+        chunk_size = memory_chunk_size(held, per_qpt, n_qpts, budget)
+        estimate = (held - modes_bytes + chunk_size * per_qpt) / 1024**2
+        tracemalloc.start()
+        start = time.perf_counter()
+        produce_Q_section_intensities(modes, dw=dw, memory_budget=budget)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{budget:>11.1f} {chunk_size:>7} {estimate:>13.1f} "
+            f"{peak / 1024**2:>10.1f} {elapsed:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Benchmark: rebinning the mode list vs recomputing the single-crystal S(Q,w) map.
+
+Seekpath path with q_spacing 0.005 1/A, at 100 K. The map is computed once (modes, mode
+list, binning); then the number of energy bins is changed, which only rebins the mode list
+kept in the stage cache (see mode_list.py), and the same map is computed from scratch. The
+memory of the mode list is compared with the one of the dense maps.
+
+    python benchmarks/mode_list.py
+
+Model system: see systems.py.
+"""
+
+import time
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import StageCache
+from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+    parameters_single_crystal,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+    enablePrint,
+    produce_bands_weigthed_data,
+)
+
+from systems import diamond_force_constants
+
+PARAMETERS = dict(parameters_single_crystal, q_spacing=0.005, temperature=100)
+
+
+def main():
+    fc = diamond_force_constants(supercell=4)
+    cache = StageCache()
+    # the Debye-Waller factor is cached per fc: compute it before timing.
+    produce_bands_weigthed_data(PARAMETERS, fc, cache=cache)
+    enablePrint()
+    mode_list = cache._stages["mode_list"][1][0]
+    print(f"mode list: {len(mode_list)} entries, {mode_list.nbytes / 1024**2:.2f} MB")
+    print(f"{'ebins':>6} {'map (MB)':>9} {'rebin (s)':>10} {'recompute (s)':>14}")
+    for ebins in [200, 1000, 5000]:
+        parameters = dict(PARAMETERS, ebins=ebins)
+        start = time.perf_counter()
+        spectrum, _ = produce_bands_weigthed_data(parameters, fc, cache=cache)
+        enablePrint()
+        rebin = time.perf_counter() - start
+        start = time.perf_counter()
+        produce_bands_weigthed_data(parameters, fc)
+        enablePrint()
+        recompute = time.perf_counter() - start
+        print(
+            f"{ebins:>6} {spectrum.z_data.magnitude.nbytes / 1024**2:>9.2f} "
+            f"{rebin:>10.2f} {recompute:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
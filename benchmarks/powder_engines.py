@@ -0,0 +1,67 @@
+"""Benchmark: powder map with the sphere sampling (serial engine) vs the grid engine.
+
+Dense |q| range (0.5-6 1/A, 0.05 1/A shells) at 100 K. The error is the relative L2
+distance from a reference map (sphere sampling with many points), after the energy
+broadening. For the grid engine, the convergence estimate it reports is shown as well.
+
+    python benchmarks/powder_engines.py
+
+Model system: see systems.py.
+"""
+
+import time
+
+import numpy as np
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import parameters_powder
+from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+    enablePrint,
+    produce_powder_data,
+)
+
+from systems import diamond_force_constants
+
+PARAMETERS = dict(
+    parameters_powder,
+    q_min=0.5,
+    q_max=6.0,
+    q_spacing=0.05,
+    temperature=100,
+    energy_broadening=3,
+    ebins=100,
+    seed=0,
+)
+
+
+def run(fc, **parameters):
+    start = time.perf_counter()
+    spectrum, _ = produce_powder_data(params=dict(PARAMETERS, **parameters), fc=fc)
+    enablePrint()
+    return spectrum, time.perf_counter() - start
+
+
+def main():
+    fc = diamond_force_constants()
+    reference, _ = run(fc, npts=5000)
+    reference = reference.z_data.magnitude
+
+    def error(spectrum):
+        difference = spectrum.z_data.magnitude - reference
+        return np.linalg.norm(difference) / np.linalg.norm(reference)
+
+    print(f"{'engine':>8} {'setting':>18} {'time (s)':>9} {'error':>7} {'estimate':>9}")
+    for npts in [100, 500]:
+        spectrum, elapsed = run(fc, npts=npts)
+        print(
+            f"{'serial':>8} {f'npts={npts}':>18} {elapsed:>9.2f} {error(spectrum):>7.3f}"
+        )
+    for grid_spacing in [0.1, 0.05]:
+        spectrum, elapsed = run(fc, powder_engine="grid", grid_spacing=grid_spacing)
+        print(
+            f"{'grid':>8} {f'grid_spacing={grid_spacing}':>18} {elapsed:>9.2f} "
+            f"{error(spectrum):>7.3f} {spectrum.metadata['grid_convergence']:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
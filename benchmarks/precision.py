@@ -0,0 +1,69 @@
+"""Benchmark: single vs double precision single-crystal S(Q,w) maps, for growing cells.
+
+Diamond-like cells of 2, 16 and 54 atoms (see systems.py), seekpath path with q_spacing
+0.02 1/A, at 100 K. "held" is the memory kept in the stage cache (the modes with their
+eigenvectors, the mode list and the maps, see cache.py); "peak" is the peak memory of the
+calculation (tracemalloc, including the diagonalisation, which euphonic does in double
+precision); "error" is the largest difference of the maps relative to the largest intensity,
+to compare with the bound of kernels.py.
+
+    python benchmarks/precision.py
+
+Model system: see systems.py.
+"""
+
+import time
+import tracemalloc
+
+import numpy as np
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import StageCache, _nbytes
+from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+    parameters_single_crystal,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+    enablePrint,
+    produce_bands_weigthed_data,
+)
+
+from systems import diamond_force_constants
+
+PARAMETERS = dict(parameters_single_crystal, q_spacing=0.02, temperature=100)
+
+
+def main():
+    print(
+        f"{'atoms':>6} {'precision':>10} {'q-points':>9} {'held (MB)':>10} "
+        f"{'peak (MB)':>10} {'time (s)':>9} {'error':>9}"
+    )
+    for cell_repeat in [1, 2, 3]:
+        fc = diamond_force_constants(supercell=2, cell_repeat=cell_repeat)
+        # the Debye-Waller factor is cached per fc: compute it before timing.
+        produce_bands_weigthed_data(dict(PARAMETERS, q_spacing=1), fc)
+        enablePrint()
+        maps = {}
+        for precision in ["double", "single"]:
+            cache = StageCache()
+            tracemalloc.start()
+            start = time.perf_counter()
+            spectrum, _ = produce_bands_weigthed_data(
+                dict(PARAMETERS, precision=precision), fc, cache=cache
+            )
+            enablePrint()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            maps[precision] = spectrum.z_data.magnitude
+            held = sum(_nbytes(value) for _, value in cache._stages.values())
+            error = np.max(np.abs(maps[precision] - maps["double"])) / np.max(
+                maps["double"]
+            )
+            print(
+                f"{fc.crystal.n_atoms:>6} {precision:>10} {spectrum.z_data.shape[0]:>9} "
+                f"{held / 1024**2:>10.1f} {peak / 1024**2:>10.1f} {elapsed:>9.2f} "
+                f"{error:>9.1e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
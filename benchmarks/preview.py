@@ -0,0 +1,57 @@
+"""Benchmark: interpolated preview vs exact single-crystal S(Q,w) map.
+
+Seekpath path with q_spacing 0.005 1/A, at 100 K. The map error is the relative difference
+sum|S_preview - S_exact| / sum|S_exact| of the whole maps; the estimated one is the error
+reported by the preview, i.e. the largest of its check points (see interpolation.py).
+
+    python benchmarks/preview.py
+
+Model system: see systems.py.
+"""
+
+import time
+
+import numpy as np
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+    parameters_single_crystal,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+    enablePrint,
+    produce_bands_preview,
+    produce_bands_weigthed_data,
+)
+
+from systems import diamond_force_constants
+
+PARAMETERS = dict(parameters_single_crystal, q_spacing=0.005, temperature=100)
+
+
+def main():
+    fc = diamond_force_constants(supercell=4)
+    # the Debye-Waller factor is cached per fc: compute it before timing.
+    produce_bands_preview(PARAMETERS, fc)
+    start = time.perf_counter()
+    exact, _ = produce_bands_weigthed_data(PARAMETERS, fc)
+    enablePrint()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{'coarsening':>10} {'q-points':>9} {'time (s)':>9} {'map error':>10} {'estimated':>10}"
+    )
+    print(f"{'exact':>10} {exact.z_data.shape[0]:>9} {elapsed:>9.2f}")
+    for coarsening in [3, 5, 10]:
+        start = time.perf_counter()
+        preview, _ = produce_bands_preview(PARAMETERS, fc, coarsening=coarsening)
+        enablePrint()
+        elapsed = time.perf_counter() - start
+        error = np.sum(np.abs(preview.z_data - exact.z_data).magnitude) / np.sum(
+            np.abs(exact.z_data.magnitude)
+        )
+        print(
+            f"{coarsening:>10} {preview.metadata['preview_qpts']:>9} {elapsed:>9.2f} "
+            f"{error:>10.3f} {preview.metadata['preview_intensity_error']:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Benchmark: modes of a Q-plane, diagonalising all the points vs the ones unique up to a
+reciprocal lattice vector (zone) vs the symmetry-unique ones, and the E cut as a direct sum over the modes vs binning the S(Q,w) in energy.
+
+400x400 plane spanned by [1 1 1] and [1 -1 0] around Gamma. The difference is the largest
+relative deviation of the averaged intensity at the E cut.
+
+    python benchmarks/q_planes.py
+
+Model system: see systems.py.
+"""
+
+import time
+
+import numpy as np
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.qpoint_symmetry import (
+    reduce_qpts,
+    reduce_qpts_to_zone,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+    produce_Q_section_energy_stack,
+    produce_Q_section_intensities,
+    produce_Q_section_modes,
+    produce_Q_section_spectrum,
+)
+
+from systems import diamond_force_constants
+
+PLANE = dict(h=[1, 1, 1], k=[1, -1, 0], Q0=[0, 0, 0], n_h=400, n_k=400)
+
+
+def run(fc, symmetry_reduction, zone_reduction=True):
+    start = time.perf_counter()
+    modes, q_array, h_array, k_array, labels, dw = produce_Q_section_modes(
+        fc,
+        symmetry_reduction=symmetry_reduction,
+        zone_reduction=zone_reduction,
+        **PLANE,
+    )
+    elapsed = time.perf_counter() - start
+    section = produce_Q_section_spectrum(
+        modes, q_array, h_array, k_array, ecenter=15, deltaE=2
+    )
+    return section[0], q_array, elapsed, modes
+
+
+def run_cuts(modes, bins):
+    intensities = produce_Q_section_intensities(modes)
+    start = time.perf_counter()
+    cut = produce_Q_section_energy_stack(intensities, [15], deltaE=2, bins=bins)[0]
+    return cut, time.perf_counter() - start
+
+
+def main():
+    fc = diamond_force_constants()
+    reference, q_array, elapsed, modes = run(
+        fc, symmetry_reduction=False, zone_reduction=False
+    )
+    print(f"{'modes':>10} {'diagonalised':>13} {'time (s)':>9} {'difference':>11}")
+    print(f"{'all':>10} {len(q_array):>13} {elapsed:>9.2f}")
+    section, _, elapsed, _ = run(fc, symmetry_reduction=False)
+    n_zone = len(reduce_qpts_to_zone(q_array)[0])
+    difference = np.nanmax(np.abs(section - reference)) / np.nanmax(np.abs(reference))
+    print(f"{'zone':>10} {n_zone:>13} {elapsed:>9.2f} {difference:>11.1e}")
+    n_irreducible = len(reduce_qpts(fc, q_array)[0])
+    section, _, elapsed, _ = run(fc, symmetry_reduction=True)
+    # (the intensity at Gamma is not defined.)
+    difference = np.nanmax(np.abs(section - reference)) / np.nanmax(np.abs(reference))
+    print(f"{'symmetry':>10} {n_irreducible:>13} {elapsed:>9.2f} {difference:>11.1e}")
+
+    print()
+    direct, _ = run_cuts(modes, bins=None)
+    print(f"{'E cut':>10} {'time (s)':>9} {'difference':>11}")
+    for bins in [None, 10, 100, 1000]:
+        cut, elapsed = run_cuts(modes, bins=bins)
+        difference = np.nanmax(np.abs(cut - direct)) / np.nanmax(np.abs(direct))
+        label = "direct" if bins is None else f"{bins} bins"
+        print(f"{label:>10} {elapsed:>9.3f} {difference:>11.1e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Model systems for the benchmarks."""
+
+import numpy as np
+from phonopy import Phonopy
+from phonopy.structure.atoms import PhonopyAtoms
+
+
+def diamond_phonopy(supercell, cell_repeat=1):
+    """Phonopy instance of diamond-like silicon, with forces from nearest-neighbour springs.
+
+    Same model of the generate_phonopy_instance fixture (tests/conftest.py). The unit cell
+    is the primitive cell repeated cell_repeat times along each vector (2 * cell_repeat**3
+    atoms), to benchmark large cells. The force constants are not produced.
+    """
+    a = 5.43
+    n = cell_repeat
+    shifts = np.array([[i, j, k] for i in range(n) for j in range(n) for k in range(n)])
+    positions = np.array([[0, 0, 0], [0.25, 0.25, 0.25]])
+    unitcell = PhonopyAtoms(
+        symbols=["Si"] * (2 * n**3),
+        cell=n * np.array([[0, a / 2, a / 2], [a / 2, 0, a / 2], [a / 2, a / 2, 0]]),
+        scaled_positions=((shifts[:, None, :] + positions[None]) / n).reshape(-1, 3),
+    )
+    # (the unit cell is the primitive cell of the model, also when repeated.)
+    ph = Phonopy(
+        unitcell,
+        supercell_matrix=np.eye(3, dtype=int) * supercell,
+        primitive_matrix="P",
+    )
+    ph.generate_displacements(distance=0.01)
+
+    # nearest-neighbours springs (k = 1 eV/A^2, rest length 2.3 A), looping over the
+    # atoms to keep the memory low for large supercells.
+    shifts = np.array(
+        [[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+    )
+    forces = []
+    for cell in ph.supercells_with_displacements:
+        images = (
+            cell.positions[None, :, :] + (shifts @ cell.cell)[:, None, :]
+        ).reshape(-1, 3)
+        f = np.zeros((len(cell), 3))
+        for i, position in enumerate(cell.positions):
+            d = images - position
+            r = np.linalg.norm(d, axis=-1)
+            mask = (r > 1e-6) & (r < 2.5)
+            f[i] = np.sum((r[mask] - 2.3)[:, None] * d[mask] / r[mask, None], axis=0)
+        forces.append(f)
+    ph.forces = np.array(forces)
+    return ph
+
+
+def diamond_force_constants(supercell=3, cell_repeat=1):
+    """euphonic ForceConstants of diamond_phonopy(supercell, cell_repeat)."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
+        generate_force_constant_from_phonopy_instance,
+    )
+
+    ph = diamond_phonopy(supercell, cell_repeat)
+    ph.produce_force_constants(calculate_full_force_constants=False)
+    return generate_force_constant_from_phonopy_instance(ph)
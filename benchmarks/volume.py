@@ -0,0 +1,49 @@
+"""Benchmark: peak memory of the chunked S(Q,E) volumes, for growing grids.
+
+Cubic grids spanned by [1 0 0], [0 1 0], [0 0 1] around Gamma, 200 energy bins, written to a
+temporary HDF5 file (see volume.py). The peak is measured with tracemalloc: it is given by
+the blocks, so it stays about the same while the size of the volume grows.
+
+    python benchmarks/volume.py [grid sizes, default: 16 32 48]
+
+Model system: see systems.py.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.volume import compute_volume
+
+from systems import diamond_force_constants
+
+
+def main(sizes):
+    fc = diamond_force_constants()
+    print(
+        f"{'grid':>6} {'volume (MB)':>12} {'file (MB)':>10} {'peak (MB)':>10} {'time (s)':>9}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for n in sizes:
+            path = os.path.join(directory, f"volume-{n}.h5")
+            tracemalloc.start()
+            start = time.perf_counter()
+            volume = compute_volume(
+                path, fc, h=[1, 0, 0], k=[0, 1, 0], l=[0, 0, 1], n_h=n, n_k=n, n_l=n
+            )
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with volume:
+                n_bytes = 8 * volume._data.size
+            print(
+                f"{n + 1:>6} {n_bytes / 1024**2:>12.1f} "
+                f"{os.path.getsize(path) / 1024**2:>10.1f} {peak / 1024**2:>10.1f} "
+                f"{elapsed:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [16, 32, 48])
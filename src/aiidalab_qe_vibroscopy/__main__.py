@@ -84,5 +84,59 @@ def setup_phonopy():
         subprocess.run(command, check=True)
 
 
+@cli.group(help="Inspect or purge the disk cache of the INS spectra.")
+def cache():
+    pass
+
+
+@cache.command(help="Show the location, the size and the entries of the cache.")
+def inspect():
+    import datetime
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.disk_cache import (
+        get_spectrum_disk_cache,
+    )
+
+    disk_cache = get_spectrum_disk_cache()
+    if disk_cache is None:
+        print("The cache is disabled (AIIDALAB_QE_VIBROSCOPY_CACHE_DIR is empty).")
+        return
+    entries = disk_cache.entries()
+    total = sum(entry["nbytes"] for entry in entries)
+    print(f"Cache directory: {disk_cache.directory}")
+    print(
+        f"{len(entries)} entries, {total / 1024**2:.1f} MB "
+        f"(max {disk_cache.max_bytes / 1024**2:.1f} MB)"
+    )
+    # most recently used first.
+    for entry in reversed(entries):
+        accessed = datetime.datetime.fromtimestamp(entry["accessed"])
+        print(
+            f"{entry['key'][:16]}  {entry['kind']:<15} "
+            f"{entry['nbytes'] / 1024**2:>9.2f} MB  last used {accessed:%Y-%m-%d %H:%M}"
+        )
+
+
+@cache.command(help="Remove the entries of the cache (all of them, by default).")
+@click.option(
+    "--older-than",
+    type=float,
+    default=None,
+    help="Remove only the entries not used in the last given number of days.",
+)
+def purge(older_than):
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.disk_cache import (
+        get_spectrum_disk_cache,
+    )
+
+    disk_cache = get_spectrum_disk_cache()
+    if disk_cache is None:
+        print("The cache is disabled (AIIDALAB_QE_VIBROSCOPY_CACHE_DIR is empty).")
+        return
+    removed = disk_cache.purge(
+        older_than=older_than * 24 * 3600 if older_than is not None else None
+    )
+    print(f"Removed {removed} entries from {disk_cache.directory}.")
+
+
 if __name__ == "__main__":
     cli()
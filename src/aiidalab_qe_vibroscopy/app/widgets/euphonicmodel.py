@@ -1,18 +1,24 @@
 import numpy as np
 import traitlets as tl
 import copy
+import threading
 
+from euphonic import Spectrum2D
 from IPython.display import display
 
 from aiidalab_qe.common.mvc import Model
 
 from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
     AttrDict,
+    produce_bands_preview,
     produce_bands_weigthed_data,
     produce_powder_data,
+    stream_powder_data,
     generated_curated_data,
     produce_Q_section_spectrum,
     produce_Q_section_modes,
+    produce_Q_section_intensities,
+    produce_Q_section_energy_stack,
 )
 from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
     generate_force_constant_from_phonopy,
@@ -24,6 +30,16 @@ from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
     parameters_single_crystal,
     parameters_powder,
 )
+from aiidalab_qe_vibroscopy.utils.euphonic.data.execution import get_execution_policy
+from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import StageCache
+from aiidalab_qe_vibroscopy.utils.euphonic.data.disk_cache import (
+    get_spectrum_disk_cache,
+    q_section_from_arrays,
+    q_section_to_arrays,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.native_format import (
+    force_constants_to_npz,
+)
 
 
 class EuphonicResultsModel(Model):
@@ -50,6 +66,7 @@ class EuphonicResultsModel(Model):
     temperature = tl.Float(0)  # temperature
     weighting = tl.Unicode("coherent")  # weighting
     energy_units = tl.Unicode("meV")  # energy units
+    precision = tl.Unicode("double")  # "single": float32 maps, half the memory
     intensity_filter = tl.List(
         trait=tl.Float(), default_value=[0, 100]
     )  # intensity filter
@@ -74,6 +91,18 @@ class EuphonicResultsModel(Model):
         self.xlabel = None
         self.ylabel = self.energy_units
         self.detached_app = detached_app
+        # partial maps: all of them, and the groups of atoms shown (None: all).
+        self.partial_spectra = None
+        self.partial_selection = None
+        # memoised stages of the spectra generation, so that replotting after changing
+        # e.g. only the broadening does not recompute the phonon modes.
+        self._stage_cache = StageCache()
+        # the jobs run in background threads (see get_spectra_job) have their own stage
+        # cache, used by one of them at a time.
+        self._background_stage_cache = StageCache()
+        self._background_lock = threading.Lock()
+        # spectra stored on disk, shared across sessions (None if disabled, see disk_cache.py).
+        self._disk_cache = get_spectrum_disk_cache()
         if node:  # qe app mode.
             self.vibro = node
 
@@ -151,6 +180,18 @@ class EuphonicResultsModel(Model):
 
         # Dynamically add a trait for single crystal settings
         self.add_traits(custom_kpath=tl.Unicode(""))
+        # temperature series: comma separated temperatures (K), and the index of the one shown.
+        self.add_traits(temperatures=tl.Unicode(""))
+        self.add_traits(series_index=tl.Int(0))
+        # why the temperatures are not valid ("" if they are), shown next to them.
+        self.add_traits(temperatures_error=tl.Unicode(""))
+        self.observe(self._validate_temperatures, names="temperatures")
+        # fast preview: interpolated map shown first, then replaced by the exact one.
+        self.add_traits(preview=tl.Bool(False))
+        # adaptive density of q-points along the path (0: uniform path).
+        self.add_traits(path_tolerance=tl.Float(0.0))
+        # partial maps: "" (total map), "species" or "atoms".
+        self.add_traits(partials=tl.Unicode(""))
 
     def _inject_powder_settings(
         self,
@@ -162,6 +203,9 @@ class EuphonicResultsModel(Model):
         self.add_traits(q_min=tl.Float(0.0))
         self.add_traits(q_max=tl.Float(1))
         self.add_traits(npts=tl.Int(500))
+        self.add_traits(symmetry_reduction=tl.Bool(False))
+        self.add_traits(npts_tolerance=tl.Float(0.0))
+        self.add_traits(partials=tl.Unicode(""))
 
     def _inject_qsection_settings(
         self,
@@ -186,37 +230,194 @@ class EuphonicResultsModel(Model):
         if self.spectrum_type == "q_planes":
             self._get_qsection_spectra()
         else:
-            self.parameters.update(self.get_model_state())
-            # custom path case (some non 3D systems, or custom linear path from user inputs)
-            custom_kpath = self.custom_kpath if hasattr(self, "custom_kpath") else ""
-            if len(custom_kpath) > 1:
-                coordinates, labels = self._curate_path_and_labels()
-                qpath = {
-                    "coordinates": coordinates,
-                    "labels": labels,  # ["$\Gamma$","X","X","(1,1,1)"],
-                    "delta_q": self.parameters["q_spacing"],
-                }
-            else:
-                qpath = copy.deepcopy(self.q_path)
-                if qpath:
-                    qpath["delta_q"] = self.parameters["q_spacing"]
-
-            # we need to convert back the broadening to meV, as in the get_spectra we use the meV units.
-            self.parameters["energy_broadening"] = (
-                self.energy_broadening
-                / self.energy_conversion_factor(meV_to=self.energy_units)
-            )
+            self.set_spectra(self.get_spectra_job()())
+
+    def get_spectra_job(self, background=False):
+        """Function computing the spectra (single crystal and powder) with the current
+        parameters: the parameters are taken now, so the model can change meanwhile. Its
+        result is to be passed to set_spectra.
 
-            spectra, parameters = self._callback_spectra_generation(
-                params=AttrDict(self.parameters),
+        With background=True, the job can run in a background thread: it uses the stage
+        cache of the background jobs (not the one of the main thread), one job at a time.
+        """
+        qpath = self._update_parameters()
+        params = AttrDict(copy.deepcopy(self.parameters))
+
+        def compute(cache=self._stage_cache):
+            spectra, _ = self._callback_spectra_generation(
+                params=params,
                 fc=self.fc,
                 linear_path=qpath,
                 plot=False,
+                cache=cache,
+                disk_cache=self._disk_cache,
             )
+            return spectra
+
+        if not background:
+            return compute
+
+        def compute_in_background():
+            with self._background_lock:
+                return compute(cache=self._background_stage_cache)
+
+        return compute_in_background
+
+    def get_preview(self):
+        """Set the interpolated preview of the single crystal map as plot data
+        (see produce_bands_preview)."""
+        qpath = self._update_parameters()
+        spectrum, _ = produce_bands_preview(
+            params=AttrDict(self.parameters),
+            fc=self.fc,
+            linear_path=qpath,
+            cache=self._stage_cache,
+        )
+        self.series_spectra = None
+        self.partial_spectra = None
+        self._set_plot_data(spectrum)
+
+    def set_spectra(self, spectra):
+        """Set the spectra (output of the get_spectra_job function) as plot data."""
+        # partial maps: we keep all the maps, and show the sum of the selected groups.
+        if isinstance(spectra, list) and "partial" in spectra[0].metadata:
+            self.series_spectra = None
+            self.partial_spectra = spectra
+            labels = self.partial_group_labels()
+            self.partial_selection = [
+                label for label in self.partial_selection or [] if label in labels
+            ] or None
+            self._set_plot_data(self._partial_sum())
+            return
 
-        if self.spectrum_type == "q_planes":
+        self.partial_spectra = None
+        # temperature series: we keep all the spectra, and show the selected one.
+        self.series_spectra = spectra if isinstance(spectra, list) else None
+        if self.series_spectra:
+            self.series_index = min(self.series_index, len(spectra) - 1)
+            spectra = spectra[self.series_index]
+
+        self._set_plot_data(spectra)
+
+    def iter_spectra(self):
+        """Like get_spectra, but for the powder maps yield the index of each |q| shell
+        as soon as it is sampled, with the partial map (NaN for the missing shells) set
+        as plot data. The last yielded index is None, when the final map is set."""
+        if self.spectrum_type != "powder":
+            self.get_spectra()
+            yield None
             return
 
+        self._update_parameters()
+        for spectrum, q_index in stream_powder_data(
+            params=AttrDict(self.parameters),
+            fc=self.fc,
+            cache=self._stage_cache,
+            disk_cache=self._disk_cache,
+        ):
+            self.set_spectra(spectrum)
+            yield q_index
+
+    def _update_parameters(self):
+        """Update the parameters from the model state; returns the q path (None for powder)."""
+        self.parameters.update(self.get_model_state())
+        # custom path case (some non 3D systems, or custom linear path from user inputs)
+        custom_kpath = self.custom_kpath if hasattr(self, "custom_kpath") else ""
+        if len(custom_kpath) > 1:
+            coordinates, labels = self._curate_path_and_labels()
+            qpath = {
+                "coordinates": coordinates,
+                "labels": labels,  # ["$\Gamma$","X","X","(1,1,1)"],
+                "delta_q": self.parameters["q_spacing"],
+            }
+        else:
+            qpath = copy.deepcopy(self.q_path)
+            if qpath:
+                qpath["delta_q"] = self.parameters["q_spacing"]
+
+        # we need to convert back the broadening to meV, as in the get_spectra we use the meV units.
+        self.parameters["energy_broadening"] = (
+            self.energy_broadening
+            / self.energy_conversion_factor(meV_to=self.energy_units)
+        )
+        if "temperatures" in self.parameters:
+            # the series is only available for the S(Q, ω) (coherent) maps.
+            self.parameters["temperatures"] = (
+                self._get_temperature_series() if self.weighting == "coherent" else None
+            )
+        if "partials" in self.parameters:
+            # the partial maps are only available for the coherent weighting, and they
+            # replace the temperature series.
+            self.parameters["partials"] = (
+                self.partials or None if self.weighting == "coherent" else None
+            )
+            if self.parameters["partials"] and self.parameters.get("temperatures"):
+                self.parameters["temperatures"] = None
+        return qpath
+
+    def select_series_spectrum(self, index):
+        """Show the spectrum of the temperature series at the given index (no recomputation)."""
+        self.series_index = index
+        self._set_plot_data(self.series_spectra[index])
+
+    def partial_group_labels(self):
+        """The groups of atoms of the partial maps (empty if the map is the total one)."""
+        if not self.partial_spectra:
+            return []
+        return [
+            spectrum.metadata["partial"][0]
+            for spectrum in self.partial_spectra
+            if len(spectrum.metadata["partial"]) == 1
+        ]
+
+    def select_partials(self, labels):
+        """Show the map of the given groups of atoms only (all of them if empty), summing
+        their partial maps and their cross terms (no recomputation)."""
+        self.partial_selection = list(labels) or None
+        self._set_plot_data(self._partial_sum())
+
+    def _partial_sum(self):
+        selection = set(self.partial_selection or self.partial_group_labels())
+        spectra = [
+            spectrum
+            for spectrum in self.partial_spectra
+            if set(spectrum.metadata["partial"]) <= selection
+        ]
+        first = self.partial_spectra[0]
+        z_data = np.sum([spectrum.z_data.magnitude for spectrum in spectra], axis=0)
+        return Spectrum2D(
+            first.x_data,
+            first.y_data,
+            z_data * first.z_data.units,
+            x_tick_labels=first.x_tick_labels,
+            metadata={k: v for k, v in first.metadata.items() if k != "partial"},
+        )
+
+    def _get_temperature_series(self):
+        """The temperatures (K) of the series, from the comma separated temperatures trait
+        (None if there are none, or if they are not valid: see temperatures_error)."""
+        temperatures, error = self._parse_temperatures(self.temperatures)
+        return None if error else temperatures
+
+    def _validate_temperatures(self, change=None):
+        _, self.temperatures_error = self._parse_temperatures(self.temperatures)
+
+    @staticmethod
+    def _parse_temperatures(text):
+        """The temperatures (K) in the comma (or space) separated text, and the error
+        message if they are not valid (non-negative numbers), else ""."""
+        temperatures = []
+        for token in text.replace(",", " ").split():
+            try:
+                temperature = float(token)
+            except ValueError:
+                return None, f"'{token}' is not a temperature in K, e.g. 10, 100, 300"
+            if not np.isfinite(temperature) or temperature < 0:
+                return None, f"{token}: the temperatures must be >= 0 K"
+            temperatures.append(temperature)
+        return temperatures or None, ""
+
+    def _set_plot_data(self, spectra):
         # curated spectra (labels and so on...)
         self.x, self.y_meV = np.meshgrid(
             spectra.x_data.magnitude, spectra.y_data.magnitude
@@ -235,6 +436,7 @@ class EuphonicResultsModel(Model):
 
             self.ticks_positions = ticks_positions
             self.ticks_labels = ticks_labels
+            self.sampling_info = self._get_sampling_info(spectra.metadata)
 
             self.z = final_zspectra.T
 
@@ -245,6 +447,11 @@ class EuphonicResultsModel(Model):
             self.x = list(
                 range(self.ticks_positions[-1] + 1)
             )  # we have, instead, the ticks positions and labels
+            if "path_indices" in spectra.metadata:
+                # adaptive path: the columns are at their (non-uniform) positions on the path.
+                path_indices = spectra.metadata["path_indices"]
+                self.x = path_indices
+                self.ticks_positions = [path_indices[i] for i in ticks_positions]
 
         elif self.spectrum_type == "powder":  # powder case
             # Spectrum2D as output of the powder data
@@ -255,6 +462,7 @@ class EuphonicResultsModel(Model):
 
             self.x = spectra.x_data.magnitude
             self.z = spectra.z_data.magnitude.T
+            self.sampling_info = self._get_sampling_info(spectra.metadata)
 
         else:
             raise ValueError("Spectrum type not recognized:", self.spectrum_type)
@@ -265,6 +473,34 @@ class EuphonicResultsModel(Model):
 
         self.ylabel = self.energy_units
 
+    def _get_sampling_info(self, metadata):
+        """Short summary of how the powder shells were sampled (see powder.py)."""
+        if "npts" in metadata and self.npts_tolerance:
+            npts = metadata["npts"]
+            return (
+                f"Adaptive sampling: {min(npts)}-{max(npts)} points per |q| shell "
+                f"({sum(npts)} in total)."
+            )
+        if "grid_convergence" in metadata:
+            return (
+                f"Grid sampling: {metadata['grid_irreducible_qpts']} irreducible q-points, "
+                f"estimated relative error {100 * metadata['grid_convergence']:.1f}%."
+            )
+        if "path_indices" in metadata:
+            path_indices = metadata["path_indices"]
+            return (
+                f"Adaptive path: {len(path_indices)} of {path_indices[-1] + 1} q-points "
+                "computed."
+            )
+        if "preview_qpts" in metadata:
+            return (
+                f"Preview, interpolated from {metadata['preview_qpts']} q-points; "
+                "estimated error: "
+                f"{metadata['preview_frequency_error']:.2g} meV in the frequencies, "
+                f"{100 * metadata['preview_intensity_error']:.1f}% in the intensities."
+            )
+        return ""
+
     def _get_qsection_spectra(
         self,
     ):
@@ -286,38 +522,90 @@ class EuphonicResultsModel(Model):
                 / self.energy_conversion_factor(
                     meV_to=self.energy_units
                 ),  # convert to meV
-                "ebins": self.ebins,
                 "spectrum_type": self.weighting,
                 "temperature": self.temperature,
+                "precision": self.precision,
             }
         )
 
-        modes, q_array, h_array, k_array, labels, dw = produce_Q_section_modes(
+        def compute():
+            intensities, q_array, h_array, k_array, labels = self._get_qplane()
+            return produce_Q_section_spectrum(
+                None,
+                q_array,
+                h_array,
+                k_array,
+                ecenter=self.parameters_qplanes.ecenter,
+                deltaE=self.parameters_qplanes.deltaE,
+                labels=labels,
+                intensities=intensities,
+            )
+
+        if self._disk_cache is not None:
+            q_section = self._disk_cache.get(
+                self._disk_cache.key("q_planes", self.fc, self.parameters_qplanes),
+                compute,
+                q_section_to_arrays,
+                q_section_from_arrays,
+                kind="q_planes",
+            )
+        else:
+            q_section = compute()
+        self.z, q_array, self.x, self.y, self.labels = q_section
+        self.xlabel = self.labels["h"]
+        self.ylabel = self.labels["k"]
+
+    def _get_qplane(self):
+        # the modes and the per-mode intensities of the plane do not depend on the energy
+        # cut: they are kept in the stage cache, so a new cut is only a sum over the modes.
+        parameters = self.parameters_qplanes
+        plane_key = (
             self.fc,
-            h=self.parameters_qplanes.h,
-            k=self.parameters_qplanes.k,
-            Q0=self.parameters_qplanes.Q0,
-            n_h=self.parameters_qplanes.n_h,
-            n_k=self.parameters_qplanes.n_k,
-            h_extension=self.parameters_qplanes.h_extension,
-            k_extension=self.parameters_qplanes.k_extension,
-            temperature=self.parameters_qplanes.temperature,
+            tuple(parameters.h),
+            tuple(parameters.k),
+            tuple(parameters.Q0),
+            parameters.n_h,
+            parameters.n_k,
+            parameters.h_extension,
+            parameters.k_extension,
+            parameters.temperature,
+            parameters.spectrum_type,
+            parameters.precision,
         )
 
-        self.z, q_array, self.x, self.y, self.labels = produce_Q_section_spectrum(
-            modes,
-            q_array,
-            h_array,
-            k_array,
-            ecenter=self.parameters_qplanes.ecenter,
+        def compute_plane():
+            modes, q_array, h_array, k_array, labels, dw = produce_Q_section_modes(
+                self.fc,
+                h=parameters.h,
+                k=parameters.k,
+                Q0=parameters.Q0,
+                n_h=parameters.n_h,
+                n_k=parameters.n_k,
+                h_extension=parameters.h_extension,
+                k_extension=parameters.k_extension,
+                temperature=parameters.temperature,
+                precision=parameters.precision,
+            )
+            intensities = produce_Q_section_intensities(
+                modes, spectrum_type=parameters.spectrum_type, dw=dw
+            )
+            return intensities, q_array, h_array, k_array, labels
+
+        return self._stage_cache.get("q_plane", plane_key, compute_plane)
+
+    def get_qsection_energy_stack(self, ecenters):
+        """The intensities of the last plotted Q-plane at each of the energies `ecenters`
+        (in the current energy units), as a (n_cuts, n_Q) array, e.g. for an energy scan.
+
+        The plane is computed only if it is not in the cache (see _get_qplane).
+        """
+        conversion = self.energy_conversion_factor(meV_to=self.energy_units)
+        intensities, *_ = self._get_qplane()
+        return produce_Q_section_energy_stack(
+            intensities,
+            np.asarray(ecenters) / conversion,
             deltaE=self.parameters_qplanes.deltaE,
-            bins=self.parameters_qplanes.ebins,
-            spectrum_type=self.parameters_qplanes.spectrum_type,
-            dw=dw,
-            labels=labels,
         )
-        self.xlabel = self.labels["h"]
-        self.ylabel = self.labels["k"]
 
     def energy_conversion_factor(self, meV_to="meV"):
         if meV_to == "meV" or not meV_to:
@@ -410,6 +698,7 @@ class EuphonicResultsModel(Model):
         info_legend_text = env.from_string(info_legend_template).render(
             {
                 "spectrum_type": self.spectrum_type,
+                "execution": get_execution_policy(),
             }
         )
 
@@ -426,6 +715,13 @@ class EuphonicResultsModel(Model):
         )
         return phonopy_yaml, fc_hdf5
 
+    def produce_euphonic_file(self):
+        # The force constants in the euphonic layout (.npz), encoded as the phonopy files.
+        import base64
+
+        self.fetch_data()
+        return base64.b64encode(force_constants_to_npz(self.fc)).decode()
+
     def prepare_data_for_download(self):
         import pandas as pd
         import base64
@@ -7,6 +7,11 @@ from aiidalab_qe_vibroscopy.app.widgets.structurefactorwidget import (
     EuphonicStructureFactorWidget,
 )
 from aiidalab_qe_vibroscopy.app.widgets.euphonicmodel import EuphonicResultsModel
+from aiidalab_qe_vibroscopy.utils.euphonic.data.execution import (
+    available_cpus,
+    get_execution_policy,
+    set_execution_policy,
+)
 
 from aiidalab_qe.common.infobox import InAppGuide
 
@@ -106,6 +111,18 @@ class EuphonicWidget(ipw.VBox):
         self.loading_widget = LoadingWidget("Loading INS data")
         self.loading_widget.layout.display = "none"
 
+        # global execution policy of the INS calculations (see utils/euphonic/data/execution.py)
+        self.threads_widget = ipw.BoundedIntText(
+            value=get_execution_policy()["n_threads"],
+            min=1,
+            max=available_cpus(),
+            description="CPU threads:",
+            tooltip="Number of threads used in the INS calculations",
+            style={"description_width": "initial"},
+            layout=ipw.Layout(width="auto"),
+        )
+        self.threads_widget.observe(self._on_threads_change, names="value")
+
         if not self._model.detached_app:
             # we are in QeApp, for sure data are already there.
             self.plot_button.disabled = False
@@ -129,6 +146,7 @@ class EuphonicWidget(ipw.VBox):
 
         self.children += (
             InAppGuide(identifier="ins-results"),
+            self.threads_widget,
             self.plot_button,
             self.tab_widget,
             self.download_widget,
@@ -158,6 +176,8 @@ class EuphonicWidget(ipw.VBox):
 
         # setting the data for the other two models, because these are exactly the same.
         # the difference is in the post processiong routines.
+        # Sharing the same fc object, the three models share also its cache of derived
+        # quantities (Debye-Waller factor, grid modes, seekpath, see utils/euphonic/data/cache.py).
         for data in ["fc", "q_path"]:
             setattr(powder_model, data, getattr(self._model, data))
             setattr(qsection_model, data, getattr(self._model, data))
@@ -187,6 +207,12 @@ class EuphonicWidget(ipw.VBox):
         self.tab_widget.layout.display = "block"
         self.download_widget.layout.display = "block"
 
+    def _on_threads_change(self, change):
+        set_execution_policy(n_threads=change["new"])
+        # the info legends report the execution policy.
+        for widget in self.tab_widget.children:
+            widget._model.generate_info_legend()
+
     def _on_reset_uploads_button_clicked(self, change):
         # method employed in the detached app to reset the upload widgets.
         self.upload_widget.upload_phonopy_yaml.value.clear()
@@ -202,7 +228,7 @@ class EuphonicWidget(ipw.VBox):
         self.tab_widget.layout.display = "none"
 
     def _on_upload_yaml(self, change):
-        # detached app method to handle the upload of a phonopy YAML file.
+        # detached app method to handle the upload of a phonopy YAML (or euphonic npz) file.
         if change["new"] != change["old"]:
             for fname in self.upload_widget.children[
                 0
@@ -226,7 +252,7 @@ class EuphonicWidget(ipw.VBox):
 
 class DownloadYamlHdf5Widget(ipw.HBox):
     """
-    Widget to download the phonopy.yaml and fc.hdf5 files.
+    Widget to download the phonopy.yaml and fc.hdf5 files (and the fc_euphonic.npz file).
 
     The download button will trigger the download of the phonopy.yaml and fc.hdf5 files
     via the _download_data method of the widget and the produce_phonopy_files method of the model.
@@ -254,11 +280,15 @@ class DownloadYamlHdf5Widget(ipw.HBox):
 
     def _download_data(self, _=None):
         """
-        Download both the phonopy.yaml and fc.hdf5 files.
+        Download both the phonopy.yaml and fc.hdf5 files, and the force constants
+        in the euphonic layout (fc_euphonic.npz), which is faster to load in the detached app.
         """
         phonopy_yaml, fc_hdf5 = self._model.produce_phonopy_files()
         self._download(payload=phonopy_yaml, filename="phonopy" + ".yaml")
         self._download(payload=fc_hdf5, filename="fc" + ".hdf5")
+        self._download(
+            payload=self._model.produce_euphonic_file(), filename="fc_euphonic.npz"
+        )
 
     @staticmethod
     def _download(payload, filename):
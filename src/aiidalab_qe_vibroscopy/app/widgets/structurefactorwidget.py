@@ -1,3 +1,8 @@
+import asyncio
+import html
+import threading
+import time
+
 import ipywidgets as ipw
 import numpy as np
 import plotly.graph_objs as go
@@ -9,6 +14,19 @@ from aiidalab_qe_vibroscopy.app.widgets.euphonicmodel import EuphonicResultsMode
 
 COLORSCALE = "Viridis"  # we should allow more options
 COLORBAR_DICT = dict(orientation="v", showticklabels=False, x=1, thickness=10, len=0.4)
+LIVE_UPDATE_INTERVAL = (
+    0.5  # minimum time (s) between two updates of the live powder map
+)
+
+
+def _main_thread_caller():
+    """Function calling f(*args) in the current (main) thread from another thread, via its
+    event loop (the one of the kernel); directly, if there is no running event loop."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return lambda f, *args: f(*args)
+    return loop.call_soon_threadsafe
 
 
 class EuphonicStructureFactorWidget(ipw.VBox):
@@ -198,6 +216,25 @@ class EuphonicStructureFactorWidget(ipw.VBox):
         )
         weight_button.observe(self._on_weight_button_change, names="value")
 
+        precision_dropdown = ipw.Dropdown(
+            options=[
+                ("double", "double"),
+                ("single (float32)", "single"),
+            ],
+            value=self._model.precision,
+            description="Precision:",
+            tooltip="Single precision: half the memory, for visualisation",
+            style={"description_width": "initial"},
+            layout=ipw.Layout(
+                width="auto",
+            ),
+        )
+        ipw.link(
+            (self._model, "precision"),
+            (precision_dropdown, "value"),
+        )
+        precision_dropdown.observe(self._on_setting_change, names="value")
+
         self.plot_button = ipw.Button(
             description="Replot",
             icon="pencil",
@@ -255,6 +292,7 @@ class EuphonicStructureFactorWidget(ipw.VBox):
                             ebins,
                             self.temperature,
                             weight_button,
+                            precision_dropdown,
                             self.plot_button,
                             reset_button,
                             self.download_button,
@@ -284,7 +322,81 @@ class EuphonicStructureFactorWidget(ipw.VBox):
             )
             self.custom_kpath_text.observe(self._on_setting_change, names="value")
 
-            self.children += (self.custom_kpath_text,)
+            # temperature series: the maps for all the temperatures are computed together,
+            # then we just switch between them.
+            self.temperatures_text = ipw.Text(
+                value="",
+                description="T series (K):",
+                placeholder="e.g. 10, 100, 300",
+                tooltip="Comma separated temperatures, computed in one go (S(Q, ω) only)",
+                style={"description_width": "initial"},
+                continuous_update=True,
+            )
+            ipw.link(
+                (self._model, "temperatures"),
+                (self.temperatures_text, "value"),
+            )
+            self.temperatures_text.observe(self._on_temperatures_change, names="value")
+            # invalid temperatures are reported here, and cannot be plotted.
+            self.temperatures_error = ipw.HTML("")
+            ipw.dlink(
+                (self._model, "temperatures_error"),
+                (self.temperatures_error, "value"),
+                lambda error: f'<span style="color: #a94442;">{html.escape(error)}</span>'
+                if error
+                else "",
+            )
+
+            self.series_dropdown = ipw.Dropdown(
+                options=[],
+                description="Shown T (K):",
+                style={"description_width": "initial"},
+                layout=ipw.Layout(width="auto", display="none"),
+            )
+            self.series_dropdown.observe(self._on_series_change, names="value")
+
+            # fast preview: the interpolated map is shown at once, the exact one replaces
+            # it when computed (in a background thread).
+            self.preview = ipw.Checkbox(
+                value=False,
+                description="Fast preview (interpolated)",
+                indent=False,
+                layout=ipw.Layout(width="auto"),
+            )
+            ipw.link(
+                (self._model, "preview"),
+                (self.preview, "value"),
+            )
+            self.preview.observe(self._on_setting_change, names="value")
+
+            self.path_tolerance = ipw.BoundedFloatText(
+                value=0,
+                min=0,
+                max=1,
+                step=0.005,
+                description="Adaptive q tol.",
+                continuous_update=True,
+            )
+            ipw.link(
+                (self._model, "path_tolerance"),
+                (self.path_tolerance, "value"),
+            )
+            self.path_tolerance.observe(self._on_setting_change, names="value")
+
+            self.sampling_info = ipw.HTML("")
+
+            self.children += (
+                self.custom_kpath_text,
+                ipw.HBox(
+                    [
+                        self.temperatures_text,
+                        self.temperatures_error,
+                        self.series_dropdown,
+                    ]
+                ),
+                ipw.HBox([self.path_tolerance, self.preview, self.sampling_info]),
+                self._render_partials(),
+            )
 
         elif self._model.spectrum_type == "powder":
             self.qmin = ipw.BoundedFloatText(
@@ -314,17 +426,50 @@ class EuphonicStructureFactorWidget(ipw.VBox):
             )
             self.qmax.observe(self._on_setting_change, names="value")
 
+            self.symmetry_reduction = ipw.Checkbox(
+                value=False,
+                description="Use crystal symmetry (faster)",
+                indent=False,
+                layout=ipw.Layout(width="auto"),
+            )
+            ipw.link(
+                (self._model, "symmetry_reduction"),
+                (self.symmetry_reduction, "value"),
+            )
+            self.symmetry_reduction.observe(self._on_setting_change, names="value")
+
+            self.npts_tolerance = ipw.BoundedFloatText(
+                value=0,
+                min=0,
+                max=1,
+                step=0.005,
+                description="Adaptive tol.",
+                continuous_update=True,
+            )
+            ipw.link(
+                (self._model, "npts_tolerance"),
+                (self.npts_tolerance, "value"),
+            )
+            self.npts_tolerance.observe(self._on_setting_change, names="value")
+
+            self.sampling_info = ipw.HTML("")
+
             self.children += (
                 ipw.HBox(
                     [
                         self.qmin,
                         self.qmax,
+                        self.symmetry_reduction,
                     ],
                 ),
+                ipw.HBox([self.npts_tolerance, self.sampling_info]),
+                self._render_partials(),
             )
 
         elif self._model.spectrum_type == "q_planes":
             q_spacing.layout.display = "none"
+            # the E cuts are evaluated directly on the modes, without energy bins.
+            ebins.layout.display = "none"
 
             self.ecenter = ipw.FloatText(
                 value=0,
@@ -423,6 +568,32 @@ class EuphonicStructureFactorWidget(ipw.VBox):
         # RENDERING IS DONE, SO:
         self.rendered = True
 
+    def _render_partials(self):
+        # partial maps: computed all together, then we just sum the ones of the selected
+        # groups of atoms (S(Q, ω) only).
+        self.partials_dropdown = ipw.Dropdown(
+            options=[("Total", ""), ("Species", "species"), ("Atoms", "atoms")],
+            value="",
+            description="Partial maps:",
+            style={"description_width": "initial"},
+            layout=ipw.Layout(width="auto"),
+        )
+        ipw.link(
+            (self._model, "partials"),
+            (self.partials_dropdown, "value"),
+        )
+        self.partials_dropdown.observe(self._on_setting_change, names="value")
+
+        self.partials_select = ipw.SelectMultiple(
+            options=[],
+            description="Shown:",
+            tooltip="Groups of atoms shown (all if none is selected)",
+            rows=4,
+            layout=ipw.Layout(width="auto", display="none"),
+        )
+        self.partials_select.observe(self._on_partials_change, names="value")
+        return ipw.HBox([self.partials_dropdown, self.partials_select])
+
     def _init_view(self, _=None):
         # for safety, we fetch the data again (should have happened already in the EuophonicWidget).
         # if already there, this model method will not do anything.
@@ -451,10 +622,85 @@ class EuphonicStructureFactorWidget(ipw.VBox):
     ):  # think if we want to do something more evident...
         self.plot_button.disabled = False
 
+    def _on_temperatures_change(self, change):
+        # the model validates the temperatures first (it observes them through the link).
+        self.plot_button.disabled = bool(self._model.temperatures_error)
+
     def _update_plot(self, _=None):
         # update the spectra, i.e. the data to be plotted contained in the _model.
-        self._model.get_spectra()
-
+        # (a new plot discards the exact map still computed for a previous preview.)
+        self._plot_request = getattr(self, "_plot_request", 0) + 1
+        preview = self._model.spectrum_type == "single_crystal" and self._model.preview
+        if self._model.spectrum_type == "powder":
+            self._stream_plot()
+        elif preview:
+            self._model.get_preview()
+            self._model.sampling_info += " Computing the exact map..."
+        else:
+            self._model.get_spectra()
+        self._update_series_dropdown()
+        self._update_partials_select()
+        self._update_sampling_info()
+        self._draw()
+        if preview:
+            self._compute_exact_in_background()
+
+    def _compute_exact_in_background(self):
+        # the exact map replaces the preview when ready, unless another plot was
+        # requested in the meantime. Only the calculation runs in the thread: the model
+        # and the widgets are updated in the main thread, via the event loop of the kernel.
+        request = self._plot_request
+        compute = self._model.get_spectra_job(background=True)
+        call_in_main_thread = _main_thread_caller()
+
+        def show_exact(spectra):
+            if request != self._plot_request:
+                return
+            self._model.set_spectra(spectra)
+            self._update_series_dropdown()
+            self._update_partials_select()
+            self._update_sampling_info()
+            self._draw()
+
+        def show_error(error):
+            if request != self._plot_request:
+                return
+            self._model.sampling_info = (
+                "Preview only, the exact map could not be computed: "
+                f"{html.escape(str(error))}"
+            )
+            self._update_sampling_info()
+            self.plot_button.disabled = False
+
+        def run():
+            try:
+                spectra = compute()
+            except Exception as error:
+                call_in_main_thread(show_error, error)
+            else:
+                call_in_main_thread(show_exact, spectra)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _stream_plot(self):
+        # the powder map is shown while the |q| shells are sampled: the first shell
+        # draws the heatmap, the next ones only replace its rows (the final, broadened,
+        # map is drawn by _update_plot).
+        drawn = False
+        last_update = time.monotonic()
+        for q_index in self._model.iter_spectra():
+            if q_index is None:
+                break
+            if not drawn:
+                self._draw()
+                self.plot_button.disabled = True
+                drawn = True
+            elif time.monotonic() - last_update > LIVE_UPDATE_INTERVAL:
+                self.fig.data[0].z = self._model.z
+                last_update = time.monotonic()
+
+    def _draw(self):
+        # plot the data currently in the _model.
         if self._model.spectrum_type == "q_planes":
             # hide figure until we have the data
             self.figure_container.layout.display = (
@@ -495,15 +741,65 @@ class EuphonicStructureFactorWidget(ipw.VBox):
 
         self.plot_button.disabled = True
 
+    def _update_series_dropdown(self):
+        if not hasattr(self, "series_dropdown"):
+            return
+        temperatures = (
+            self._model._get_temperature_series()
+            if getattr(self._model, "series_spectra", None)
+            else None
+        )
+        with self.series_dropdown.hold_trait_notifications():
+            self.series_dropdown.options = [
+                (f"{t:g}", i) for i, t in enumerate(temperatures or [])
+            ]
+            if temperatures:
+                self.series_dropdown.value = self._model.series_index
+        self.series_dropdown.layout.display = "block" if temperatures else "none"
+
+    def _update_partials_select(self):
+        if not hasattr(self, "partials_select"):
+            return
+        labels = self._model.partial_group_labels()
+        with self.partials_select.hold_trait_notifications():
+            self.partials_select.options = labels
+            self.partials_select.value = tuple(self._model.partial_selection or [])
+        self.partials_select.layout.display = "flex" if labels else "none"
+
+    def _update_sampling_info(self):
+        if not hasattr(self, "sampling_info"):
+            return
+        self.sampling_info.value = getattr(self._model, "sampling_info", "")
+
+    def _on_series_change(self, change):
+        # no recomputation: the spectra of the series are already in the model.
+        if change["new"] in (None, self._model.series_index):
+            return
+        replot_was_off = self.plot_button.disabled
+        self._model.select_series_spectrum(change["new"])
+        self._draw()
+        self.plot_button.disabled = replot_was_off
+
+    def _on_partials_change(self, change):
+        # no recomputation: the partial maps are already in the model.
+        if not self._model.partial_spectra or list(change["new"]) == list(
+            self._model.partial_selection or []
+        ):
+            return
+        replot_was_off = self.plot_button.disabled
+        self._model.select_partials(change["new"])
+        self._draw()
+        self.plot_button.disabled = replot_was_off
+
     def _update_intensity_filter(self, change=None):
         # the value of the intensity slider is in fractions of the max.
         # NOTE: we do this here, as we do not want to replot. Reason is that
         # the data will not change! so we don't need to invoke the model.
         self.fig.data[0].zmax = (
-            self._model.intensity_filter[1] * np.max(self.fig.data[0].z) / 100
+            self._model.intensity_filter[1] * np.nanmax(self.fig.data[0].z) / 100
         )  # above this, it is all yellow, i.e. max intensity.
         self.fig.data[0].zmin = (
-            self._model.intensity_filter[0] * np.max(self.fig.data[0].z) / 100
+            self._model.intensity_filter[0] * np.nanmax(self.fig.data[0].z) / 100
         )  # below this, it is all blue, i.e. zero intensity
 
     def _update_energy_units(self, change):
@@ -101,6 +101,9 @@ def get_builder(codes, structure, parameters):
         spin_type=SpinType(parameters["workchain"]["spin_type"]),
         initial_magnetic_moments=parameters["advanced"]["initial_magnetic_moments"],
     )
+    if simulation_mode in [1, 3]:
+        # force constants ready to be used in the INS results (euphonic).
+        builder.export_euphonic_force_constants = orm.Bool(True)
 
     return builder
 
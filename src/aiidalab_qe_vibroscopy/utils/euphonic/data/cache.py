@@ -0,0 +1,189 @@
+"""Caches for the INS calculations.
+
+StageCache memoises the stages of the spectra pipelines (e.g. modes -> mode list -> binning
+-> broadening in produce_bands_weigthed_data). Each stage keeps only its last result,
+together with the key it was computed with, i.e. the subset of parameters the stage depends on
+(including the keys of the upstream stages). When the user changes only a downstream parameter
+(say the energy broadening), the upstream stages are found in the cache and are not recomputed.
+
+DerivedCache holds the quantities which depend only on the force constants and on a few
+settings: the phonon modes on the Monkhorst-Pack grid and the Debye-Waller factor computed from
+them, and the seekpath explicit path. There is one DerivedCache per ForceConstants object (see
+derived_cache), so every function (and every tab of the app) working with the same force
+constants shares it. It is a LRU cache, bounded in memory by DERIVED_CACHE_MEMORY, and it is
+thread-safe (e.g. the exact map after a preview is computed in a background thread).
+"""
+
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import seekpath
+from euphonic import ureg
+from euphonic.cli.utils import _grid_spec_from_args
+from euphonic.util import mp_grid
+
+# memory bound (bytes) of each DerivedCache.
+DERIVED_CACHE_MEMORY = 512 * 1024**2
+
+_MISSING = object()
+
+
+class StageCache:
+    """Single-slot memoisation of the stages of a pipeline."""
+
+    def __init__(self):
+        self._stages = {}
+
+    def get(self, stage, key, compute):
+        """Return the result of `stage` for `key`, calling compute() if it is not cached.
+
+        Keys are compared by equality (objects without __eq__, like the ForceConstants,
+        by identity), so they do not need to be hashable.
+        """
+        value = self.lookup(stage, key, default=_MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.store(stage, key, value)
+        return value
+
+    def lookup(self, stage, key, default=None):
+        """The result of `stage` for `key`, `default` if it is not cached."""
+        if stage in self._stages:
+            cached_key, value = self._stages[stage]
+            if cached_key == key:
+                return value
+        return default
+
+    def store(self, stage, key, value):
+        self._stages[stage] = (key, value)
+
+    def clear(self):
+        self._stages = {}
+
+
+def _nbytes(value):
+    """Rough memory footprint of a cached value: the numpy arrays it holds."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "magnitude"):  # pint Quantity
+        return _nbytes(value.magnitude)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if hasattr(value, "__dict__"):
+        return _nbytes(vars(value))
+    return 0
+
+
+class DerivedCache:
+    """LRU cache of the quantities derived from one ForceConstants."""
+
+    def __init__(self, max_bytes=DERIVED_CACHE_MEMORY):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        # held also while computing, so that a value is computed once when two threads
+        # need it (reentrant: e.g. the Debye-Waller factor gets the grid modes).
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._entries.values())
+
+    def get(self, key, compute):
+        """Return the value for the (hashable) `key`, calling compute() if it is not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+            value = compute()
+            nbytes = _nbytes(value)
+            if nbytes > self.max_bytes:
+                # would evict everything else, we do not store it.
+                return value
+            self._entries[key] = (value, nbytes)
+            while self.nbytes > self.max_bytes:
+                self._entries.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_DERIVED_CACHES = weakref.WeakKeyDictionary()
+_DERIVED_CACHES_LOCK = threading.Lock()
+
+
+def derived_cache(fc):
+    """The DerivedCache attached to `fc` (created at the first call).
+
+    The cache lives as long as the ForceConstants object, and is not part of its state
+    (e.g. it is not sent to the workers of the parallel powder engine).
+    """
+    with _DERIVED_CACHES_LOCK:
+        if fc not in _DERIVED_CACHES:
+            _DERIVED_CACHES[fc] = DerivedCache()
+        return _DERIVED_CACHES[fc]
+
+
+def get_grid_modes(
+    fc, grid=None, grid_spacing=0.1 * ureg("1/angstrom"), **calc_modes_kwargs
+):
+    """Cached phonon modes of `fc` on the Monkhorst-Pack grid given by grid or grid_spacing."""
+    mp_grid_spec = tuple(
+        int(n)
+        for n in _grid_spec_from_args(fc.crystal, grid=grid, grid_spacing=grid_spacing)
+    )
+    # the threads and the C extension do not change the result.
+    key = (
+        "grid_modes",
+        mp_grid_spec,
+        calc_modes_kwargs.get("asr"),
+        calc_modes_kwargs.get("dipole_parameter", 1.0),
+    )
+    return derived_cache(fc).get(
+        key,
+        lambda: fc.calculate_qpoint_phonon_modes(
+            mp_grid(mp_grid_spec), **calc_modes_kwargs
+        ),
+    )
+
+
+def get_debye_waller(
+    temperature,
+    fc,
+    grid=None,
+    grid_spacing=0.1 * ureg("1/angstrom"),
+    **calc_modes_kwargs,
+):
+    """Cached version of euphonic.cli.utils._get_debye_waller (same arguments)."""
+    mp_grid_spec = tuple(
+        int(n)
+        for n in _grid_spec_from_args(fc.crystal, grid=grid, grid_spacing=grid_spacing)
+    )
+    key = (
+        "debye_waller",
+        float(temperature.to("K").magnitude),
+        mp_grid_spec,
+        calc_modes_kwargs.get("asr"),
+        calc_modes_kwargs.get("dipole_parameter", 1.0),
+    )
+    return derived_cache(fc).get(
+        key,
+        lambda: get_grid_modes(
+            fc, grid=mp_grid_spec, **calc_modes_kwargs
+        ).calculate_debye_waller(temperature),
+    )
+
+
+def get_explicit_k_path(fc):
+    """Cached seekpath.get_explicit_k_path of the crystal of `fc`."""
+    return derived_cache(fc).get(
+        ("explicit_k_path",),
+        lambda: seekpath.get_explicit_k_path(fc.crystal.to_spglib_cell()),
+    )
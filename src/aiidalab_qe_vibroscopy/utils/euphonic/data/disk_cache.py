@@ -0,0 +1,342 @@
+"""Persistent (on-disk) cache of the INS spectra.
+
+The spectra computed by produce_bands_weigthed_data, produce_powder_data and the Q-planes
+(produce_Q_section_modes + produce_Q_section_spectrum) are stored on disk, so that reopening
+the same results (also in another session, or by another user of the same AiiDAlab host)
+shows the maps without recomputing them.
+
+The cache is content-addressed: the key of an entry is the hash of
+- the content of the force constants (see force_constants_hash), so that the same
+  VibroWorkChain results give the same key for every user;
+- the canonicalised parameters of the spectrum: only the ones of parameters.py are kept for
+  the single crystal and powder maps (not e.g. the legend or the intensity filter of the
+  widgets), and the execution ones, which do not change the result, are dropped;
+- the kind of spectrum, the cache format version and the euphonic version.
+
+Each entry is a directory with one .npy file per array (loaded memory-mapped) and a meta.json
+file. The total size is bounded by max_bytes: when exceeded, the least recently used entries
+are evicted (the access time is the modification time of meta.json, updated on each hit).
+Entries are written in a temporary directory and then renamed, so concurrent sessions never
+read partially written entries.
+
+The location is given by the AIIDALAB_QE_VIBROSCOPY_CACHE_DIR environment variable (set it to a
+group-writable directory to share the cache among users; set it to an empty string to disable
+the cache), the default being ~/.cache/aiidalab-qe-vibroscopy/spectra. The size bound (in MB)
+is given by AIIDALAB_QE_VIBROSCOPY_CACHE_SIZE.
+The cache can be inspected and purged with `aiidalab-qe-vibroscopy cache inspect/purge`.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import time
+import uuid
+
+import numpy as np
+import euphonic
+from euphonic import ureg
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import derived_cache
+from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+    parameters_powder,
+    parameters_single_crystal,
+)
+
+# 2: Gaussian weights of the Q-plane energy cuts with the standard deviation deltaE / 2.
+CACHE_FORMAT_VERSION = 2
+
+DEFAULT_CACHE_DIR = (
+    pathlib.Path.home() / ".cache" / "aiidalab-qe-vibroscopy" / "spectra"
+)
+DEFAULT_CACHE_SIZE = 2 * 1024**3  # bytes
+
+# parameters which do not change the spectra, only how they are computed.
+EXECUTION_PARAMETERS = (
+    "n_threads",
+    "n_workers",
+    "batch_size",
+    "preview",
+    "memory_budget",
+)
+
+# parameters of each kind of spectrum (the other kinds keep all their parameters).
+SPECTRUM_PARAMETERS = {
+    "single_crystal": frozenset(parameters_single_crystal),
+    "powder": frozenset(parameters_powder),
+}
+
+
+def force_constants_hash(fc):
+    """sha256 of the content of the force constants and of their crystal (memoised per fc)."""
+
+    def compute():
+        digest = hashlib.sha256()
+        for array in [
+            fc._force_constants,
+            np.asarray(fc.sc_matrix),
+            np.asarray(fc.cell_origins),
+            fc.crystal._cell_vectors,
+            fc.crystal.atom_r,
+            fc.crystal._atom_mass,
+        ]:
+            digest.update(memoryview(np.ascontiguousarray(array)))
+        digest.update(" ".join(str(t) for t in fc.crystal.atom_type).encode())
+        for extra in [fc._born, fc._dielectric]:
+            if extra is not None:
+                digest.update(memoryview(np.ascontiguousarray(extra)))
+        return digest.hexdigest()
+
+    return derived_cache(fc).get(("content_hash",), compute)
+
+
+def _canonical(value):
+    """JSON-serialisable canonical form of the parameters (e.g. 1 and 1.0 are the same)."""
+    if isinstance(value, dict):
+        return {
+            str(k): _canonical(v)
+            for k, v in sorted(value.items(), key=lambda item: str(item[0]))
+        }
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        return _canonical(value.item())
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if hasattr(value, "magnitude"):  # pint Quantity
+        return [_canonical(value.magnitude), str(value.units)]
+    return str(value)
+
+
+def spectra_to_arrays(spectra):
+    """Arrays and metadata of a Spectrum2D (or of a list of Spectrum2D with the same axes)."""
+    series = isinstance(spectra, list)
+    first = spectra[0] if series else spectra
+    z_data = (
+        np.stack([s.z_data.magnitude for s in spectra])
+        if series
+        else first.z_data.magnitude
+    )
+    arrays = {
+        "x_data": first.x_data.magnitude,
+        "y_data": first.y_data.magnitude,
+        "z_data": z_data,
+    }
+    meta = {
+        "series": series,
+        "units": {
+            "x_data": str(first.x_data.units),
+            "y_data": str(first.y_data.units),
+            "z_data": str(first.z_data.units),
+        },
+        "x_tick_labels": [
+            [int(i), str(label)] for i, label in (first.x_tick_labels or [])
+        ],
+        "metadata": first.metadata,
+    }
+    if series:
+        # e.g. the groups of the partial maps.
+        meta["series_metadata"] = [s.metadata for s in spectra]
+    return arrays, meta
+
+
+def spectra_from_arrays(arrays, meta):
+    """Inverse of spectra_to_arrays."""
+    units = meta["units"]
+    x_tick_labels = [tuple(item) for item in meta["x_tick_labels"]] or None
+
+    def spectrum(z_data, metadata):
+        spectrum = euphonic.Spectrum2D(
+            arrays["x_data"] * ureg(units["x_data"]),
+            arrays["y_data"] * ureg(units["y_data"]),
+            z_data * ureg(units["z_data"]),
+            x_tick_labels=x_tick_labels,
+            metadata=dict(metadata),
+        )
+        if spectrum.z_data.dtype != z_data.dtype:
+            # euphonic creates the maps in double precision (e.g. single precision maps).
+            spectrum.z_data = spectrum.z_data.astype(z_data.dtype)
+        return spectrum
+
+    if meta["series"]:
+        series_metadata = meta.get(
+            "series_metadata", [meta["metadata"]] * len(arrays["z_data"])
+        )
+        return [
+            spectrum(z_data, metadata)
+            for z_data, metadata in zip(arrays["z_data"], series_metadata)
+        ]
+    return spectrum(arrays["z_data"], meta["metadata"])
+
+
+def q_section_to_arrays(q_section):
+    """Arrays and metadata of the output of produce_Q_section_spectrum."""
+    av_spec, q_array, h_array, k_array, labels = q_section
+    arrays = {"av_spec": av_spec, "q": q_array, "h": h_array, "k": k_array}
+    return arrays, {"labels": labels}
+
+
+def q_section_from_arrays(arrays, meta):
+    """Inverse of q_section_to_arrays."""
+    return (
+        arrays["av_spec"],
+        arrays["q"],
+        arrays["h"],
+        arrays["k"],
+        meta["labels"],
+    )
+
+
+class SpectrumDiskCache:
+    """Content-addressed, size-bounded (LRU) disk cache of arrays."""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+
+    def key(self, kind, fc, parameters, **extra):
+        """The key of the spectrum `kind` computed from `fc` with the given parameters."""
+        spectrum_parameters = SPECTRUM_PARAMETERS.get(kind)
+        parameters = {
+            k: v
+            for k, v in dict(parameters).items()
+            if k not in EXECUTION_PARAMETERS
+            and (spectrum_parameters is None or k in spectrum_parameters)
+        }
+        content = json.dumps(
+            {
+                "version": CACHE_FORMAT_VERSION,
+                "euphonic": euphonic.__version__,
+                "kind": kind,
+                "force_constants": force_constants_hash(fc),
+                "parameters": _canonical(parameters),
+                "extra": _canonical(extra),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def load(self, key):
+        """The (memory-mapped) arrays and the metadata of the entry, None if not cached."""
+        entry = self.directory / key
+        try:
+            with open(entry / "meta.json", encoding="utf8") as handle:
+                meta = json.load(handle)
+            arrays = {
+                name: np.load(entry / f"{name}.npy", mmap_mode="c", allow_pickle=False)
+                for name in meta["arrays"]
+            }
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            os.utime(entry / "meta.json")  # last access, for the LRU eviction.
+        except OSError:
+            pass
+        return arrays, meta["meta"]
+
+    def store(self, key, arrays, meta, kind=""):
+        """Store the arrays (dict of numpy arrays) and the JSON-serialisable metadata.
+
+        Failures (e.g. read-only or full disk, or metadata which is not JSON-serialisable)
+        are ignored: the cache is only an optimisation.
+        """
+        entry = self.directory / key
+        tmp = self.directory / f"tmp-{uuid.uuid4().hex}"
+        try:
+            tmp.mkdir(parents=True)
+            for name, array in arrays.items():
+                np.save(tmp / f"{name}.npy", np.asarray(array), allow_pickle=False)
+            with open(tmp / "meta.json", "w", encoding="utf8") as handle:
+                json.dump(
+                    {
+                        "kind": kind,
+                        "created": time.time(),
+                        "arrays": list(arrays),
+                        "meta": meta,
+                    },
+                    handle,
+                )
+            os.rename(tmp, entry)
+        except (OSError, TypeError, ValueError):
+            # also if another session stored the same entry in the meantime.
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def get(self, key, compute, encode, decode, kind=""):
+        """Return decode(arrays, meta) of the entry, storing encode(compute()) if it is not cached."""
+        cached = self.load(key)
+        if cached is not None:
+            return decode(*cached)
+        value = compute()
+        self.store(key, *encode(value), kind=kind)
+        return value
+
+    def entries(self):
+        """List of the entries (dict with key, kind, size, created and last access times),
+        the least recently used first."""
+        entries = []
+        if not self.directory.is_dir():
+            return entries
+        for entry in self.directory.iterdir():
+            if entry.name.startswith("tmp-") or not entry.is_dir():
+                continue
+            try:
+                with open(entry / "meta.json", encoding="utf8") as handle:
+                    meta = json.load(handle)
+                entries.append(
+                    {
+                        "key": entry.name,
+                        "kind": meta.get("kind", ""),
+                        "nbytes": sum(f.stat().st_size for f in entry.iterdir()),
+                        "created": meta.get("created"),
+                        "accessed": (entry / "meta.json").stat().st_mtime,
+                    }
+                )
+            except (OSError, ValueError):
+                continue
+        return sorted(entries, key=lambda e: e["accessed"])
+
+    @property
+    def nbytes(self):
+        return sum(entry["nbytes"] for entry in self.entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        entries = self.entries()
+        total = sum(entry["nbytes"] for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.directory / entry["key"], ignore_errors=True)
+            total -= entry["nbytes"]
+
+    def purge(self, older_than=None):
+        """Remove the entries not accessed in the last `older_than` seconds (all if None).
+
+        Returns the number of removed entries. Leftover temporary directories are removed too.
+        """
+        removed = 0
+        now = time.time()
+        for entry in self.entries():
+            if older_than is None or now - entry["accessed"] > older_than:
+                shutil.rmtree(self.directory / entry["key"], ignore_errors=True)
+                removed += 1
+        if self.directory.is_dir():
+            for tmp in self.directory.glob("tmp-*"):
+                if older_than is None or now - tmp.stat().st_mtime > older_than:
+                    shutil.rmtree(tmp, ignore_errors=True)
+        return removed
+
+
+def get_spectrum_disk_cache():
+    """The SpectrumDiskCache configured by the environment (None if it is disabled)."""
+    directory = os.environ.get("AIIDALAB_QE_VIBROSCOPY_CACHE_DIR", DEFAULT_CACHE_DIR)
+    if not str(directory):
+        return None
+    size = os.environ.get("AIIDALAB_QE_VIBROSCOPY_CACHE_SIZE")
+    max_bytes = int(float(size) * 1024**2) if size else DEFAULT_CACHE_SIZE
+    return SpectrumDiskCache(directory=directory, max_bytes=max_bytes)
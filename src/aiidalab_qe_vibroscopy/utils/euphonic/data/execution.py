@@ -0,0 +1,287 @@
+"""Execution policy of the INS (euphonic) calculations.
+
+Euphonic diagonalises the dynamical matrices in its C extension, looping over q-points
+with OpenMP threads, and each thread calls LAPACK. If the BLAS/LAPACK library of NumPy is itself
+multi-threaded, or if several worker processes each use all the cores, the machine is
+oversubscribed. The policy defined here decides:
+
+- n_threads: the number of cores given to the INS calculations, i.e. the OpenMP threads of euphonic
+  (or, for the parallel powder engine, the total number of threads of all its workers);
+- blas_threads: the threads of the NumPy BLAS pools while the INS functions run (default 1,
+  as the parallelism is already in the euphonic loop over q-points). They are limited with
+  threadpoolctl (a dependency of the package): without it, they are not controlled, and the
+  info legend says so.
+
+The available cores are detected from the CPU affinity of the process and from the cgroup CPU
+quota (e.g. in the AiiDAlab containers, where os.cpu_count() returns the cores of the host).
+The number of threads can be set, in order of precedence:
+
+1. per calculation, via the n_threads parameter (see parameters.py);
+2. globally from the API, via set_execution_policy (this is what the app does);
+3. via the AIIDALAB_QE_VIBROSCOPY_NUM_THREADS environment variable.
+
+Otherwise, all the available cores are used.
+
+The policy also sets the memory budget of the structure factor calculations, which process the
+q-points in chunks sized to fit in it (see memory_chunk_size), and raise a MemoryBudgetError
+before computing anything if the arrays kept for all the q-points (the modes, the maps) do not
+fit. The budget (in MB) can be set in the same order of precedence: per calculation via the
+memory_budget parameter, via set_execution_policy, or via the
+AIIDALAB_QE_VIBROSCOPY_MEMORY_BUDGET environment variable. Otherwise, it is half of the
+memory available to the process (available system memory, bounded by the cgroup limit).
+"""
+
+import functools
+import inspect
+import math
+import os
+from contextlib import contextmanager
+
+try:
+    from threadpoolctl import threadpool_limits
+except ModuleNotFoundError:
+    threadpool_limits = None
+
+NUM_THREADS_ENV_VAR = "AIIDALAB_QE_VIBROSCOPY_NUM_THREADS"
+MEMORY_BUDGET_ENV_VAR = "AIIDALAB_QE_VIBROSCOPY_MEMORY_BUDGET"
+
+# fraction of the available memory used as budget, if not set.
+DEFAULT_MEMORY_FRACTION = 0.5
+
+# set via set_execution_policy.
+_POLICY = {
+    "n_threads": None,
+    "blas_threads": 1,
+    "memory_budget": None,
+}
+
+
+class MemoryBudgetError(MemoryError):
+    """The memory needed by a calculation is larger than the memory budget."""
+
+
+def cgroup_cpu_limit():
+    """The CPU limit given by the cgroup quota (v2 or v1), or None if there is no limit."""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max", encoding="utf8") as handle:
+            quota, period = handle.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+
+    for root in ["/sys/fs/cgroup/cpu", "/sys/fs/cgroup/cpu,cpuacct"]:
+        try:
+            with open(f"{root}/cpu.cfs_quota_us", encoding="utf8") as handle:
+                quota = int(handle.read())
+            with open(f"{root}/cpu.cfs_period_us", encoding="utf8") as handle:
+                period = int(handle.read())
+        except (OSError, ValueError):
+            continue
+        if quota > 0 and period > 0:
+            return quota / period
+    return None
+
+
+def available_cpus():
+    """Number of cores available to this process (affinity and cgroup quota)."""
+    if hasattr(os, "sched_getaffinity"):
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = os.cpu_count() or 1
+
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        n_cpus = min(n_cpus, math.ceil(limit))
+    return max(1, n_cpus)
+
+
+def cgroup_memory_limit():
+    """The memory (bytes) left by the cgroup limit (v2 or v1), or None if there is no limit."""
+    for limit_file, usage_file in [
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        (
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        ),
+    ]:
+        try:
+            with open(limit_file, encoding="utf8") as handle:
+                limit = handle.read().strip()
+            with open(usage_file, encoding="utf8") as handle:
+                usage = int(handle.read())
+        except (OSError, ValueError):
+            continue
+        # "max" (v2), or a huge number (v1): no limit.
+        if limit == "max" or int(limit) >= 2**60:
+            return None
+        return max(0, int(limit) - usage)
+    return None
+
+
+def available_memory():
+    """Memory (bytes) available to this process (system memory and cgroup limit), or None
+    if it cannot be detected."""
+    available = None
+    try:
+        with open("/proc/meminfo", encoding="utf8") as handle:
+            for line in handle:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if available is None:
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    limit = cgroup_memory_limit()
+    if limit is not None:
+        available = limit if available is None else min(available, limit)
+    return available
+
+
+def set_execution_policy(n_threads=None, blas_threads=1, memory_budget=None):
+    """Set the global execution policy of the INS calculations.
+
+    Args:
+        n_threads (int): number of threads of the INS calculations. None (or 0) means
+            from the environment variable, or all the available cores.
+        blas_threads (int): number of BLAS threads while the INS functions run.
+            None means no limit.
+        memory_budget (float): memory budget (MB) of the structure factor calculations.
+            None (or 0) means from the environment variable, or half of the available memory.
+    """
+    _POLICY["n_threads"] = n_threads or None
+    _POLICY["blas_threads"] = blas_threads or None
+    _POLICY["memory_budget"] = memory_budget or None
+
+
+def get_memory_budget(memory_budget=None):
+    """Resolve the memory budget (see the module docstring).
+
+    Args:
+        memory_budget (float): per-calculation request (MB), which takes precedence over
+            the global policy.
+
+    Returns:
+        int: the budget in bytes, or None (no budget) if the available memory is unknown.
+    """
+    if not memory_budget:
+        memory_budget = _POLICY["memory_budget"]
+    if not memory_budget:
+        try:
+            memory_budget = float(os.environ.get(MEMORY_BUDGET_ENV_VAR, ""))
+        except ValueError:
+            memory_budget = None
+    if memory_budget:
+        return int(memory_budget * 1024**2)
+
+    available = available_memory()
+    if available is None:
+        return None
+    return int(DEFAULT_MEMORY_FRACTION * available)
+
+
+def memory_chunk_size(held, per_point, n_points, memory_budget=None):
+    """The number of points (e.g. q-points) processed at once within the memory budget.
+
+    Args:
+        held (int): bytes of the arrays kept for all the points (e.g. the modes, the maps).
+        per_point (int): bytes of the temporary arrays per point of a chunk.
+        n_points (int): total number of points.
+        memory_budget (float): per-calculation budget (MB), see get_memory_budget.
+
+    Raises:
+        MemoryBudgetError: if not even one point at a time fits in the budget.
+    """
+    budget = get_memory_budget(memory_budget)
+    if budget is None:
+        return n_points
+    if held + per_point > budget:
+        raise MemoryBudgetError(
+            f"The calculation over {n_points} points needs at least "
+            f"{(held + per_point) / 1024**2:.3g} MB, more than the memory budget of "
+            f"{budget / 1024**2:.3g} MB. Use fewer points (e.g. a larger q spacing, or a "
+            "smaller grid), or raise the budget (memory_budget parameter, "
+            f"set_execution_policy or the {MEMORY_BUDGET_ENV_VAR} environment variable)."
+        )
+    return int(min(n_points, (budget - held) // per_point))
+
+
+def get_execution_policy(n_threads=None):
+    """Resolve the execution policy.
+
+    Args:
+        n_threads (int): per-calculation request, which takes precedence over the global policy.
+
+    Returns:
+        dict: with n_threads, blas_threads, available_cpus, source (where n_threads comes from)
+        and memory_budget (bytes, see get_memory_budget).
+    """
+    cpus = available_cpus()
+    if n_threads:
+        source = "parameters"
+    elif _POLICY["n_threads"]:
+        n_threads = _POLICY["n_threads"]
+        source = "app/API"
+    elif os.environ.get(NUM_THREADS_ENV_VAR, "").isdigit() and int(
+        os.environ[NUM_THREADS_ENV_VAR]
+    ):
+        n_threads = int(os.environ[NUM_THREADS_ENV_VAR])
+        source = NUM_THREADS_ENV_VAR
+    else:
+        n_threads = cpus
+        source = "cgroup quota" if cgroup_cpu_limit() is not None else "CPU affinity"
+
+    return {
+        "n_threads": int(n_threads),
+        "blas_threads": _POLICY["blas_threads"],
+        "available_cpus": cpus,
+        "source": source,
+        "blas_control": threadpool_limits is not None,
+        "memory_budget": get_memory_budget(),
+    }
+
+
+@contextmanager
+def limit_blas_threads(blas_threads):
+    """Limit the threads of the BLAS pools (no-op if threadpoolctl is not installed)."""
+    if not blas_threads or threadpool_limits is None:
+        yield
+        return
+    with threadpool_limits(limits=blas_threads, user_api="blas"):
+        yield
+
+
+def uses_execution_policy(func):
+    """Decorator for the INS functions: they run with the BLAS threads of the policy.
+
+    For generator functions, the limit holds while the generator runs, not while
+    the caller handles the yielded items.
+    """
+
+    if inspect.isgeneratorfunction(func):
+
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            generator = func(*args, **kwargs)
+            while True:
+                with limit_blas_threads(_POLICY["blas_threads"]):
+                    try:
+                        item = next(generator)
+                    except StopIteration as stop:
+                        return stop.value
+                yield item
+
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with limit_blas_threads(_POLICY["blas_threads"]):
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -1,3 +1,6 @@
+from aiidalab_qe_vibroscopy.utils.euphonic.data.native_format import (
+    force_constants_from_array_data,
+)
 from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
     generate_force_constant_from_phonopy,
 )
@@ -32,11 +35,15 @@ def export_euphonic_data(output_vibronic, fermi_energy=None):
     else:
         q_path = None
 
-    phonopy_calc = output_set.creator
-    fc = generate_force_constant_from_phonopy(
-        phonopy_calc,
-        use_euphonic_full_parser=False,  # This is to avoid the bug in euphonic. WE IGNORE THE NAC CORRECTIONS
-    )
+    if "euphonic_force_constants" in output_vibronic:
+        # already converted in the workchain: only a binary read.
+        fc = force_constants_from_array_data(output_vibronic.euphonic_force_constants)
+    else:
+        phonopy_calc = output_set.creator
+        fc = generate_force_constant_from_phonopy(
+            phonopy_calc,
+            use_euphonic_full_parser=False,  # This is to avoid the bug in euphonic. WE IGNORE THE NAC CORRECTIONS
+        )
     # bands = compute_bands(fc)
     # pdos = compute_pdos(fc)
     return {
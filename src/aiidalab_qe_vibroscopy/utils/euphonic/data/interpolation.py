@@ -0,0 +1,248 @@
+"""Interpolated preview of the S(Q,w) maps along a q-point path.
+
+The path is made of straight segments of equally spaced q-points. The modes are computed only
+at every `coarsening`-th point of each segment (and at its ends); the frequencies and the
+per-mode intensities (kernels.mode_intensities) of the other points are linearly interpolated
+between the two closest computed points. The bands are matched between consecutive computed
+points by the overlap of their eigenvectors, so that the interpolation follows the bands
+through the crossings instead of joining the frequency-sorted modes.
+
+The modes are also computed exactly at a few other points of the path (the check points), and
+the interpolation error is estimated there: the largest frequency error, and the largest
+relative difference of the interpolated and exact S(Q,w) rows.
+
+The same interpolation drives the adaptive sampling of the path (adaptive_path_modes): starting
+from a coarse sampling, each interval between two computed points is split at its middle point
+as long as the modes there differ from the interpolated ones by more than a tolerance, so the
+points are dense where the frequencies or the structure factors change fast (e.g. the acoustic
+branches near Gamma), and sparse along flat branches.
+"""
+
+import numpy as np
+from euphonic import QpointPhononModes
+from scipy.optimize import linear_sum_assignment
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.kernels import (
+    bin_mode_intensities,
+    mode_intensities,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.qpoint_symmetry import (
+    calculate_qpoint_phonon_modes_zone_reduced,
+)
+
+# the modes are computed every PREVIEW_COARSENING points of the path.
+PREVIEW_COARSENING = 5
+
+# number of points of the path where the interpolation is checked against the exact modes.
+PREVIEW_CHECK_POINTS = 5
+
+# initial sampling of the adaptive path: every ADAPTIVE_PATH_COARSENING points of the path.
+ADAPTIVE_PATH_COARSENING = 16
+
+
+def path_segments(qpts):
+    """The (start, stop) indices (both included) of the straight segments of the path,
+    i.e. of the runs of q-points with the same step."""
+    steps = np.diff(qpts, axis=0)
+    norms = np.linalg.norm(steps, axis=1)
+    changes = np.linalg.norm(steps[1:] - steps[:-1], axis=1) > 1e-6 * np.maximum(
+        np.maximum(norms[1:], norms[:-1]), 1e-12
+    )
+    boundaries = np.concatenate([[0], np.nonzero(changes)[0] + 1, [len(qpts) - 1]])
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def coarse_path_indices(segments, coarsening=PREVIEW_COARSENING):
+    """The indices of the points of the path where the modes are computed."""
+    indices = [
+        np.append(np.arange(start, stop, coarsening), stop) for start, stop in segments
+    ]
+    return np.unique(np.concatenate(indices))
+
+
+def check_path_indices(coarse, n_qpts, qpts, n_check=PREVIEW_CHECK_POINTS):
+    """Up to n_check points of the path, spread along it, where the interpolation is checked.
+
+    These are interpolated points (not in `coarse`), and not Gamma-equivalent ones, where the
+    acoustic intensities are not defined.
+    """
+    candidates = np.setdiff1d(np.arange(n_qpts), coarse)
+    candidates = candidates[
+        np.any(np.abs(qpts[candidates] - np.round(qpts[candidates])) > 1e-8, axis=1)
+    ]
+    if not len(candidates) or not n_check:
+        return np.array([], dtype=int)
+    # the middle points of n_check equal parts of the candidates.
+    spread = ((np.arange(n_check) + 0.5) * len(candidates) / n_check).astype(int)
+    return np.unique(candidates[spread])
+
+
+def match_bands(eigenvectors):
+    """Band order at each point, following the bands through the crossings.
+
+    Args:
+        eigenvectors: (n_points, n_modes, n_atoms, 3) eigenvectors of consecutive points.
+
+    Returns:
+        (n_points, n_modes) array: the mode of each band at each point. The bands are the
+        modes of the first point, each matched with the mode of the next point with which
+        it has the largest overlap |<e|e'>|**2 (one to one, maximising the total overlap).
+    """
+    order = np.empty(eigenvectors.shape[:2], dtype=int)
+    order[0] = np.arange(eigenvectors.shape[1])
+    for i in range(1, len(eigenvectors)):
+        previous = eigenvectors[i - 1][order[i - 1]]
+        overlaps = (
+            np.abs(np.einsum("iac,jac->ij", previous.conj(), eigenvectors[i])) ** 2
+        )
+        _, order[i] = linear_sum_assignment(-overlaps)
+    return order
+
+
+def interpolate_mode_intensities(intensities, eigenvectors, coarse, n_qpts):
+    """Interpolate the output of kernels.mode_intensities along the path.
+
+    Args:
+        intensities: mode_intensities of the coarse points.
+        eigenvectors: the eigenvectors of the coarse points (to match the bands).
+        coarse: the indices of the coarse points in the path.
+        n_qpts: the number of points of the path.
+
+    Returns:
+        mode_intensities-like dict for all the points of the path.
+    """
+    order = match_bands(eigenvectors)
+    rows = np.arange(len(coarse))[:, np.newaxis]
+    k = np.clip(np.searchsorted(coarse, np.arange(n_qpts), side="right") - 1, 0, None)
+    k = np.minimum(k, len(coarse) - 2) if len(coarse) > 1 else k
+    upper = np.minimum(k + 1, len(coarse) - 1)
+    span = np.maximum(coarse[upper] - coarse[k], 1)
+    weight = ((np.arange(n_qpts) - coarse[k]) / span)[:, np.newaxis]
+
+    interpolated = {"units": intensities["units"]}
+    for name in ["frequencies", "positive", "negative"]:
+        bands = intensities[name][rows, order]
+        interpolated[name] = (1 - weight) * bands[k] + weight * bands[upper]
+    return interpolated
+
+
+def interpolation_errors(exact, interpolated, e_bins, broadening=None):
+    """Error estimate of the interpolation at the check points.
+
+    Args:
+        exact, interpolated: mode_intensities-like dicts of the check points.
+        e_bins: the energy bin edges (magnitude, in the units of the frequencies).
+        broadening: optional FWHM of a Gaussian energy broadening applied to the rows
+            before comparing them (as for the plotted map).
+
+    Returns:
+        the largest frequency error (in the units of the frequencies), and the largest
+        relative difference sum|S_interpolated - S_exact| / sum|S_exact| of the binned rows.
+    """
+    if not len(exact["frequencies"]):  # no check points: nothing is interpolated.
+        return 0.0, 0.0
+    frequency_error = np.max(
+        np.abs(
+            np.sort(interpolated["frequencies"], axis=1)
+            - np.sort(exact["frequencies"], axis=1)
+        ),
+        initial=0.0,
+    )
+    rows = [
+        bin_mode_intensities(intensities, e_bins)
+        for intensities in (exact, interpolated)
+    ]
+    if broadening:
+        sigma = broadening / (2 * np.sqrt(2 * np.log(2))) / np.mean(np.diff(e_bins))
+        offsets = np.arange(-int(4 * sigma) - 1, int(4 * sigma) + 2)
+        kernel = np.exp(-(offsets**2) / (2 * sigma**2))
+        kernel /= kernel.sum()
+        rows = [
+            np.apply_along_axis(np.convolve, 1, row, kernel, mode="same")
+            for row in rows
+        ]
+    totals = np.sum(np.abs(rows[0]), axis=1)
+    differences = np.sum(np.abs(rows[1] - rows[0]), axis=1)
+    intensity_error = np.max(differences[totals > 0] / totals[totals > 0], initial=0.0)
+    return float(frequency_error), float(intensity_error)
+
+
+def adaptive_path_modes(
+    fc, qpts, tolerance, coarsening=ADAPTIVE_PATH_COARSENING, **kwargs
+):
+    """Phonon modes at an adaptive subset of the points of the path (see the module docstring).
+
+    An interval is split if, at its middle point, the largest frequency error of the
+    interpolation is above `tolerance` times the largest frequency of the path, or the
+    relative difference of the structure factors (sorted by frequency, at T=0) is above
+    `tolerance`. The path itself is the finest sampling: intervals of consecutive points
+    are never split. kwargs are passed to fc.calculate_qpoint_phonon_modes.
+
+    Returns:
+        the QpointPhononModes of the computed points, and their indices in the path.
+    """
+    qpts = np.asarray(qpts, dtype=float)
+    frequencies, eigenvectors, intensities = {}, {}, {}
+
+    def compute(indices):
+        modes = calculate_qpoint_phonon_modes_zone_reduced(fc, qpts[indices], **kwargs)
+        structure_factors = mode_intensities(modes)["positive"]
+        for i, index in enumerate(indices):
+            frequencies[index] = modes.frequencies.magnitude[i]
+            eigenvectors[index] = modes.eigenvectors[i]
+            intensities[index] = structure_factors[i]
+        return modes.frequencies.units
+
+    coarse = coarse_path_indices(path_segments(qpts), coarsening)
+    units = compute(coarse)
+    scale = max(np.max(np.abs(list(frequencies.values()))), 1e-12)
+
+    pending = [(i, j) for i, j in zip(coarse[:-1], coarse[1:]) if j - i > 1]
+    while pending:
+        middles = [(i + j) // 2 for i, j in pending]
+        compute(np.array(middles))
+        refine = []
+        for (i, j), m in zip(pending, middles):
+            frequency_error, intensity_error = _midpoint_error(
+                i, j, m, frequencies, eigenvectors, intensities
+            )
+            if frequency_error > tolerance * scale or intensity_error > tolerance:
+                refine += [(i, m), (m, j)]
+        pending = [(i, j) for i, j in refine if j - i > 1]
+
+    indices = np.array(sorted(frequencies))
+    modes = QpointPhononModes(
+        fc.crystal,
+        qpts[indices],
+        np.array([frequencies[i] for i in indices]) * units,
+        np.array([eigenvectors[i] for i in indices]),
+    )
+    return modes, indices
+
+
+def _midpoint_error(i, j, m, frequencies, eigenvectors, intensities):
+    """(frequency error, relative structure factor error) of the interpolation between the
+    points i and j, at the point m (see adaptive_path_modes)."""
+    order = match_bands(np.array([eigenvectors[i], eigenvectors[j]]))
+    weight = (m - i) / (j - i)
+    predicted = {
+        name: (1 - weight) * values[i][order[0]] + weight * values[j][order[1]]
+        for name, values in [("frequencies", frequencies), ("intensities", intensities)]
+    }
+    exact_order = np.argsort(frequencies[m])
+    predicted_order = np.argsort(predicted["frequencies"])
+    frequency_error = np.max(
+        np.abs(predicted["frequencies"][predicted_order] - frequencies[m][exact_order])
+    )
+    total = np.sum(np.abs(intensities[m]))
+    intensity_error = (
+        np.sum(
+            np.abs(
+                predicted["intensities"][predicted_order] - intensities[m][exact_order]
+            )
+        )
+        / total
+        if total
+        else 0.0
+    )
+    return frequency_error, intensity_error
@@ -0,0 +1,542 @@
+"""Vectorised kernels for the structure factor.
+
+These are re-implementations of parts of euphonic (QpointPhononModes.calculate_structure_factor
+and StructureFactor.calculate_sqw_map), written to reuse the parts which do not change between
+calculations. The results are the same of euphonic, within floating point precision.
+
+- calculate_sqw_map_series: S(Q,w) maps for an array of temperatures. The eigenvectors, the
+  Q.e and exp(iQ.r) terms and the energy binning indexes do not depend on the temperature,
+  so they are computed once; the Debye-Waller exponents and the Bose occupations are then
+  applied to all the temperatures in one NumPy pass.
+- mode_intensities + energy_window_intensities (or energy_cuts, with energy bins): the Q-plane
+  cuts at fixed energy. The per-mode intensities (structure factor with the Bose factor) of the
+  plane do not depend on the energy cut, so they are computed once, and each cut (or a stack of
+  cuts) is a weighted sum over the modes.
+- mode_intensities + bin_mode_intensities: the S(Q,w) (or DOS) map of a block of q-points, as
+  calculate_sqw_map (calculate_dos_map), e.g. for the chunks of a volume (see volume.py).
+- partial_mode_intensities: the per-mode intensities split in the contributions of groups of
+  atoms (e.g. of each species), from one pass over the eigenvectors. The terms b/sqrt(M) (Q.e*)
+  exp(iQ.r) of the structure factor are summed over the atoms of each group, and the partials
+  are the squared moduli of these sums, plus the cross terms between two groups: all of them add
+  up to the total, and those of a subset of the groups are the map of these atoms alone.
+
+The structure factor of a q-point needs temporary arrays of the size of its eigenvectors,
+(3 * n_atoms)**2 complex numbers: calculate_structure_factor, mode_intensities and
+calculate_sqw_map_series can process the q-points in chunks of chunk_size, so that these arrays
+are allocated only for one chunk at a time (see structure_factor_memory).
+
+Single precision (opt-in, see with_precision): the eigenvectors are stored as complex64, and
+the kernels then compute and store the structure factors, the per-mode intensities and the
+maps in float32 (complex64), at half the memory. The frequencies, the Bose factors and the
+energy binning stay in double precision (the maps are accumulated in float64 and stored in
+float32), so no mode moves to another energy bin. Rounding the eigenvectors and the terms
+b/sqrt(M) (Q.e*) exp(iQ.r) to single precision (unit roundoff u = 2**-24, about 6e-8) gives
+an error of each intensity bounded by about (3 * n_atoms + 4) * u times the squared sum of
+the moduli of its terms, i.e. relative to the largest intensity of the map: below 1e-5 for
+cells of a few tens of atoms, far below what a plot resolves (the error is measured in
+benchmarks/precision.py). Intensities much smaller than the largest one (e.g. cancelling
+terms) have a larger relative error, so this is for visualisation, not for fitting.
+"""
+
+import itertools
+import math
+import warnings
+
+import numpy as np
+from euphonic import QpointPhononModes, StructureFactor, ureg
+from euphonic.util import get_reference_data
+
+# floating point precisions of the arrays: (real, complex) dtypes.
+PRECISIONS = {
+    "double": (np.float64, np.complex128),
+    "single": (np.float32, np.complex64),
+}
+
+
+def precision_dtypes(precision="double"):
+    """The (real, complex) dtypes of the precision, "double" or "single"."""
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Precision '{precision}' not recognized, choose among {list(PRECISIONS)}."
+        )
+    return PRECISIONS[precision]
+
+
+def with_precision(modes, precision="double"):
+    """The modes with the eigenvectors in the given precision: the kernels compute in the
+    precision of the eigenvectors (the frequencies are kept in double precision)."""
+    _, complex_dtype = precision_dtypes(precision)
+    if not hasattr(modes, "eigenvectors") or modes.eigenvectors.dtype == complex_dtype:
+        return modes
+    return QpointPhononModes(
+        modes.crystal,
+        modes.qpts,
+        modes.frequencies,
+        modes.eigenvectors.astype(complex_dtype),
+        weights=modes.weights,
+    )
+
+
+def real_dtype(modes):
+    """The real dtype of the precision of the modes (float64 without eigenvectors)."""
+    if not hasattr(modes, "eigenvectors"):
+        return np.dtype(np.float64)
+    return np.finfo(modes.eigenvectors.dtype).dtype
+
+
+def structure_factor_memory(
+    n_qpts, n_atoms, n_ebins, n_maps=1, eigenvectors=True, precision="double"
+):
+    """Memory estimate (bytes) of the S(Q,w) maps of n_qpts q-points.
+
+    Args:
+        n_qpts, n_atoms, n_ebins: number of q-points, of atoms and of energy bins.
+        n_maps: number of maps (temperature series, partial maps).
+        eigenvectors: whether the modes hold the eigenvectors (not for frequencies only).
+        precision: "double" or "single" (the eigenvectors, the temporary arrays and the
+            stored maps take half the memory, see the module docstring).
+
+    Returns:
+        held: bytes of the arrays kept for all the q-points: the modes and the maps (with
+            the buffers of the binning).
+        per_qpt: bytes of the temporary arrays of the structure factor of each q-point of a
+            chunk: the conjugated eigenvectors, Q.e* and the terms of each atom and mode.
+    """
+    real = np.dtype(precision_dtypes(precision)[0]).itemsize
+    n_modes = 3 * n_atoms
+    held = n_qpts * 8 * n_modes
+    if eigenvectors:
+        held += n_qpts * 2 * real * n_modes**2
+    # the maps are accumulated in double precision, and stored in the given one.
+    held += (8 + real) * n_qpts * n_maps * (n_ebins + 2)
+    per_qpt = (
+        2 * real * (n_modes**2 + 2 * n_modes * n_atoms) + 8 * real * n_modes * n_maps
+    )
+    return held, per_qpt
+
+
+def qpoint_chunks(n_qpts, chunk_size=None):
+    """The slices of consecutive chunks of at most chunk_size q-points (all if None)."""
+    chunk_size = chunk_size or max(n_qpts, 1)
+    return [slice(i, i + chunk_size) for i in range(0, n_qpts, chunk_size)]
+
+
+def modes_chunk(modes, chunk):
+    """The QpointPhononModes of the q-points of `chunk` (a slice) of `modes`."""
+    return QpointPhononModes(
+        modes.crystal,
+        modes.qpts[chunk],
+        modes.frequencies[chunk],
+        modes.eigenvectors[chunk],
+        weights=modes.weights[chunk],
+    )
+
+
+def calculate_structure_factor(modes, dw=None, chunk_size=None):
+    """modes.calculate_structure_factor(dw=dw), computed chunk_size q-points at a time."""
+    if not chunk_size or chunk_size >= modes.n_qpts:
+        return modes.calculate_structure_factor(dw=dw)
+    chunks = [
+        modes_chunk(modes, chunk).calculate_structure_factor(dw=dw)
+        for chunk in qpoint_chunks(modes.n_qpts, chunk_size)
+    ]
+    units = chunks[0].structure_factors.units
+    return StructureFactor(
+        modes.crystal,
+        modes.qpts,
+        modes.frequencies,
+        np.concatenate([c.structure_factors.to(units).magnitude for c in chunks])
+        * units,
+        temperature=chunks[0].temperature,
+    )
+
+
+def structure_factor_terms(modes, scattering_lengths="Sears1992"):
+    """Temperature-independent terms of the one-phonon structure factor.
+
+    Returns:
+        term: (n_qpts, 3*n_atoms, n_atoms) complex array, b/sqrt(M) (Q.e*) exp(iQ.r) of each
+            atom and mode, in atomic units (as in euphonic), in the precision of the
+            eigenvectors.
+        Q: (n_qpts, 3) array, the cartesian Q vectors in 1/bohr.
+    """
+    if isinstance(scattering_lengths, str):
+        scattering_lengths = get_reference_data(
+            collection=scattering_lengths,
+            physical_property="coherent_scattering_length",
+        )
+    sl = [scattering_lengths[x].to("bohr").magnitude for x in modes.crystal.atom_type]
+    norm_factor = sl / np.sqrt(modes.crystal._atom_mass)
+
+    exp_factor = np.exp(
+        1j * 2 * math.pi * np.einsum("ij,kj->ik", modes.qpts, modes.crystal.atom_r)
+    )
+    recip = modes.crystal.reciprocal_cell().to("1/bohr").magnitude
+    Q = np.einsum("ij,jk->ik", modes.qpts, recip)
+    # (the phases and the Q vectors are computed in double precision, then rounded.)
+    eigenvectors = modes.eigenvectors
+    real = real_dtype(modes)
+    eigenv_dot_q = np.einsum(
+        "ijkl,il->ijk", np.conj(eigenvectors), Q.astype(real, copy=False)
+    )
+
+    term = (
+        eigenv_dot_q
+        * (exp_factor * norm_factor).astype(eigenvectors.dtype)[:, np.newaxis, :]
+    )
+    return term, Q
+
+
+def calculate_sqw_map_series(
+    modes,
+    e_bins,
+    temperatures,
+    dws=None,
+    scattering_lengths="Sears1992",
+    chunk_size=None,
+):
+    """S(Q,w) maps of `modes` for several temperatures.
+
+    For each temperature T this is equivalent to
+    modes.calculate_structure_factor(dw=dw_T).calculate_sqw_map(e_bins), but the
+    temperature-independent parts are computed only once.
+
+    Args:
+        modes: QpointPhononModes.
+        e_bins: (n_e_bins + 1,) energy bin edges (Quantity).
+        temperatures: (n_T,) temperatures (Quantity), used for the Bose factor.
+        dws: list of the n_T DebyeWaller objects (or None, no Debye-Waller factor).
+        chunk_size: if given, the maps are computed chunk_size q-points at a time.
+
+    Returns:
+        (n_T, n_qpts, n_e_bins) Quantity, in mbarn/(units of e_bins).
+    """
+    if chunk_size and chunk_size < modes.n_qpts:
+        maps = [
+            calculate_sqw_map_series(
+                modes_chunk(modes, chunk),
+                e_bins,
+                temperatures,
+                dws=dws,
+                scattering_lengths=scattering_lengths,
+            )
+            for chunk in qpoint_chunks(modes.n_qpts, chunk_size)
+        ]
+        units = maps[0].units
+        return np.concatenate([m.to(units).magnitude for m in maps], axis=1) * units
+
+    temps = np.atleast_1d(temperatures.to("K").magnitude)
+    n_qpts = modes.n_qpts
+    n_atoms = modes.crystal.n_atoms
+    freqs = modes._frequencies
+
+    real = real_dtype(modes)
+    term, Q = structure_factor_terms(modes, scattering_lengths=scattering_lengths)
+    if dws is not None:
+        # (n_T, n_atoms, 3, 3) -> (n_T, n_qpts, n_atoms)
+        W = np.stack([dw._debye_waller for dw in dws])
+        dw_factor = np.exp(-np.einsum("tjkl,ik,il->tij", W, Q, Q)).astype(real)
+        term = np.einsum("ijk,tik->tij", term, dw_factor)
+    else:
+        term = np.sum(term, axis=-1)[np.newaxis]
+
+    # (n_T, n_qpts, 3*n_atoms), or (1, ...) without Debye-Waller factor.
+    sf = np.real(np.absolute(term * np.conj(term)) / np.absolute(freqs))
+    sf /= 2 * n_atoms
+    sf = np.broadcast_to(sf, (len(temps),) + freqs.shape)
+
+    kB = (1 * ureg.k).to("E_h/K").magnitude
+    bose = np.zeros((len(temps),) + freqs.shape)
+    positive = temps > 0
+    with np.errstate(divide="ignore", over="ignore"):
+        bose[positive] = 1 / (
+            np.exp(
+                np.absolute(freqs)[np.newaxis]
+                / (kB * temps[positive, np.newaxis, np.newaxis])
+            )
+            - 1
+        )
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=RuntimeWarning)
+        e_bins_internal = e_bins.to("hartree").magnitude
+
+    # binning, as in StructureFactor._bose_corrected_structure_factor, with an extra
+    # bin either side for the modes outside the energy range. The bin indexes do not depend
+    # on the temperature, so all the maps are filled by one bincount.
+    n_bins = len(e_bins) + 1
+    p_bin = np.digitize(freqs, e_bins_internal)
+    n_bin = np.digitize(-freqs, e_bins_internal)
+    q_offset = np.arange(n_qpts)[:, np.newaxis] * n_bins
+    t_offset = np.arange(len(temps))[:, np.newaxis, np.newaxis] * n_qpts * n_bins
+    size = len(temps) * n_qpts * n_bins
+    sqw_map = np.bincount(
+        (t_offset + q_offset + p_bin).ravel(),
+        weights=((1 + bose) * sf).ravel(),
+        minlength=size,
+    ) + np.bincount(
+        (t_offset + q_offset + n_bin).ravel(),
+        weights=(bose * sf).ravel(),
+        minlength=size,
+    )
+    sqw_map = sqw_map.reshape(len(temps), n_qpts, n_bins)[:, :, 1:-1]
+    sqw_map /= np.diff(e_bins_internal)
+
+    e_conv = 1 * ureg("hartree").to(e_bins.units)
+    sf_conv = 1 * ureg("bohr**2").to("mbarn")
+    return (sqw_map * (sf_conv / e_conv).magnitude).astype(real, copy=False) * (
+        sf_conv.units / e_conv.units
+    )
+
+
+def mode_intensities(modes, dw=None, weighting="coherent", chunk_size=None):
+    """Per-mode intensities, the ones binned in the S(Q,w) (or DOS) maps of euphonic.
+
+    For the coherent weighting, this is modes.calculate_structure_factor(dw=dw), with the Bose
+    factor of the temperature of dw (none without dw) applied as in calculate_sqw_map: the
+    phonon creation at +w has (1 + n), the annihilation at -w has n. For the dos weighting,
+    each mode has 3/n_modes (the DOS per atom of calculate_dos_map), only at +w.
+    With chunk_size, the structure factor is computed chunk_size q-points at a time.
+    With single precision eigenvectors (see with_precision), the intensities are computed
+    and returned in float32.
+
+    Returns:
+        dict with the frequencies (n_qpts, 3*n_atoms, magnitude in the units of
+        modes.frequencies), the intensities at +w ("positive") and at -w ("negative"), and
+        "units", the units of the intensity times energy units (i.e. of the map times
+        the bin width).
+    """
+    frequencies = modes.frequencies
+    if weighting == "dos":
+        positive = np.full(frequencies.shape, 3 / frequencies.shape[1])
+        return {
+            "frequencies": frequencies.magnitude,
+            "positive": positive,
+            "negative": np.zeros_like(positive),
+            "units": "dimensionless",
+        }
+
+    if real_dtype(modes) != np.float64:
+        # euphonic computes in double precision: the kernel of the partial maps, with one
+        # group of all the atoms, computes in the precision of the eigenvectors.
+        intensities = partial_mode_intensities(
+            modes,
+            [("", list(range(modes.crystal.n_atoms)))],
+            dw=dw,
+            cross_terms=False,
+            chunk_size=chunk_size,
+        )
+        return {
+            "frequencies": frequencies.magnitude,
+            "positive": intensities["positive"][0],
+            "negative": intensities["negative"][0],
+            "units": intensities["units"],
+        }
+
+    structure_factor = calculate_structure_factor(modes, dw=dw, chunk_size=chunk_size)
+    sf = structure_factor.structure_factors
+    positive, negative = sf.magnitude, sf.magnitude
+    if structure_factor.temperature is not None:
+        bose = structure_factor._bose_factor()
+        positive, negative = (1 + bose) * positive, bose * negative
+    return {
+        "frequencies": frequencies.magnitude,
+        "positive": positive,
+        "negative": negative,
+        "units": str(sf.units),
+    }
+
+
+def bin_mode_intensities(intensities, e_bins):
+    """Bin the output of mode_intensities (or of partial_mode_intensities) in the energy bins
+    `e_bins` (bin edges, magnitude in the units of the frequencies), as calculate_sqw_map
+    (or calculate_dos_map).
+
+    Returns:
+        (n_qpts, len(e_bins) - 1) array, in intensities["units"] / (units of the frequencies),
+        or (n_partials, n_qpts, len(e_bins) - 1) for the partial intensities.
+    """
+    frequencies = intensities["frequencies"]
+    positive = np.asarray(intensities["positive"])
+    maps_shape = positive.shape[:-2]
+    n_maps = int(np.prod(maps_shape))
+    n_qpts = frequencies.shape[0]
+    # an extra bin either side for the modes outside the energy range. The bin indexes
+    # are the same for all the maps, so they are all filled by one bincount.
+    n_bins = len(e_bins) + 1
+    q_offset = np.arange(n_qpts)[:, np.newaxis] * n_bins
+    m_offset = np.arange(n_maps)[:, np.newaxis, np.newaxis] * n_qpts * n_bins
+    size = n_maps * n_qpts * n_bins
+    sqw_map = np.bincount(
+        (m_offset + q_offset + np.digitize(frequencies, e_bins)).ravel(),
+        weights=positive.ravel(),
+        minlength=size,
+    ) + np.bincount(
+        (m_offset + q_offset + np.digitize(-frequencies, e_bins)).ravel(),
+        weights=np.asarray(intensities["negative"]).ravel(),
+        minlength=size,
+    )
+    sqw_map = sqw_map.reshape(maps_shape + (n_qpts, n_bins))
+    # (stored in the precision of the intensities.)
+    return (sqw_map[..., 1:-1] / np.diff(e_bins)).astype(
+        np.result_type(positive.dtype, np.float32), copy=False
+    )
+
+
+def partial_groups(crystal, partials="species"):
+    """The groups of atoms of the partial maps, as a list of (label, atom indices).
+
+    partials is "species" (a group per species, in order of appearance) or "atoms" (a group
+    per atom, labelled by its species and index, e.g. "H3").
+    """
+    atom_type = [str(t) for t in crystal.atom_type]
+    if partials == "species":
+        return [
+            (species, [i for i, t in enumerate(atom_type) if t == species])
+            for species in dict.fromkeys(atom_type)
+        ]
+    if partials == "atoms":
+        return [(f"{t}{i}", [i]) for i, t in enumerate(atom_type)]
+    raise ValueError(
+        f"Partial maps '{partials}' not recognized, choose 'species' or 'atoms'."
+    )
+
+
+def partial_labels(groups, cross_terms=True):
+    """The groups of each partial map of partial_mode_intensities: [g] for the partial of the
+    group g, [g, h] for the cross term of the groups g and h."""
+    labels = [[label] for label, _ in groups]
+    if cross_terms:
+        labels += [[g[0], h[0]] for g, h in itertools.combinations(groups, 2)]
+    return labels
+
+
+def partial_mode_intensities(
+    modes,
+    groups,
+    dw=None,
+    cross_terms=True,
+    scattering_lengths="Sears1992",
+    chunk_size=None,
+):
+    """Per-mode intensities (as mode_intensities, coherent weighting) of the partial
+    contributions of groups of atoms (see the module docstring).
+
+    Args:
+        modes: QpointPhononModes.
+        groups: list of (label, atom indices), e.g. from partial_groups.
+        dw: DebyeWaller factor (its temperature is used for the Bose factor).
+        cross_terms: whether to compute the cross terms between the groups. Without them,
+            the partials do not add up to the total (the interference between the groups
+            is missing).
+        chunk_size: if given, the q-points are processed chunk_size at a time.
+
+    Returns:
+        dict as mode_intensities, with "positive" and "negative" of shape
+        (n_partials, n_qpts, 3*n_atoms), and "partials", the groups of each partial
+        (see partial_labels).
+    """
+    pairs = [(g, g) for g in range(len(groups))]
+    if cross_terms:
+        pairs += list(itertools.combinations(range(len(groups)), 2))
+    freqs = modes._frequencies
+    real = real_dtype(modes)
+
+    sf = np.empty((len(pairs),) + freqs.shape, dtype=real)
+    for chunk in qpoint_chunks(modes.n_qpts, chunk_size):
+        term, Q = structure_factor_terms(
+            modes_chunk(modes, chunk), scattering_lengths=scattering_lengths
+        )
+        if dw is not None:
+            dw_factor = np.exp(-np.einsum("jkl,ik,il->ij", dw._debye_waller, Q, Q))
+            term = term * dw_factor.astype(real)[:, np.newaxis, :]
+        group_terms = np.stack([term[..., atoms].sum(axis=-1) for _, atoms in groups])
+        for p, (g, h) in enumerate(pairs):
+            product = np.real(group_terms[g] * np.conj(group_terms[h]))
+            sf[p, chunk] = product if g == h else 2 * product
+    sf /= np.absolute(freqs) * 2 * modes.crystal.n_atoms
+    sf *= (1 * ureg("bohr**2")).to("mbarn").magnitude
+
+    positive, negative = sf, sf
+    if dw is not None:
+        temperature = dw.temperature.to("K").magnitude
+        bose = np.zeros(freqs.shape)
+        if temperature > 0:
+            kB = (1 * ureg.k).to("E_h/K").magnitude
+            bose = 1 / (np.exp(np.absolute(freqs) / (kB * temperature)) - 1)
+        positive = ((1 + bose) * sf).astype(real, copy=False)
+        negative = (bose * sf).astype(real, copy=False)
+    return {
+        "frequencies": modes.frequencies.magnitude,
+        "positive": positive,
+        "negative": negative,
+        "units": "millibarn",
+        "partials": partial_labels(groups, cross_terms),
+    }
+
+
+def energy_cut_weights(e_bins, ecenter, deltaE):
+    """Gaussian weights of the energy bins (lower edges) averaged in a Q-plane cut: the
+    standard deviation is deltaE / 2, i.e. the window ecenter +- deltaE is +- 2 sigma."""
+    mu = ecenter
+    sigma = (deltaE) / 2
+
+    return np.exp(-((e_bins[:-1] - mu) ** 2) / (2 * sigma**2)) / np.sqrt(
+        2 * np.pi * sigma**2
+    )
+
+
+def energy_cuts(intensities, ecenters, deltaE=0.5, bins=10):
+    """Q-plane cuts at the energies `ecenters`, from the output of mode_intensities.
+
+    Each cut is the same of binning the intensities in `bins` energy bins between
+    ecenter - deltaE and ecenter + deltaE (as calculate_sqw_map) and averaging the bins with
+    the energy_cut_weights, but without building the maps: the weight of the bin of each mode
+    is summed directly.
+
+    Returns:
+        (n_cuts, n_qpts) array, in intensities["units"] / (units of the frequencies).
+    """
+    frequencies = intensities["frequencies"]
+    cuts = np.empty((len(ecenters), frequencies.shape[0]))
+    for i, ecenter in enumerate(ecenters):
+        e_bins = np.linspace(ecenter - deltaE, ecenter + deltaE, bins + 1)
+        weights = energy_cut_weights(e_bins, ecenter, deltaE)
+        # the weights of the bins from np.digitize, 0 outside the energy range.
+        bin_weights = np.concatenate([[0], weights / np.diff(e_bins), [0]])
+        cuts[i] = np.sum(
+            intensities["positive"] * bin_weights[np.digitize(frequencies, e_bins)]
+            + intensities["negative"] * bin_weights[np.digitize(-frequencies, e_bins)],
+            axis=1,
+        ) / np.sum(weights)
+    return cuts
+
+
+def energy_window_intensities(intensities, ecenters, deltaE=0.5):
+    """Q-plane cuts at the energies `ecenters`, evaluated directly on the modes.
+
+    This is the limit of energy_cuts for infinitely many bins: each mode in the window
+    [ecenter - deltaE, ecenter + deltaE] contributes its intensity times the Gaussian weight
+    (energy_cut_weights) at its own frequency, normalised by the integral of the weight over
+    the window. No energy bins are used, and the memory is O(n_qpts * n_modes).
+
+    Returns:
+        (n_cuts, n_qpts) array, in intensities["units"] / (units of the frequencies).
+    """
+    frequencies = intensities["frequencies"]
+    # energy_cut_weights is exp(-a (E - ecenter)**2), up to a constant.
+    a = 1 / (2 * (deltaE / 2) ** 2)
+    norm = math.sqrt(math.pi / a) * math.erf(deltaE * math.sqrt(a))
+
+    cuts = np.empty((len(ecenters), frequencies.shape[0]))
+    for i, ecenter in enumerate(ecenters):
+        cut = np.zeros(frequencies.shape[0])
+        for sign, intensity in [
+            (1, intensities["positive"]),
+            (-1, intensities["negative"]),
+        ]:
+            distance = sign * frequencies - ecenter
+            weights = np.where(np.abs(distance) <= deltaE, np.exp(-a * distance**2), 0)
+            cut += np.sum(intensity * weights, axis=1)
+        cuts[i] = cut / norm
+    return cuts
@@ -0,0 +1,121 @@
+"""Sparse, mode-resolved representation of the S(Q,w) maps.
+
+The S(Q,w) map of a set of q-points is a sum of delta functions: each mode of each q-point
+contributes its intensity at +w (phonon creation) and, at finite temperature, at -w
+(annihilation). ModeList keeps these contributions as three flat arrays, (q index, energy,
+intensity), instead of the binned map: the ones with zero intensity (e.g. all the ones at -w
+at T=0) are not stored, so the memory scales with the number of modes, not of energy bins.
+
+The intensities are computed once (kernels.mode_intensities, with the Bose factor): binning in
+other energy bins (a different number of bins, energy range or energy unit) and selecting an
+energy window are then vectorised operations on the arrays, without recomputing the
+structure factors. The binning is the one of bin_mode_intensities, i.e. of calculate_sqw_map.
+
+The intensities can have leading map dimensions, e.g. the partial maps of
+kernels.partial_mode_intensities: all the maps share the q indexes and the energies.
+"""
+
+import numpy as np
+from euphonic import ureg
+
+
+class ModeList:
+    """The (q index, energy, intensity) contributions of the modes to the S(Q,w) maps.
+
+    Attributes:
+        q_index: (n_entries,) index of the q-point of each entry.
+        energies: (n_entries,) energy of each entry (+w or -w of its mode), in energy_unit.
+        intensities: (..., n_entries) intensity of each entry, in intensity_unit (the
+            units of the map times energy units); leading dimensions for several maps.
+        n_qpts: the number of q-points (also those without any entry).
+    """
+
+    def __init__(
+        self, q_index, energies, intensities, n_qpts, energy_unit, intensity_unit
+    ):
+        self.q_index = q_index
+        self.energies = energies
+        self.intensities = intensities
+        self.n_qpts = n_qpts
+        self.energy_unit = energy_unit
+        self.intensity_unit = intensity_unit
+
+    @classmethod
+    def from_mode_intensities(cls, intensities, energy_unit, threshold=0.0):
+        """The ModeList of the output of kernels.mode_intensities (or
+        partial_mode_intensities), whose frequencies are in energy_unit. The entries whose
+        intensity is not larger than threshold (in absolute value, in all the maps) are
+        dropped."""
+        frequencies = intensities["frequencies"]
+        n_qpts, n_modes = frequencies.shape
+        positive = np.asarray(intensities["positive"])
+        negative = np.asarray(intensities["negative"])
+        maps_shape = positive.shape[:-2]
+        weights = np.concatenate(
+            [
+                positive.reshape(maps_shape + (-1,)),
+                negative.reshape(maps_shape + (-1,)),
+            ],
+            axis=-1,
+        )
+        keep = np.abs(weights).reshape(-1, weights.shape[-1]).max(axis=0) > threshold
+        q_index = np.tile(np.repeat(np.arange(n_qpts, dtype=np.int32), n_modes), 2)
+        energies = np.concatenate([frequencies.ravel(), -frequencies.ravel()])
+        return cls(
+            q_index[keep],
+            energies[keep],
+            weights[..., keep],
+            n_qpts,
+            energy_unit,
+            intensities["units"],
+        )
+
+    def __len__(self):
+        return len(self.energies)
+
+    @property
+    def nbytes(self):
+        return self.q_index.nbytes + self.energies.nbytes + self.intensities.nbytes
+
+    def energy_window(self, e_min, e_max):
+        """The entries with e_min <= energy < e_max (Quantities)."""
+        energies = self.energies * ureg(self.energy_unit)
+        keep = (energies >= e_min) & (energies < e_max)
+        return ModeList(
+            self.q_index[keep],
+            self.energies[keep],
+            self.intensities[..., keep],
+            self.n_qpts,
+            self.energy_unit,
+            self.intensity_unit,
+        )
+
+    def bin(self, e_bins):
+        """The map in the energy bins e_bins (bin edges, Quantity in any energy unit), as
+        kernels.bin_mode_intensities.
+
+        Returns:
+            (n_qpts, len(e_bins) - 1) Quantity, or (..., n_qpts, len(e_bins) - 1) with
+            leading map dimensions, in intensity_unit / e_bins units.
+        """
+        edges = e_bins.magnitude
+        scale = (1 * ureg(self.energy_unit)).to(e_bins.units).magnitude
+        maps_shape = self.intensities.shape[:-1]
+        n_maps = int(np.prod(maps_shape))
+        # an extra bin either side for the entries outside the energy range.
+        n_bins = len(edges) + 1
+        index = self.q_index.astype(np.int64) * n_bins + np.digitize(
+            self.energies * scale, edges
+        )
+        m_offset = np.arange(n_maps)[:, np.newaxis] * self.n_qpts * n_bins
+        z_data = np.bincount(
+            (m_offset + index).ravel(),
+            weights=self.intensities.reshape(n_maps, -1).ravel(),
+            minlength=n_maps * self.n_qpts * n_bins,
+        )
+        z_data = z_data.reshape(maps_shape + (self.n_qpts, n_bins))[..., 1:-1]
+        # accumulated in double precision, stored in the precision of the intensities.
+        z_data = (z_data / np.diff(edges)).astype(
+            np.result_type(self.intensities.dtype, np.float32), copy=False
+        )
+        return z_data * (ureg(self.intensity_unit) / e_bins.units)
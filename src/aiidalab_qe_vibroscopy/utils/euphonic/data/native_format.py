@@ -0,0 +1,138 @@
+"""Euphonic-native storage of the force constants.
+
+The force constants are stored in the layout used internally by euphonic.ForceConstants (i.e.
+(n_cells, 3*n_atoms, 3*n_atoms) in hartree/bohr**2, already converted from the phonopy phases),
+together with the crystal and the supercell information. Loading them is then a binary read,
+without building Phonopy objects and producing/converting the force constants.
+
+Two containers are supported, with the same arrays (see NATIVE_ARRAYS):
+
+- an AiiDA ArrayData (the euphonic_force_constants output of the VibroWorkChain), where
+  the atom types and the format version are stored as attributes;
+- a .npz file (e.g. for the detached app), where everything is an array.
+
+As in generate_force_constant_instance_temporary_fix, the NAC is not stored.
+"""
+
+import io
+
+import numpy as np
+import euphonic
+from euphonic import ureg
+
+NATIVE_FORMAT_VERSION = 1
+
+# array name: unit of the stored values (None if dimensionless).
+NATIVE_ARRAYS = {
+    "force_constants": "hartree/bohr**2",
+    "cell_vectors": "angstrom",
+    "atom_r": None,
+    "atom_mass": "amu",
+    "sc_matrix": None,
+    "cell_origins": None,
+}
+
+
+def force_constants_from_atomic_units(
+    crystal, force_constants, sc_matrix, cell_origins
+):
+    """ForceConstants instance using the given (n_cells, 3*n_atoms, 3*n_atoms) array, in hartree/bohr**2.
+
+    We bypass the __init__, which would copy the force constants (pint conversion):
+    the array is used as it is.
+    """
+    fc = euphonic.ForceConstants.__new__(euphonic.ForceConstants)
+    fc.__dict__.update(
+        crystal=crystal,
+        _force_constants=force_constants,
+        force_constants_unit=str(ureg("hartree/bohr**2").units),
+        sc_matrix=sc_matrix,
+        cell_origins=cell_origins,
+        n_cells_in_sc=len(cell_origins),
+        _born=None,
+        born_unit=str(ureg.e),
+        _dielectric=None,
+        dielectric_unit=str(ureg("e**2/(bohr*hartree)")),
+    )
+    return fc
+
+
+def force_constants_to_arrays(fc):
+    """The arrays (see NATIVE_ARRAYS) and the atom types of a ForceConstants instance."""
+    arrays = {
+        "force_constants": fc._force_constants,
+        "cell_vectors": fc.crystal.cell_vectors.to("angstrom").magnitude,
+        "atom_r": fc.crystal.atom_r,
+        "atom_mass": fc.crystal.atom_mass.to("amu").magnitude,
+        "sc_matrix": np.asarray(fc.sc_matrix),
+        "cell_origins": np.asarray(fc.cell_origins),
+    }
+    return arrays, [str(atom_type) for atom_type in fc.crystal.atom_type]
+
+
+def force_constants_from_arrays(arrays, atom_type):
+    """Inverse of force_constants_to_arrays."""
+    crystal = euphonic.Crystal(
+        cell_vectors=arrays["cell_vectors"] * ureg("angstrom"),
+        atom_r=arrays["atom_r"],
+        atom_type=np.array(atom_type),
+        atom_mass=arrays["atom_mass"] * ureg("amu"),
+    )
+    return force_constants_from_atomic_units(
+        crystal,
+        np.ascontiguousarray(arrays["force_constants"], dtype=np.float64),
+        np.asarray(arrays["sc_matrix"], dtype=np.int32),
+        np.asarray(arrays["cell_origins"], dtype=np.int32),
+    )
+
+
+def force_constants_to_npz(fc):
+    """The bytes of a .npz file with the force constants in the euphonic-native layout."""
+    arrays, atom_type = force_constants_to_arrays(fc)
+    handle = io.BytesIO()
+    np.savez(
+        handle,
+        atom_type=np.array(atom_type),
+        version=np.array(NATIVE_FORMAT_VERSION),
+        **arrays,
+    )
+    return handle.getvalue()
+
+
+def force_constants_from_npz(content):
+    """Load the force constants from the bytes (or a path/file) of a .npz file."""
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        content = io.BytesIO(content)
+    with np.load(content, allow_pickle=False) as npz:
+        if int(npz["version"]) > NATIVE_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported version {int(npz['version'])} of the euphonic force constants file."
+            )
+        arrays = {name: npz[name] for name in NATIVE_ARRAYS}
+        atom_type = npz["atom_type"].tolist()
+    return force_constants_from_arrays(arrays, atom_type)
+
+
+def force_constants_to_array_data(fc):
+    """An (unstored) ArrayData with the force constants in the euphonic-native layout."""
+    from aiida import orm
+
+    arrays, atom_type = force_constants_to_arrays(fc)
+    node = orm.ArrayData()
+    for name, array in arrays.items():
+        node.set_array(name, array)
+    node.base.attributes.set("atom_type", atom_type)
+    node.base.attributes.set("units", {k: v for k, v in NATIVE_ARRAYS.items() if v})
+    node.base.attributes.set("euphonic_native_version", NATIVE_FORMAT_VERSION)
+    return node
+
+
+def force_constants_from_array_data(node):
+    """Load the force constants from the ArrayData produced by force_constants_to_array_data."""
+    version = node.base.attributes.get("euphonic_native_version")
+    if version > NATIVE_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported version {version} of the euphonic force constants node <PK={node.pk}>."
+        )
+    arrays = {name: node.get_array(name) for name in NATIVE_ARRAYS}
+    return force_constants_from_arrays(arrays, node.base.attributes.get("atom_type"))
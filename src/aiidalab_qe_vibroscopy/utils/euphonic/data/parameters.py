@@ -31,11 +31,18 @@ common_parameters = {
     "asr": "reciprocal",  # Apply an acoustic-sum-rule (ASR) correction to the data: "realspace" applies the correction to the force constant matrix in real space. "reciprocal" applies the correction to the dynamical matrix at each q-point. (default: None)
     "dipole_parameter": 1.0,  # Set the cutoff in real/reciprocal space for the dipole Ewald sum; higher values use more reciprocal terms. If tuned correctly this can result in performance improvements. See euphonic-optimise-dipole-parameter program for help on choosing a good DIPOLE_PARAMETER. (default: 1.0)
     "use_c": True,
-    "n_threads": 1,
+    "n_threads": None,  # Number of OpenMP threads of euphonic. None: decided by the execution policy, see execution.py (default: None)
+    "partials": None,  # "species" or "atoms": partial maps of each group of atoms (and cross terms between two groups), computed in one pass and returned as a list of spectra, adding up to the total (Only applicable when --weighting=coherent, without temperature series). (default: None)
+    "partial_cross_terms": True,  # Compute the cross terms between the groups of the partial maps (without them, the partials do not add up to the total). (default: True)
+    "precision": "double",  # "single" computes and stores the eigenvectors, the structure factors and the maps in single precision (float32/complex64): half the memory, for visualisation-grade maps (error bounds in kernels.py). (default: "double")
 }
 
 parameters_single_crystal = {
     **common_parameters,
+    "zone_reduction": True,  # Custom paths: diagonalise only once the q-points equal up to a reciprocal lattice vector (the modes are the same), so a path through several Brillouin zones costs the same of one zone. (default: True)
+    "path_tolerance": None,  # If set, adaptive density of q-points along the path: starting from every 16th point of the q_spacing path, intervals are split where the interpolated frequencies (relative to the largest one) or structure factors differ from the computed ones by more than this tolerance (e.g. 0.01); the x-axis is then non-uniform. (default: None)
+    "memory_budget": None,  # Memory (MB) for the structure factors: the q-points are processed in chunks fitting in it, and a path whose modes and maps alone do not fit raises a MemoryBudgetError before computing. None: decided by the execution policy, see execution.py (default: None)
+    "temperatures": None,  # List of temperatures in K; if set, a temperature series of S(Q,w) maps is computed (Only applicable when --weighting=coherent). (default: None)
 }
 
 parameters_powder = {
@@ -50,4 +57,13 @@ parameters_powder = {
     "jitter": True,
     "e_f": None,
     "disable_widgets": True,
+    "npts_tolerance": None,  # If set, adaptive sampling: points are added to each |q| shell in batches of npts_batch until the relative change of the shell spectrum is below this tolerance (or npts_max points are used); npts is then ignored, and the points used per shell are reported. (default: None)
+    "npts_batch": 50,  # Number of sphere points added at each step of the adaptive sampling. (default: 50)
+    "npts_min": 100,  # Minimum number of points per |q| shell with npts_density. (default: 100)
+    "npts_max": 10000,  # Maximum number of points per |q| shell with npts_density or the adaptive sampling. (default: 10000)
+    "symmetry_reduction": False,  # Diagonalise only the sphere points in the irreducible wedge of the point group of the crystal, i.e. ~npts/|G| per |q| shell (up to 48x fewer); converges to the same spherical average, but is noisier at the same npts. (default: False)
+    "seed": None,  # Seed for the jitter of the sphere sampling; if set, each |q| shell is reseeded (seed + shell index), so the map is reproducible. (default: None)
+    "powder_engine": "serial",  # How the |q| shells are sampled: "serial", "parallel" (process pool sharing the force constants in memory), "batched" (all the shells diagonalised together) or "grid" (no sphere sampling: phonons on the irreducible grid of grid/grid_spacing, unfolded to q+G and binned by |Q|; coherent weighting only). (default: serial)
+    "n_workers": None,  # Number of processes used by the parallel powder engine, which share the n_threads of the execution policy (from n_threads, set_execution_policy, AIIDALAB_QE_VIBROSCOPY_NUM_THREADS or the cores left by the cgroup quota and CPU affinity, see execution.py). (default: None, i.e. one process per thread of the policy)
+    "batch_size": None,  # Maximum number of q-points per diagonalisation in the batched powder engine. (default: None, i.e. bounded by memory)
 }
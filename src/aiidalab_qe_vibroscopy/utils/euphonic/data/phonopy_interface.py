@@ -1,10 +1,16 @@
+import re
 import tempfile
 import pathlib
 import base64
 from typing import Optional
+import numpy as np
 import euphonic
+from euphonic import ureg
 from phonopy.file_IO import write_force_constants_to_hdf5
 
+from aiidalab_qe_vibroscopy.utils.euphonic.data.native_format import (
+    force_constants_from_atomic_units,
+)
 from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
     blockPrint,
     enablePrint,
@@ -33,6 +39,220 @@ def generate_force_constant_instance_temporary_fix(
     return fc
 
 
+def _phonopy_physical_units(ph):
+    """Length and force constants units of a Phonopy instance, in the pint format of euphonic.
+
+    These are the units which would be written in the physical_unit section of phonopy.yaml.
+    """
+    try:
+        from phonopy.physical_units import get_calculator_physical_units
+
+        units = get_calculator_physical_units(ph.calculator)
+        length_unit, fc_unit = units.length_unit, units.force_constants_unit
+    except ImportError:  # older phonopy versions.
+        from phonopy.interface.calculator import get_default_physical_units
+
+        units = get_default_physical_units(ph.calculator)
+        length_unit, fc_unit = units["length_unit"], units["force_constants_unit"]
+
+    # same formatting as euphonic.readers.phonopy, e.g. eV/Angstrom.au -> eV/(angstrom.bohr)
+    divs = re.findall(r"/([^/]+)", fc_unit)
+    fc_unit = fc_unit.split("/")[0] + "/(" + "/(".join([d + ")" for d in divs])
+    length_unit, fc_unit = (
+        unit.replace("au", "bohr").replace("Angstrom", "angstrom")
+        for unit in (length_unit, fc_unit)
+    )
+    return length_unit, fc_unit
+
+
+def _supercell_keys(origins, sc_matrix):
+    """Integer keys of cell origins, equal for the origins equivalent in the supercell.
+
+    An origin r (unit cell coordinates) is equivalent to r + n.sc_matrix, so the key is
+    r.adj(sc_matrix) modulo |det(sc_matrix)|, which is integer (no tolerance needed).
+    """
+    det = int(np.rint(np.absolute(np.linalg.det(sc_matrix))))
+    adj = np.rint(np.linalg.inv(sc_matrix) * det).astype(np.int64)
+    keys = np.mod(origins @ adj, det)
+    return (keys[..., 0] * det + keys[..., 1]) * det + keys[..., 2]
+
+
+def _index_of_keys(keys, reference_keys, error_message):
+    order = np.argsort(reference_keys)
+    position = np.searchsorted(reference_keys[order], keys)
+    position = np.minimum(position, len(order) - 1)
+    index = order[position]
+    if np.any(reference_keys[index] != keys):
+        raise ValueError(error_message)
+    return index
+
+
+def _convert_fc_phases(
+    force_constants,
+    atom_r,
+    sc_atom_r,
+    uc_to_sc_atom_idx,
+    sc_to_uc_atom_idx,
+    sc_matrix,
+    cell_origins_tol=1e-5,
+):
+    """Vectorised version of euphonic.util.convert_fc_phases (same arguments and results).
+
+    euphonic matches the cell origins of each supercell atom, and then the cell-cell vectors,
+    in Python loops over the supercell atoms and cells (quadratic in the supercell size), which
+    dominates the conversion for large supercells. Here the equivalent origins are found
+    all together by their integer supercell keys, and the force constants are written directly
+    in the euphonic layout, (n_cells, 3*n_atoms, 3*n_atoms), without intermediate copies.
+    """
+    n_atoms_sc = len(sc_to_uc_atom_idx)
+    n_atoms_uc = len(uc_to_sc_atom_idx)
+    n_cells = int(np.rint(np.absolute(np.linalg.det(sc_matrix))))
+    if n_atoms_sc / n_atoms_uc - n_cells != 0:
+        raise ValueError(
+            f"Inconsistent numbers of cells in the supercell, unit "
+            f"cell has {n_atoms_uc} atoms, and supercell has "
+            f"{n_atoms_sc} atoms, but sc_matrix determinant suggests "
+            f"there should be {n_cells} cells in the supercell"
+        )
+    cell_origins_per_atom = sc_atom_r - atom_r[sc_to_uc_atom_idx]
+    non_int = np.where(
+        np.abs(cell_origins_per_atom - np.rint(cell_origins_per_atom))
+        > cell_origins_tol
+    )[0]
+    if len(non_int) > 0:
+        raise RuntimeError(
+            f"Non-integer cell origins for atom(s) "
+            f"{', '.join(np.unique(non_int).astype(str))}, "
+            f"check coordinates and indices are correct"
+        )
+    cell_origins_per_atom = np.rint(cell_origins_per_atom).astype(np.int32)
+    cell_origins_per_atom -= cell_origins_per_atom[uc_to_sc_atom_idx[0]]
+    cell_origins = cell_origins_per_atom[np.where(sc_to_uc_atom_idx == 0)[0]]
+
+    cell_keys = _supercell_keys(cell_origins, sc_matrix)
+    # cell of each supercell atom
+    cell_origins_map = _index_of_keys(
+        _supercell_keys(cell_origins_per_atom, sc_matrix),
+        cell_keys,
+        "Couldn't determine cell origins for force constants matrix",
+    )
+    # sc_relative_idx[i, j]: index of the cell equivalent to cell_origins[j] - cell_origins[i]
+    sc_relative_idx = _index_of_keys(
+        _supercell_keys(
+            cell_origins[np.newaxis] - cell_origins[:, np.newaxis], sc_matrix
+        ),
+        cell_keys,
+        "Couldn't find supercell relative index",
+    )
+
+    if force_constants.shape[0] == force_constants.shape[1]:
+        # full fc: we need only the rows of the atoms of the unit cell.
+        rows = uc_to_sc_atom_idx
+    else:
+        rows = range(n_atoms_uc)
+    fc_converted = np.zeros((n_cells, n_atoms_uc, 3, n_atoms_uc, 3))
+    for i, row in enumerate(rows):
+        # the n_atoms rows of the Phonopy force constants may not be in the same cell
+        # of the supercell, we use the cell vectors relative to the cell of the atom i.
+        cell_idx = cell_origins_map[np.where(sc_to_uc_atom_idx == i)[0][0]]
+        fc_converted[
+            sc_relative_idx[cell_idx][cell_origins_map], i, :, sc_to_uc_atom_idx, :
+        ] = force_constants[row]
+
+    return (
+        fc_converted.reshape(n_cells, 3 * n_atoms_uc, 3 * n_atoms_uc),
+        cell_origins,
+    )
+
+
+def generate_force_constant_from_phonopy_instance(ph):
+    """Build the euphonic ForceConstants directly from a Phonopy instance (with force constants).
+
+    This is the in-memory equivalent of writing phonopy.yaml and fc.hdf5 and reading them
+    back with euphonic (as in generate_force_constant_instance_temporary_fix): the same
+    arrays are passed to the (vectorised) conversion of the phases of the force constants,
+    without the text serialisation. The conversion produces the only copy of the force
+    constants, which is then converted to atomic units in place and used as is by the
+    ForceConstants instance.
+    As in the temporary fix, the NAC (Born charges and dielectric tensor) is not included.
+    """
+    length_unit, fc_unit = _phonopy_physical_units(ph)
+    primitive = ph.primitive
+    supercell = ph.supercell
+
+    # same as in euphonic.readers.phonopy._extract_summary.
+    u_to_sc_matrix = np.array(ph.supercell_matrix)
+    if ph.primitive_matrix is not None:
+        p_to_u_matrix = np.linalg.inv(ph.primitive_matrix).transpose()
+        p_to_sc_matrix = np.rint(np.matmul(u_to_sc_matrix, p_to_u_matrix)).astype(
+            np.int32
+        )
+    else:
+        p_to_sc_matrix = u_to_sc_matrix
+    atom_r = primitive.scaled_positions
+    satom_r_pcell = np.einsum("ij,jk->ik", supercell.scaled_positions, p_to_sc_matrix)
+    pc_to_sc_atom_idx, sc_to_pc_atom_idx = np.unique(
+        primitive.s2p_map, return_inverse=True
+    )
+
+    crystal = euphonic.Crystal(
+        cell_vectors=primitive.cell * ureg(length_unit).to("angstrom"),
+        atom_r=atom_r - np.floor(atom_r),
+        atom_type=np.array(primitive.symbols),
+        atom_mass=primitive.masses * ureg("amu"),
+    )
+
+    force_constants, cell_origins = _convert_fc_phases(
+        ph.force_constants,
+        atom_r,
+        satom_r_pcell,
+        pc_to_sc_atom_idx,
+        sc_to_pc_atom_idx,
+        p_to_sc_matrix,
+    )
+    force_constants *= ureg(fc_unit).to("hartree/bohr**2").magnitude
+
+    return force_constants_from_atomic_units(
+        crystal, force_constants, p_to_sc_matrix, cell_origins
+    )
+
+
+def get_phonopy_instance_from_inputs(inputs):
+    """Phonopy instance, with compact force constants, and p2s_map from the inputs of a PhonopyCalculation.
+
+    `inputs` can be the inputs of the PhonopyCalculation node, or a dictionary with the same
+    keys (phonopy_data or force_constants, and optionally settings).
+    This is almost copied from PhonopyCalculation.
+    """
+    kwargs = {}
+
+    if "settings" in inputs:
+        the_settings = inputs["settings"].get_dict()
+        for key in ["symmetrize_nac", "factor_nac", "subtract_residual_forces"]:
+            if key in the_settings:
+                kwargs.update({key: the_settings[key]})
+
+    if "phonopy_data" in inputs:
+        ph = inputs["phonopy_data"].get_phonopy_instance(**kwargs)
+        p2s_map = inputs["phonopy_data"].get_cells_mappings()["primitive"]["p2s_map"]
+        # compact force constants, i.e. only the rows of the primitive atoms (p2s_map):
+        # these are the only ones needed (and written in fc.hdf5), and the full ones
+        # are n_cells times larger.
+        ph.produce_force_constants(calculate_full_force_constants=False)
+    elif "force_constants" in inputs:
+        ph = inputs["force_constants"].get_phonopy_instance(**kwargs)
+        p2s_map = inputs["force_constants"].get_cells_mappings()["primitive"]["p2s_map"]
+        force_constants = inputs["force_constants"].get_array("force_constants")
+        if force_constants.shape[0] == force_constants.shape[1]:
+            # stored as full force constants, we keep only the compact ones.
+            force_constants = force_constants[p2s_map]
+        ph.force_constants = force_constants
+    else:
+        raise ValueError("No phonopy_data or force_constants in the inputs.")
+
+    return ph, p2s_map
+
+
 def generate_force_constant_from_phonopy(
     phonopy_calc=None,
     path: str = None,
@@ -67,31 +287,16 @@ def generate_force_constant_from_phonopy(
     ####### This is almost copied from PhonopyCalculation and is done to support functionalities in aiidalab env:
     from phonopy.interface.phonopy_yaml import PhonopyYaml
 
-    kwargs = {}
-
-    if "settings" in phonopy_calc.inputs:
-        the_settings = phonopy_calc.inputs.settings.get_dict()
-        for key in ["symmetrize_nac", "factor_nac", "subtract_residual_forces"]:
-            if key in the_settings:
-                kwargs.update({key: the_settings[key]})
-
-    if "phonopy_data" in phonopy_calc.inputs:
-        ph = phonopy_calc.inputs.phonopy_data.get_phonopy_instance(**kwargs)
-        p2s_map = phonopy_calc.inputs.phonopy_data.get_cells_mappings()["primitive"][
-            "p2s_map"
-        ]
-        ph.produce_force_constants()
-    elif "force_constants" in phonopy_calc.inputs:
-        ph = phonopy_calc.inputs.force_constants.get_phonopy_instance(**kwargs)
-        p2s_map = phonopy_calc.inputs.force_constants.get_cells_mappings()["primitive"][
-            "p2s_map"
-        ]
-        ph.force_constants = phonopy_calc.inputs.force_constants.get_array(
-            "force_constants"
-        )
+    ph, p2s_map = get_phonopy_instance_from_inputs(phonopy_calc.inputs)
 
     #######
 
+    if mode != "download" and not use_euphonic_full_parser:
+        # no need to go through the files.
+        fc = generate_force_constant_from_phonopy_instance(ph)
+        enablePrint()
+        return fc
+
     # Create temporary directory
     #
     with tempfile.TemporaryDirectory() as dirpath:
@@ -0,0 +1,938 @@
+"""Engines for the |q|-shell sampling of the powder maps.
+
+The powder map is obtained shell by shell: for each |q| bin, the structure factor (or the DOS)
+is averaged over a sphere of constant |q| (see ``euphonic.powder``).
+Here we collect the different ways of running this sampling, so that ``produce_powder_data``
+only needs to select one of them via the ``powder_engine`` parameter:
+
+- "serial": one shell after the other, in the current process (default);
+- "parallel": the shells are distributed over a pool of worker processes. The arrays of the
+  ForceConstants instance are put in shared memory, so the workers do not copy them;
+- "batched": the sphere points of all the shells are generated up front and diagonalised
+  together, in a few calls bounded in memory, and then binned back into the shells. This avoids
+  paying the per-call setup of euphonic (Python overhead, dipole Ewald preparation) at each shell,
+  and lets the C extension thread over many q-points at once.
+- "grid": no sphere sampling. The phonons are computed once on the irreducible points of a
+  Monkhorst-Pack grid (the one of the Debye-Waller factor, i.e. the grid/grid_spacing parameters),
+  unfolded to all the Q = q + G points in the |q| range (the intensity at RQ is the one at Q, so
+  each irreducible q has the weight of its star), and the structure factor of all these Q is
+  binned by |Q| and energy at once. Each shell is then the average over the Q points it contains
+  (i.e. over the volume of the shell, not over its central sphere). Coherent weighting only.
+  A convergence estimate is reported (see _sample_shells_grid).
+
+All the engines are generators of the shell intensities, in order of |q| (see
+iter_sample_shells, used by stream_powder_data to show the map while it is computed).
+
+If a ``seed`` is provided, the jitter of the sphere sampling is reseeded at each shell
+(with seed + shell index), so that all the engines produce exactly the same map.
+
+With the ``symmetry_reduction`` option, only the points of each sphere which fall in an
+irreducible wedge of the point group of the crystal (plus the inversion, as S(Q,w) = S(-Q,w))
+are diagonalised. The wedge is the Dirichlet domain {q : v.q >= v.(Rq) for all R} of a generic
+vector v: the |G| images of the wedge tile the sphere, and the intensity is the same on each
+image, so the average over the (uniformly distributed) points of the wedge converges to the
+spherical average with ~npts/|G| diagonalisations instead of npts (up to 48x less for cubic
+crystals). The points in the wedge all have the same weight. Since fewer inequivalent points
+are sampled, at the same npts the map is noisier than the full-sphere one (still, for the same
+number of diagonalisations, it is more accurate).
+
+With the ``npts_tolerance`` option (adaptive sampling, serial and parallel engines), npts is not
+fixed: points are added to each shell in batches of ``npts_batch`` until the relative change of
+the shell spectrum (L2 norm of the running average) is below the tolerance, or ``npts_max``
+points are used. Each batch is the same golden-sphere set of points under a random rotation, so
+the batches are unbiased and the running average converges to the spherical average; shells
+with a smooth intensity stop early, the ones crossing sharp features get more points. The
+number of points used per shell is reported in the ``npts`` entry of the report (for all the
+sphere-sampling engines).
+
+With the ``partials`` option ("species" or "atoms", coherent weighting, sphere-sampling
+engines), each shell is the collection of the partial spectra of the groups of atoms (and of
+the cross terms between two groups), computed in one pass over the eigenvectors of the shell
+(see kernels.partial_mode_intensities), instead of the total spectrum: the rows of the engines
+are then (n_partials, n_energy_bins) arrays.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from euphonic import (
+    ureg,
+    ForceConstants,
+    Spectrum1DCollection,
+    QpointFrequencies,
+    QpointPhononModes,
+)
+from euphonic.cli.utils import (
+    _get_pdos_weighting,
+    _arrange_pdos_groups,
+    _grid_spec_from_args,
+)
+from euphonic.powder import (
+    sample_sphere_dos,
+    sample_sphere_pdos,
+    sample_sphere_structure_factor,
+    _get_qpts_sphere,
+    _qpts_cart_to_frac,
+)
+
+import spglib
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import derived_cache
+from aiidalab_qe_vibroscopy.utils.euphonic.data.execution import available_cpus
+from aiidalab_qe_vibroscopy.utils.euphonic.data.kernels import (
+    bin_mode_intensities,
+    calculate_sqw_map_series,
+    partial_groups,
+    partial_mode_intensities,
+)
+
+POWDER_ENGINES = ("serial", "parallel", "batched", "grid")
+
+# memory allowed for the eigenvectors of a single diagonalisation of the batched engine.
+BATCH_MEMORY = 256 * 1024**2  # bytes
+
+# arrays smaller than this are simply pickled to the workers.
+SHARED_MEMORY_THRESHOLD = 1024  # bytes
+
+# symmetry tolerance used to find the point group of the crystal (symmetry_reduction option).
+SYMPREC = 1e-5
+
+# defaults of the adaptive sampling (npts_tolerance option).
+ADAPTIVE_NPTS_BATCH = 50
+ADAPTIVE_NPTS_MAX = 10000
+
+# generic vector defining the irreducible wedge (see point_group_wedge): it must not be
+# left invariant by any rotation of the point group.
+_WEDGE_VECTOR = np.array([1.0, 0.3141592653589793, 0.02718281828459045])
+
+# state of the worker processes of the parallel engine, set by _init_worker.
+_WORKER_STATE = {}
+
+
+@contextmanager
+def seeded_jitter(seed=None, q_index=0):
+    """Reseed the numpy global random state (used by the euphonic sphere sampling)
+    for the shell `q_index`, restoring the previous state afterwards.
+
+    If seed is None, nothing is done.
+    """
+    if seed is None:
+        yield
+        return
+    state = np.random.get_state()
+    np.random.seed((seed + q_index) % 2**32)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+
+def sample_shell(
+    fc,
+    mod_q,
+    npts,
+    energy_bins,
+    options,
+    dw=None,
+    temperature=None,
+    q_index=0,
+):
+    """Sample a single |q| shell.
+
+    Args:
+        fc (ForceConstants): the force constants.
+        mod_q (Quantity): the radius of the shell.
+        npts (int): number of points on the sphere.
+        energy_bins (Quantity): energy bin edges.
+        options (dict): sampling options, i.e. weighting, pdos, sampling, jitter, seed,
+            symmetry_reduction, npts_tolerance, npts_batch, npts_max, partials,
+            partial_cross_terms and calc_modes_kwargs (passed to the euphonic calculate_qpoint_phonon_modes).
+        dw (DebyeWaller): Debye-Waller factor (coherent weighting only).
+        temperature (Quantity): temperature (coherent weighting only).
+        q_index (int): index of the shell, used to reseed the jitter.
+
+    Returns:
+        Spectrum1D: the powder-averaged spectrum of the shell (Spectrum1DCollection of the
+            partial spectra, with the partials option). If the number of points is not
+            npts (adaptive sampling, symmetry reduction), it is in metadata["npts"].
+    """
+    weighting = options["weighting"]
+    calc_modes_kwargs = options["calc_modes_kwargs"]
+
+    if options.get("npts_tolerance"):
+        return sample_shell_adaptive(
+            fc, mod_q, energy_bins, options, dw=dw, q_index=q_index
+        )
+
+    if options.get("symmetry_reduction") or options.get("partials"):
+        # only the points in the irreducible wedge, or the partial spectra (the euphonic
+        # sample_sphere_* functions generate their own points, so we diagonalise and average
+        # as in the batched engine).
+        qpts = shell_qpts(
+            fc,
+            mod_q,
+            npts,
+            sampling=options["sampling"],
+            jitter=options["jitter"],
+            seed=options.get("seed"),
+            q_index=q_index,
+            symmetry_reduction=options.get("symmetry_reduction", False),
+        )
+        if weighting == "dos" and options.get("pdos") is None:
+            phonons = fc.calculate_qpoint_frequencies(qpts, **calc_modes_kwargs)
+        else:
+            phonons = fc.calculate_qpoint_phonon_modes(qpts, **calc_modes_kwargs)
+        spectrum_1d = _shell_spectrum(phonons, slice(None), energy_bins, options, dw=dw)
+        spectrum_1d.metadata["npts"] = len(qpts)
+        return spectrum_1d
+
+    with seeded_jitter(options.get("seed"), q_index):
+        if weighting == "dos" and options.get("pdos") is None:
+            return sample_sphere_dos(
+                fc,
+                mod_q,
+                npts=npts,
+                sampling=options["sampling"],
+                jitter=options["jitter"],
+                energy_bins=energy_bins,
+                **calc_modes_kwargs,
+            )
+        elif "dos" in weighting:
+            spectrum_1d_col = sample_sphere_pdos(
+                fc,
+                mod_q,
+                npts=npts,
+                sampling=options["sampling"],
+                jitter=options["jitter"],
+                energy_bins=energy_bins,
+                weighting=_get_pdos_weighting(weighting),
+                **calc_modes_kwargs,
+            )
+            return _arrange_pdos_groups(spectrum_1d_col, options.get("pdos"))
+        elif weighting == "coherent":
+            return sample_sphere_structure_factor(
+                fc,
+                mod_q,
+                dw=dw,
+                temperature=temperature,
+                sampling=options["sampling"],
+                jitter=options["jitter"],
+                npts=npts,
+                energy_bins=energy_bins,
+                **calc_modes_kwargs,
+            )
+    raise ValueError(f"Weighting {weighting} not supported for powder maps.")
+
+
+def sample_shell_adaptive(fc, mod_q, energy_bins, options, dw=None, q_index=0):
+    """Sample a single |q| shell adding batches of points until the spectrum converges.
+
+    Each batch is the golden sphere of options["npts_batch"] points, randomly rotated
+    (the random rotations are reseeded with seed + q_index, if a seed is given). With
+    options["symmetry_reduction"], the sphere has npts_batch*|G| points, reduced to the
+    ~npts_batch ones in the irreducible wedge. The spectrum is the
+    running average over all the points; the sampling stops when, after at least two batches,
+    the relative (L2) change of the running average is below options["npts_tolerance"],
+    or when options["npts_max"] points are used.
+
+    Returns:
+        Spectrum1D: the spectrum of the shell, with the number of points diagonalised
+            in metadata["npts"].
+    """
+    tolerance = options["npts_tolerance"]
+    npts_batch = options.get("npts_batch") or ADAPTIVE_NPTS_BATCH
+    npts_max = options.get("npts_max") or ADAPTIVE_NPTS_MAX
+    calc_modes_kwargs = options["calc_modes_kwargs"]
+    frequencies_only = options["weighting"] == "dos" and options.get("pdos") is None
+
+    rotations = None
+    n_sphere = npts_batch
+    if options.get("symmetry_reduction"):
+        # ~npts_batch points in the wedge at each batch.
+        rotations = point_group_rotations(fc)
+        n_sphere = npts_batch * len(rotations)
+    sphere = _get_qpts_sphere(n_sphere, sampling=options["sampling"], jitter=False)
+    seed = options.get("seed")
+    rng = np.random.default_rng(None if seed is None else (seed + q_index) % 2**32)
+
+    npts = 0
+    average = None
+    while True:
+        qpts_cart = sphere @ _random_rotation(rng).T
+        if rotations is not None:
+            qpts_cart = qpts_cart[point_group_wedge(qpts_cart, rotations)]
+        qpts = _qpts_cart_to_frac(qpts_cart * mod_q, fc.crystal)
+        if frequencies_only:
+            phonons = fc.calculate_qpoint_frequencies(qpts, **calc_modes_kwargs)
+        else:
+            phonons = fc.calculate_qpoint_phonon_modes(qpts, **calc_modes_kwargs)
+        spectrum_1d = _shell_spectrum(phonons, slice(None), energy_bins, options, dw=dw)
+        y_data = spectrum_1d.y_data.magnitude
+
+        npts += len(qpts)
+        previous = average
+        if average is None:
+            average = y_data
+        else:
+            average = average + (y_data - average) * len(qpts) / npts
+
+        if previous is not None:
+            norm = np.linalg.norm(average)
+            change = np.linalg.norm(average - previous) / norm if norm else 0.0
+            if change < tolerance:
+                break
+        if npts >= npts_max:
+            break
+
+    # (a Spectrum1DCollection for the partial spectra.)
+    return type(spectrum_1d)(
+        spectrum_1d.x_data,
+        average * spectrum_1d.y_data.units,
+        metadata=dict(spectrum_1d.metadata, npts=npts),
+    )
+
+
+def _random_rotation(rng):
+    """A random rotation matrix, uniformly distributed (QR of a gaussian matrix)."""
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    q = q * np.sign(np.diag(r))
+    if np.linalg.det(q) < 0:
+        q[:, 0] = -q[:, 0]
+    return q
+
+
+def sample_shells(
+    fc,
+    shells,
+    energy_bins,
+    options,
+    dw=None,
+    temperature=None,
+    engine="serial",
+    n_workers=None,
+    batch_size=None,
+    q_bin_edges=None,
+    report=None,
+):
+    """Sample all the |q| shells of a powder map with the given engine.
+
+    Args:
+        shells (list): list of (mod_q, npts) tuples, mod_q being a Quantity.
+        engine (str): one of POWDER_ENGINES.
+        n_workers (int): number of processes for the parallel engine
+            (default: the n_threads of the execution policy, one thread each).
+        batch_size (int): maximum number of q-points diagonalised (or, for the grid engine,
+            of Q points binned) at once by the batched and grid engines
+            (default: as many as fit in BATCH_MEMORY).
+        q_bin_edges (Quantity): edges of the |q| shells, needed by the grid engine.
+        report (dict): if given, filled with the sampling information: the number of points
+            used per shell ("npts", sphere-sampling engines) or the convergence estimate
+            of the grid engine.
+        See `sample_shell` for the other arguments.
+
+    Returns:
+        (np.ndarray, Unit): the (n_shells, n_energy_bins) intensities and their units
+            ((n_shells, n_partials, n_energy_bins) with the partials option).
+    """
+    z_data = None
+    for q_index, row, units, _ in iter_sample_shells(
+        fc,
+        shells,
+        energy_bins,
+        options,
+        dw=dw,
+        temperature=temperature,
+        engine=engine,
+        n_workers=n_workers,
+        batch_size=batch_size,
+        q_bin_edges=q_bin_edges,
+        report=report,
+    ):
+        if z_data is None:
+            z_data = np.empty((len(shells),) + np.shape(row))
+        z_data[q_index] = row
+    return z_data, units
+
+
+def iter_sample_shells(
+    fc,
+    shells,
+    energy_bins,
+    options,
+    dw=None,
+    temperature=None,
+    engine="serial",
+    n_workers=None,
+    batch_size=None,
+    q_bin_edges=None,
+    report=None,
+):
+    """Generator version of `sample_shells` (same arguments), for live plotting.
+
+    Yields (q_index, row, units, npts) as soon as each shell is sampled, in order of q_index:
+    row are the intensities of the shell and npts the number of points used (None for the
+    grid engine). The serial and parallel engines yield one shell at a time, the batched one
+    a batch of shells at a time, the grid one all the shells at the end.
+    The report is complete once the generator is exhausted.
+    """
+    if options.get("npts_tolerance") and engine not in ("serial", "parallel"):
+        raise ValueError(
+            f"The adaptive sampling (npts_tolerance) is not supported by the '{engine}' "
+            "powder engine, use the serial or the parallel one."
+        )
+
+    if engine == "serial":
+        rows = _sample_shells_serial(
+            fc,
+            shells,
+            energy_bins,
+            options,
+            dw=dw,
+            temperature=temperature,
+        )
+    elif engine == "parallel":
+        rows = _sample_shells_parallel(
+            fc,
+            shells,
+            energy_bins,
+            options,
+            dw=dw,
+            temperature=temperature,
+            n_workers=n_workers,
+        )
+    elif engine == "batched":
+        rows = _sample_shells_batched(
+            fc,
+            shells,
+            energy_bins,
+            options,
+            dw=dw,
+            temperature=temperature,
+            batch_size=batch_size,
+        )
+    elif engine == "grid":
+        rows = _sample_shells_grid(
+            fc,
+            q_bin_edges,
+            energy_bins,
+            options,
+            dw=dw,
+            temperature=temperature,
+            batch_size=batch_size,
+            report=report,
+        )
+    else:
+        raise ValueError(
+            f"Powder engine '{engine}' not recognized, choose among {POWDER_ENGINES}."
+        )
+
+    npts = []
+    for q_index, (row, units, n) in enumerate(rows):
+        npts.append(n)
+        yield q_index, row, units, n
+    if report is not None and engine != "grid":
+        report["npts"] = [int(n) for n in npts]
+
+
+def _sample_shells_serial(
+    fc,
+    shells,
+    energy_bins,
+    options,
+    dw=None,
+    temperature=None,
+):
+    for q_index, (mod_q, npts) in enumerate(shells):
+        spectrum_1d = sample_shell(
+            fc,
+            mod_q,
+            npts,
+            energy_bins,
+            options,
+            dw=dw,
+            temperature=temperature,
+            q_index=q_index,
+        )
+        yield (
+            spectrum_1d.y_data.magnitude,
+            spectrum_1d.y_data.units,
+            spectrum_1d.metadata.get("npts", npts),
+        )
+
+
+def shell_qpts(
+    fc,
+    mod_q,
+    npts,
+    sampling="golden",
+    jitter=False,
+    seed=None,
+    q_index=0,
+    symmetry_reduction=False,
+):
+    """The q-points (fractional coordinates) sampled on the shell of radius mod_q.
+
+    These are the same points generated in the euphonic sample_sphere_* functions,
+    including the reseeding of the jitter (see `seeded_jitter`).
+    If symmetry_reduction is True, only the points in the irreducible wedge are kept
+    (at least one point per wedge is generated, see point_group_wedge).
+    """
+    if symmetry_reduction:
+        rotations = point_group_rotations(fc)
+        npts = max(npts, len(rotations))
+    with seeded_jitter(seed, q_index):
+        qpts_cart = _get_qpts_sphere(npts, sampling=sampling, jitter=jitter)
+    if symmetry_reduction:
+        qpts_cart = qpts_cart[point_group_wedge(qpts_cart, rotations)]
+    return _qpts_cart_to_frac(qpts_cart * mod_q, fc.crystal)
+
+
+def point_group_rotations(fc, symprec=SYMPREC):
+    """The cartesian rotations of the point group of the crystal of `fc`, plus the inversion.
+
+    The identity is the first one. These act on the cartesian q-points, and leave
+    the powder intensities unchanged. Cached per force constants (see cache.py).
+    """
+    crystal = fc.crystal
+
+    def compute():
+        symmetry = spglib.get_symmetry(crystal.to_spglib_cell(), symprec=symprec)
+        # spglib gives the rotations W of the fractional coordinates, x' = W x; with the
+        # cell vectors as rows of A, the cartesian rotation is A^T W A^-T.
+        cell = crystal.cell_vectors.to("angstrom").magnitude
+        rotations = np.einsum(
+            "ji,njk,lk->nil", cell, symmetry["rotations"], np.linalg.inv(cell)
+        )
+        rotations = np.concatenate([rotations, -rotations])
+        rotations = np.unique(np.round(rotations, 8), axis=0)
+        # the identity first.
+        identity = np.all(np.isclose(rotations, np.eye(3)), axis=(1, 2))
+        return np.concatenate([rotations[identity][:1], rotations[~identity]])
+
+    return derived_cache(fc).get(("point_group", symprec), compute)
+
+
+def point_group_wedge(qpts_cart, rotations):
+    """Boolean mask of the (cartesian) q-points in the irreducible wedge of the point group.
+
+    A point q is in the wedge if v.q >= v.(Rq) for all the rotations R (the identity being
+    the first one), v being a generic vector (_WEDGE_VECTOR).
+    """
+    # v.(Rq) = (R^T v).q
+    projections = qpts_cart @ np.einsum("nij,i->nj", rotations, _WEDGE_VECTOR).T
+    return np.argmax(projections, axis=1) == 0
+
+
+########################
+################################ START batched engine
+########################
+
+
+def _sample_shells_batched(
+    fc,
+    shells,
+    energy_bins,
+    options,
+    dw=None,
+    temperature=None,
+    batch_size=None,
+):
+    weighting = options["weighting"]
+    calc_modes_kwargs = options["calc_modes_kwargs"]
+    frequencies_only = weighting == "dos" and options.get("pdos") is None
+
+    if not batch_size:
+        # complex eigenvectors, (3 * n_atoms)**2 per q-point.
+        bytes_per_qpt = 16 * (3 * fc.crystal.n_atoms) ** 2
+        batch_size = max(1, BATCH_MEMORY // bytes_per_qpt)
+
+    # 1. generate the points of all the shells, in the same order as the serial engine.
+    qpts = [
+        shell_qpts(
+            fc,
+            mod_q,
+            npts,
+            sampling=options["sampling"],
+            jitter=options["jitter"],
+            seed=options.get("seed"),
+            q_index=q_index,
+            symmetry_reduction=options.get("symmetry_reduction", False),
+        )
+        for q_index, (mod_q, npts) in enumerate(shells)
+    ]
+
+    # 2. group whole shells in batches of at most batch_size q-points (at least one shell).
+    batches = [[]]
+    n_batch = 0
+    for q_index, shell in enumerate(qpts):
+        if batches[-1] and n_batch + len(shell) > batch_size:
+            batches.append([])
+            n_batch = 0
+        batches[-1].append(q_index)
+        n_batch += len(shell)
+
+    # 3. one diagonalisation per batch, then histogram back each shell.
+    for batch in batches:
+        batch_qpts = np.concatenate([qpts[q_index] for q_index in batch])
+        if frequencies_only:
+            phonons = fc.calculate_qpoint_frequencies(batch_qpts, **calc_modes_kwargs)
+        else:
+            phonons = fc.calculate_qpoint_phonon_modes(batch_qpts, **calc_modes_kwargs)
+
+        start = 0
+        for q_index in batch:
+            shell = slice(start, start + len(qpts[q_index]))
+            start = shell.stop
+            spectrum_1d = _shell_spectrum(phonons, shell, energy_bins, options, dw=dw)
+            yield (
+                spectrum_1d.y_data.magnitude,
+                spectrum_1d.y_data.units,
+                len(qpts[q_index]),
+            )
+
+
+def _shell_spectrum(phonons, shell, energy_bins, options, dw=None):
+    """Spectrum of the shell, i.e. of the q-points in the slice `shell` of `phonons`.
+
+    This reproduces what is done in the euphonic sample_sphere_* functions after the diagonalisation.
+    """
+    weighting = options["weighting"]
+    if isinstance(phonons, QpointFrequencies) and not isinstance(
+        phonons, QpointPhononModes
+    ):
+        return QpointFrequencies(
+            phonons.crystal, phonons.qpts[shell], phonons.frequencies[shell]
+        ).calculate_dos(energy_bins)
+
+    modes = QpointPhononModes(
+        phonons.crystal,
+        phonons.qpts[shell],
+        phonons.frequencies[shell],
+        phonons.eigenvectors[shell],
+    )
+    if "dos" in weighting:
+        spectrum_1d_col = modes.calculate_pdos(
+            energy_bins, weighting=_get_pdos_weighting(weighting)
+        )
+        return _arrange_pdos_groups(spectrum_1d_col, options.get("pdos"))
+    if options.get("partials"):
+        return _partial_shell_spectrum(modes, energy_bins, options, dw=dw)
+    return modes.calculate_structure_factor(dw=dw).calculate_1d_average(energy_bins)
+
+
+def _partial_shell_spectrum(modes, energy_bins, options, dw=None):
+    """Partial spectra of the shell (see kernels.partial_mode_intensities), averaged over its
+    q-points as in StructureFactor.calculate_1d_average."""
+    intensities = partial_mode_intensities(
+        modes,
+        partial_groups(modes.crystal, options["partials"]),
+        dw=dw,
+        cross_terms=options.get("partial_cross_terms", True),
+    )
+    e_bins = energy_bins.to(modes.frequencies.units).magnitude
+    y_data = np.mean(bin_mode_intensities(intensities, e_bins), axis=1) * (
+        ureg(intensities["units"]) / modes.frequencies.units
+    )
+    return Spectrum1DCollection(
+        energy_bins,
+        y_data.to(ureg(intensities["units"]) / energy_bins.units),
+        metadata={
+            "line_data": [{"partial": partial} for partial in intensities["partials"]]
+        },
+    )
+
+
+########################
+################################ END batched engine
+########################
+
+
+########################
+################################ START grid engine
+########################
+
+
+def irreducible_grid_modes(fc, grid_spec, calc_modes_kwargs):
+    """Phonon modes on the irreducible points of the Gamma-centred grid, and their weights.
+
+    Gamma is excluded, as the acoustic modes have zero frequency there (the intensity
+    diverges). Cached per force constants (see cache.py).
+    """
+    grid_spec = tuple(int(n) for n in grid_spec)
+    key = (
+        "irreducible_grid_modes",
+        grid_spec,
+        calc_modes_kwargs.get("asr"),
+        calc_modes_kwargs.get("dipole_parameter", 1.0),
+    )
+
+    def compute():
+        mapping, addresses = spglib.get_ir_reciprocal_mesh(
+            grid_spec, fc.crystal.to_spglib_cell(), is_shift=[0, 0, 0], symprec=SYMPREC
+        )
+        irreducible, weights = np.unique(mapping, return_counts=True)
+        addresses = addresses[irreducible]
+        not_gamma = np.any(addresses != 0, axis=1)
+        qpts = addresses[not_gamma] / np.array(grid_spec)
+        modes = fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=False, **calc_modes_kwargs
+        )
+        return modes, weights[not_gamma]
+
+    return derived_cache(fc).get(key, compute)
+
+
+def _sample_shells_grid(
+    fc,
+    q_bin_edges,
+    energy_bins,
+    options,
+    dw=None,
+    temperature=None,
+    batch_size=None,
+    report=None,
+):
+    """Powder map from the phonons on the irreducible Monkhorst-Pack grid (see module docstring).
+
+    The convergence estimate is obtained splitting the irreducible q-points in two interleaved
+    halves: the two half maps are independent estimates of the same map, and their relative
+    difference ||z_1 - z_2|| / ||z_1 + z_2|| is reported (as "grid_convergence"), together with
+    the number of irreducible q-points and the minimum number of Q points in a shell. As each
+    half is a coarser sampling than the full grid, this tends to overestimate the error.
+    """
+    if options["weighting"] != "coherent":
+        raise ValueError("The grid powder engine supports only the coherent weighting.")
+    if options.get("partials"):
+        raise ValueError("The grid powder engine does not support the partial maps.")
+    if q_bin_edges is None:
+        raise ValueError("The grid powder engine needs the |q| bin edges.")
+
+    grid_spec = _grid_spec_from_args(
+        fc.crystal, grid=options.get("grid"), grid_spacing=options.get("grid_spacing")
+    )
+    modes, weights = irreducible_grid_modes(fc, grid_spec, options["calc_modes_kwargs"])
+    if temperature is None:
+        temperature = 0 * ureg("K")
+
+    q_unit = q_bin_edges.units
+    edges = q_bin_edges.magnitude
+    n_shells = len(edges) - 1
+    recip = fc.crystal.reciprocal_cell().to(q_unit).magnitude
+    cell = fc.crystal.cell_vectors.to(1 / q_unit).magnitude
+
+    # all the G for which q + G (q in the first cell) can be within the largest shell:
+    # the fractional coordinates of Q are Q.a_i/2pi.
+    n_max = np.ceil(edges[-1] * np.linalg.norm(cell, axis=1) / (2 * np.pi)).astype(int)
+    G = np.stack(
+        np.meshgrid(*[np.arange(-n - 1, n + 2) for n in n_max], indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+
+    if not batch_size:
+        bytes_per_qpt = 16 * (3 * fc.crystal.n_atoms) ** 2
+        batch_size = max(1, BATCH_MEMORY // bytes_per_qpt)
+
+    # sums of the weighted intensities and of the weights, for the two halves of the G.
+    z_halves = np.zeros((2, n_shells, len(energy_bins) - 1))
+    w_halves = np.zeros((2, n_shells))
+    counts = np.zeros(n_shells, dtype=int)
+    z_unit = None
+    q_chunk = max(1, batch_size // len(G))
+    for start in range(0, modes.n_qpts, q_chunk):
+        iq = np.arange(start, min(modes.n_qpts, start + q_chunk))
+        Q_frac = modes.qpts[iq, np.newaxis, :] + G[np.newaxis, :, :]
+        mod_Q = np.linalg.norm(Q_frac @ recip, axis=-1)
+        shell = np.digitize(mod_Q, edges) - 1
+        q_index, G_index = np.nonzero((shell >= 0) & (shell < n_shells))
+
+        for b in range(0, len(q_index), batch_size):
+            sel_q = iq[q_index[b : b + batch_size]]
+            sel_G = G_index[b : b + batch_size]
+            sel_shell = shell[q_index[b : b + batch_size], sel_G]
+            unfolded = QpointPhononModes(
+                fc.crystal,
+                modes.qpts[sel_q] + G[sel_G],
+                modes.frequencies[sel_q],
+                modes.eigenvectors[sel_q],
+            )
+            sqw = calculate_sqw_map_series(
+                unfolded,
+                energy_bins,
+                temperature,
+                dws=[dw] if dw is not None else None,
+            )[0]
+            z_unit = sqw.units
+            half = sel_q % 2
+            w = weights[sel_q]
+            np.add.at(z_halves, (half, sel_shell), sqw.magnitude * w[:, np.newaxis])
+            np.add.at(w_halves, (half, sel_shell), w)
+            np.add.at(counts, sel_shell, 1)
+
+    if z_unit is None:
+        raise ValueError("No Q points of the grid in the |q| range.")
+
+    def normalised(z, w):
+        return np.divide(
+            z, w[:, np.newaxis], out=np.zeros_like(z), where=w[:, np.newaxis] > 0
+        )
+
+    z_data = normalised(z_halves.sum(axis=0), w_halves.sum(axis=0))
+    if report is not None:
+        z_1, z_2 = (normalised(z, w) for z, w in zip(z_halves, w_halves))
+        norm = np.linalg.norm(z_1 + z_2)
+        report.update(
+            {
+                "grid_convergence": float(np.linalg.norm(z_1 - z_2) / norm)
+                if norm
+                else 0.0,
+                "grid_irreducible_qpts": int(modes.n_qpts),
+                "grid_min_points_per_shell": int(counts.min()),
+            }
+        )
+    return [(row, z_unit, None) for row in z_data]
+
+
+########################
+################################ END grid engine
+########################
+
+
+########################
+################################ START parallel engine
+########################
+
+
+def share_force_constants(fc):
+    """Copy the arrays of a ForceConstants instance into shared memory blocks.
+
+    Returns:
+        blocks (list): the SharedMemory blocks, to be closed and unlinked by the caller
+            once the workers are done.
+        shared_fc (tuple): picklable description used by `attach_force_constants`
+            to rebuild the instance on top of the shared blocks.
+    """
+    blocks = []
+    state = {}
+    arrays = {}
+    for name, value in vars(fc).items():
+        if isinstance(value, np.ndarray) and value.nbytes >= SHARED_MEMORY_THRESHOLD:
+            block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+            np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+            blocks.append(block)
+            arrays[name] = (block.name, value.shape, value.dtype.str)
+        else:
+            state[name] = value
+    return blocks, (state, arrays)
+
+
+def attach_force_constants(shared_fc):
+    """Rebuild a ForceConstants instance whose arrays are views on the shared blocks.
+
+    Returns:
+        (ForceConstants, list): the instance and the attached blocks, which have to
+        be kept alive as long as the instance is used.
+    """
+    state, arrays = shared_fc
+    state = dict(state)
+    blocks = []
+    for name, (block_name, shape, dtype) in arrays.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        state[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    # we bypass the __init__, which would convert (i.e. copy) the force constants.
+    fc = ForceConstants.__new__(ForceConstants)
+    fc.__dict__.update(state)
+    return fc, blocks
+
+
+def _init_worker(shared_fc, energy_bins, options, dw, temperature):
+    fc, blocks = attach_force_constants(shared_fc)
+    _WORKER_STATE.update(
+        fc=fc,
+        blocks=blocks,
+        energy_bins=energy_bins[0] * ureg(energy_bins[1]),
+        options=options,
+        dw=dw,
+        temperature=temperature * ureg("K") if temperature is not None else None,
+    )
+
+
+def _sample_shell_in_worker(task):
+    q_index, mod_q, q_unit, npts = task
+    spectrum_1d = sample_shell(
+        _WORKER_STATE["fc"],
+        mod_q * ureg(q_unit),
+        npts,
+        _WORKER_STATE["energy_bins"],
+        _WORKER_STATE["options"],
+        dw=_WORKER_STATE["dw"],
+        temperature=_WORKER_STATE["temperature"],
+        q_index=q_index,
+    )
+    return (
+        spectrum_1d.y_data.magnitude,
+        str(spectrum_1d.y_data.units),
+        spectrum_1d.metadata.get("npts", npts),
+    )
+
+
+def _sample_shells_parallel(
+    fc,
+    shells,
+    energy_bins,
+    options,
+    dw=None,
+    temperature=None,
+    n_workers=None,
+):
+    # the thread budget of the execution policy is split among the workers.
+    n_threads = options["calc_modes_kwargs"].get("n_threads") or available_cpus()
+    if not n_workers:
+        n_workers = n_threads
+    n_workers = max(1, min(n_workers, len(shells)))
+    options = dict(
+        options,
+        calc_modes_kwargs=dict(
+            options["calc_modes_kwargs"], n_threads=max(1, n_threads // n_workers)
+        ),
+    )
+
+    # Quantities are passed as (magnitude, units): euphonic uses its own unit registry,
+    # which is not the one pint uses when unpickling.
+    tasks = [
+        (q_index, mod_q.magnitude, str(mod_q.units), npts)
+        for q_index, (mod_q, npts) in enumerate(shells)
+    ]
+    blocks, shared_fc = share_force_constants(fc)
+    initargs = (
+        shared_fc,
+        (energy_bins.magnitude, str(energy_bins.units)),
+        options,
+        dw,
+        temperature.to("K").magnitude if temperature is not None else None,
+    )
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=initargs,
+        ) as executor:
+            # the results come in order, as soon as each shell is done.
+            for row, units, npts in executor.map(
+                _sample_shell_in_worker,
+                tasks,
+                chunksize=max(1, len(tasks) // (4 * n_workers)),
+            ):
+                yield row, ureg(units).units, npts
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+########################
+################################ END parallel engine
+########################
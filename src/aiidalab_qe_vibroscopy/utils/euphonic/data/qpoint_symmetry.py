@@ -0,0 +1,199 @@
+"""Phonon modes on large sets of q-points, diagonalising only the symmetry-unique ones.
+
+The dynamical matrix used by euphonic has the phases of the cell origins, so D(q + G) = D(q):
+q-points which differ by a reciprocal lattice vector have the same modes. Moreover, for each
+operation {W|t} of the space group of the crystal (x -> Wx + t, in fractional coordinates),
+mapping the atom k to the atom g(k) plus the lattice vector L_k = W x_k + t - x_g(k),
+the modes at q' = W^-T q are
+
+    w(q') = w(q),    e_g(k)(q') = R e_k(q) exp(-2 pi i q'.L_k)
+
+with R the cartesian rotation. With the time reversal, the modes at -q are the complex conjugate
+ones. So, the q-points (e.g. the points of a Q-plane) are reduced to one representative per
+class of equivalent points, only these are diagonalised, and the modes are mapped back to all
+the q-points.
+
+Without the symmetry (calculate_qpoint_phonon_modes_zone_reduced), only the q-points equal up
+to a reciprocal lattice vector are merged: their modes are the same, and the structure factor
+takes the phases exp(iQ.r) of each Q anyway. E.g. a path through several Brillouin zones costs
+the same of one zone.
+"""
+
+import numpy as np
+import spglib
+from euphonic import QpointPhononModes
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import derived_cache
+from aiidalab_qe_vibroscopy.utils.euphonic.data.powder import SYMPREC
+
+# resolution of the fractional coordinates when comparing q-points.
+QPOINT_RESOLUTION = 10**6
+
+# number of q-points whose images are compared at once (bounds the memory).
+_CHUNK = 8192
+
+
+def space_group_operations(fc, symprec=SYMPREC):
+    """The operations of the space group of the crystal of `fc`.
+
+    Returns a dict with, for each operation: the fractional rotation "W", the cartesian one "R",
+    the atom permutation "permutation" (atom k goes to permutation[k]) and the lattice vectors
+    "shifts" (fractional, see the module docstring). Cached per force constants (see cache.py).
+    """
+    crystal = fc.crystal
+
+    def compute():
+        symmetry = spglib.get_symmetry(crystal.to_spglib_cell(), symprec=symprec)
+        rotations, translations = symmetry["rotations"], symmetry["translations"]
+        cell = crystal.cell_vectors.to("angstrom").magnitude
+        atom_r = crystal.atom_r
+
+        # images of the atoms, and the atoms they fall on.
+        images = np.einsum("oij,kj->oki", rotations, atom_r) + translations[:, None, :]
+        distance = images[:, :, None, :] - atom_r[None, None, :, :]
+        distance -= np.round(distance)
+        permutation = np.argmin(np.linalg.norm(distance, axis=-1), axis=-1)
+        shifts = np.round(images - atom_r[permutation]).astype(int)
+        return {
+            "W": rotations,
+            "R": np.einsum("ji,ojk,lk->oil", cell, rotations, np.linalg.inv(cell)),
+            "permutation": permutation,
+            "shifts": shifts,
+        }
+
+    return derived_cache(fc).get(("space_group", symprec), compute)
+
+
+def reduce_qpts(fc, qpts, symprec=SYMPREC):
+    """Reduce the (fractional) q-points to the classes of symmetry-equivalent ones.
+
+    Two q-points are equivalent if one is the image of the other under an operation of the
+    space group, possibly with the time reversal, up to a reciprocal lattice vector.
+
+    Returns:
+        irreducible (np.ndarray): the (n_irreducible, 3) representatives.
+        index (np.ndarray): the representative of each q-point (index in irreducible).
+        operation (np.ndarray): the operation mapping the representative to each q-point.
+        time_reversal (np.ndarray): whether the time reversal is needed too.
+    """
+    operations = space_group_operations(fc, symprec=symprec)
+    # the images of q are M q, with M = W^T (or -W^T with the time reversal). Only the
+    # distinct M matter (e.g. with the inversion, the time reversal gives nothing new).
+    n_operations = len(operations["W"])
+    transposed = operations["W"].transpose(0, 2, 1)
+    matrices, first = np.unique(
+        np.concatenate([transposed, -transposed]), axis=0, return_index=True
+    )
+
+    # 1. the points equal up to a reciprocal lattice vector.
+    reduced, translation_index = reduce_qpts_to_zone(qpts)
+
+    # 2. the key of a point is the smallest key of its images: equivalent points have the
+    # same key.
+    keys = np.empty(len(reduced), dtype=np.int64)
+    best = np.empty(len(reduced), dtype=int)
+    for start in range(0, len(reduced), _CHUNK):
+        image_keys = _qpoint_keys(
+            reduced[start : start + _CHUNK] @ matrices.transpose(0, 2, 1)
+        )
+        best[start : start + _CHUNK] = np.argmin(image_keys, axis=0)
+        keys[start : start + _CHUNK] = np.min(image_keys, axis=0)
+
+    _, first_point, index = np.unique(keys, return_index=True, return_inverse=True)
+    irreducible = np.einsum(
+        "qij,qj->qi", matrices[best[first_point]], reduced[first_point]
+    )
+
+    # q_irr = M q (+ G): with M = W^T, q is the image of q_irr under {W|t}.
+    best = first[best[translation_index]]
+    return (
+        irreducible,
+        index.ravel()[translation_index],
+        best % n_operations,
+        best >= n_operations,
+    )
+
+
+def reduce_qpts_to_zone(qpts):
+    """Reduce the (fractional) q-points to the ones unique up to a reciprocal lattice vector.
+
+    Returns:
+        unique (np.ndarray): the (n_unique, 3) q-points (the first of each class).
+        index (np.ndarray): the unique q-point of each q-point (index in unique).
+    """
+    _, first, index = np.unique(
+        _qpoint_keys(qpts), return_index=True, return_inverse=True
+    )
+    return qpts[first], index.ravel()
+
+
+def _qpoint_keys(qpts):
+    """Integer keys of the (fractional) q-points, equal for points equal up to a reciprocal
+    lattice vector (within 1/QPOINT_RESOLUTION)."""
+    n = QPOINT_RESOLUTION
+    digits = np.round(qpts * n).astype(np.int64) % n
+    return (digits[..., 0] * n + digits[..., 1]) * n + digits[..., 2]
+
+
+def calculate_qpoint_phonon_modes_reduced(fc, qpts, symprec=SYMPREC, **kwargs):
+    """Phonon modes at the (fractional) q-points, computed only at the irreducible ones.
+
+    Equivalent to fc.calculate_qpoint_phonon_modes(qpts, reduce_qpts=False, **kwargs),
+    up to the choice of the eigenvectors of degenerate modes (which does not change the
+    structure factors summed over the degenerate modes).
+    """
+    qpts = np.asarray(qpts, dtype=float)
+    irreducible, index, operation, time_reversal = reduce_qpts(
+        fc, qpts, symprec=symprec
+    )
+    irreducible_modes = fc.calculate_qpoint_phonon_modes(
+        irreducible, reduce_qpts=False, **kwargs
+    )
+    operations = space_group_operations(fc, symprec=symprec)
+
+    frequencies = irreducible_modes.frequencies
+    n_modes = frequencies.shape[1]
+    eigenvectors = np.empty(
+        (len(qpts),) + irreducible_modes.eigenvectors.shape[1:], dtype=complex
+    )
+    for o in np.unique(operation):
+        for reverse in (False, True):
+            selection = np.nonzero((operation == o) & (time_reversal == reverse))[0]
+            if not len(selection):
+                continue
+            vectors = irreducible_modes.eigenvectors[index[selection]]
+            if reverse:
+                vectors = vectors.conj()
+            vectors = np.einsum("ij,qmkj->qmki", operations["R"][o], vectors)
+            phases = np.exp(-2j * np.pi * qpts[selection] @ operations["shifts"][o].T)
+            eigenvectors[
+                selection[:, None, None],
+                np.arange(n_modes)[None, :, None],
+                operations["permutation"][o][None, None, :],
+            ] = vectors * phases[:, None, :, None]
+
+    return QpointPhononModes(
+        fc.crystal,
+        qpts,
+        frequencies.magnitude[index] * frequencies.units,
+        eigenvectors,
+    )
+
+
+def calculate_qpoint_phonon_modes_zone_reduced(fc, qpts, **kwargs):
+    """Phonon modes at the (fractional) q-points, computed only at the ones unique up to a
+    reciprocal lattice vector (see the module docstring).
+
+    Equivalent to fc.calculate_qpoint_phonon_modes(qpts, reduce_qpts=False, **kwargs),
+    up to the choice of the eigenvectors of degenerate modes.
+    """
+    qpts = np.asarray(qpts, dtype=float)
+    unique, index = reduce_qpts_to_zone(qpts)
+    unique_modes = fc.calculate_qpoint_phonon_modes(unique, reduce_qpts=False, **kwargs)
+    frequencies = unique_modes.frequencies
+    return QpointPhononModes(
+        fc.crystal,
+        qpts,
+        frequencies.magnitude[index] * frequencies.units,
+        unique_modes.eigenvectors[index],
+    )
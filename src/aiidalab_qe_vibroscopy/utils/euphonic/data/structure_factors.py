@@ -4,7 +4,6 @@ from typing import List, Optional
 import matplotlib.style
 import numpy as np
 import copy
-import seekpath
 from math import ceil
 
 """"
@@ -16,34 +15,72 @@ import euphonic.plot
 from euphonic.util import get_qpoint_labels
 from euphonic.styles import base_style
 from euphonic.cli.utils import (
-    _bands_from_force_constants,
     _calc_modes_kwargs,
     _compose_style,
     _plot_label_kwargs,
-    _get_debye_waller,
+    _get_break_points,
     _get_energy_bins,
     _get_q_distance,
+    _get_tick_labels,
+    _insert_gamma,
     matplotlib_save_or_show,
 )
 
-from euphonic.cli.utils import (
-    _get_pdos_weighting,
-    _arrange_pdos_groups,
-)
-from euphonic.powder import (
-    sample_sphere_dos,
-    sample_sphere_pdos,
-    sample_sphere_structure_factor,
-)
 from euphonic.spectra import apply_kinematic_constraints
 from euphonic.styles import intensity_widget_style
 import euphonic.util
+import seekpath
 
 
 from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
     parameters_single_crystal,
     parameters_powder,
 )
+from aiidalab_qe_vibroscopy.utils.euphonic.data.powder import iter_sample_shells
+from aiidalab_qe_vibroscopy.utils.euphonic.data.kernels import (
+    bin_mode_intensities,
+    calculate_sqw_map_series,
+    energy_cuts,
+    energy_window_intensities,
+    mode_intensities,
+    partial_groups,
+    partial_labels,
+    partial_mode_intensities,
+    precision_dtypes,
+    real_dtype,
+    structure_factor_memory,
+    with_precision,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import (
+    StageCache,
+    derived_cache,
+    get_debye_waller,
+    get_explicit_k_path,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.disk_cache import (
+    spectra_from_arrays,
+    spectra_to_arrays,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.qpoint_symmetry import (
+    calculate_qpoint_phonon_modes_reduced,
+    calculate_qpoint_phonon_modes_zone_reduced,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.mode_list import ModeList
+from aiidalab_qe_vibroscopy.utils.euphonic.data.interpolation import (
+    PREVIEW_CHECK_POINTS,
+    PREVIEW_COARSENING,
+    adaptive_path_modes,
+    check_path_indices,
+    coarse_path_indices,
+    interpolate_mode_intensities,
+    interpolation_errors,
+    path_segments,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.execution import (
+    get_execution_policy,
+    memory_chunk_size,
+    uses_execution_policy,
+)
 
 # Dummy tqdm function if tqdm progress bars unavailable
 try:
@@ -59,16 +96,32 @@ except ModuleNotFoundError:
 
 import sys
 import os
+import threading
+
+# the stream replaced by blockPrint, and the (single) devnull stream replacing it.
+_STDOUT = {"saved": None, "devnull": None}
 
 
 # Disable
 def blockPrint():
-    sys.stdout = open(os.devnull, "w")
+    # sys.stdout is global to the process: it is only swapped from the main thread, so a
+    # calculation in a worker thread (e.g. the exact map after a preview) does not silence
+    # the output of the main one.
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if _STDOUT["devnull"] is None:
+        _STDOUT["devnull"] = open(os.devnull, "w")
+    if sys.stdout is not _STDOUT["devnull"]:
+        _STDOUT["saved"] = sys.stdout
+        sys.stdout = _STDOUT["devnull"]
 
 
 # Restore
 def enablePrint():
-    sys.stdout = sys.__stdout__
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if sys.stdout is _STDOUT["devnull"]:
+        sys.stdout = _STDOUT["saved"] or sys.__stdout__
 
 
 class AttrDict(dict):
@@ -178,11 +231,14 @@ def join_q_paths(coordinates: list, labels: list, delta_q=0.1, G=[0, 0, 0]):
 ########################
 
 
+@uses_execution_policy
 def produce_bands_weigthed_data(
     params: Optional[List[str]] = None,
     fc: ForceConstants = None,
     linear_path=None,
     plot=False,
+    cache=None,
+    disk_cache=None,
 ) -> None:
     blockPrint()
     """
@@ -197,6 +253,24 @@ def produce_bands_weigthed_data(
         'labels' : ["$\Gamma$","X","X","(1,1,1)"],
         'delta_q':0.1, # A^-1
     }
+
+    cache is a StageCache (see cache.py) used to memoise the stages of the calculation across
+    calls, e.g. the model keeps one to replot quickly when only downstream parameters change.
+    disk_cache is a SpectrumDiskCache (see disk_cache.py): if given, the spectra are looked up
+    there (and stored after the calculation), to be shared across sessions.
+
+    If the temperatures parameter is a list of temperatures (K), a temperature series is computed
+    (coherent weighting only) and a list of spectra, one per temperature, is returned.
+    See produce_temperature_series.
+
+    If the partials parameter is "species" or "atoms" (coherent weighting, single temperature),
+    a list of partial maps is returned instead, one per group of atoms and per cross term
+    between two groups (if partial_cross_terms), computed in one pass over the eigenvectors:
+    their metadata["partial"] are the groups of each map (see kernels.partial_mode_intensities).
+    All of them add up to the total map.
+
+    If the precision parameter is "single", the eigenvectors, the structure factors and the
+    maps are computed and stored in single precision (see kernels.py for the error bounds).
     """
     # args = get_args(get_parser(), params)
     if not params:
@@ -204,8 +278,24 @@ def produce_bands_weigthed_data(
     else:
         args = AttrDict(params)
 
+    if disk_cache is not None and not plot and isinstance(fc, ForceConstants):
+        spectra = disk_cache.get(
+            disk_cache.key("single_crystal", fc, args, linear_path=linear_path),
+            lambda: produce_bands_weigthed_data(
+                params=params, fc=fc, linear_path=linear_path, cache=cache
+            )[0],
+            spectra_to_arrays,
+            spectra_from_arrays,
+            kind="single_crystal",
+        )
+        enablePrint()
+        return spectra, copy.deepcopy(params)
+
     # redundancy with args...
     calc_modes_kwargs = _calc_modes_kwargs(args)
+    calc_modes_kwargs["n_threads"] = get_execution_policy(args.get("n_threads"))[
+        "n_threads"
+    ]
 
     frequencies_only = args.weighting != "coherent"
     """data = load_data_from_file(args.filename, verbose=True,
@@ -223,53 +313,109 @@ def produce_bands_weigthed_data(
                 'the Debye-Waller factor. Leave "--temperature" '
                 "unset if plotting precalculated phonon modes."
             )
+    temperatures = args.get("temperatures")
+    if temperatures and (
+        args.weighting.lower() != "coherent" or not isinstance(data, ForceConstants)
+    ):
+        raise TypeError(
+            "A temperature series requires the coherent weighting and force constants data."
+        )
+    if args.get("partials") and (args.weighting.lower() != "coherent" or temperatures):
+        raise ValueError(
+            "The partial maps are only available for the coherent weighting, "
+            "at a single temperature."
+        )
 
     q_spacing = _get_q_distance(args.length_unit, args.q_spacing)
     recip_length_unit = q_spacing.units
 
-    if isinstance(data, ForceConstants):
-        # print("Getting band path...")
-        # HERE we add the custom path generation:
-        if linear_path:
-            # 1. get the rl_norm list for conversion delta_q ==> Nq in the join_q_paths
-            structure = fc.crystal.to_spglib_cell()
-            bandpath = seekpath.get_explicit_k_path(structure)
-
-            rl = bandpath["reciprocal_primitive_lattice"]
-            rl_norm = []
-            for G in range(3):
-                rl_norm.append(np.linalg.norm(np.array(rl[G])))
-
-            # 2. compute the path via delta_q
-            (qpts, x_tick_labels, split_args) = join_q_paths(
-                coordinates=linear_path["coordinates"],
-                labels=linear_path["labels"],
-                delta_q=linear_path["delta_q"],
-                G=rl_norm,
-            )
-
-            # 3. compute the corresponding phonons
-            modes = fc.calculate_qpoint_phonon_modes(
-                qpts,
-                reduce_qpts=False,
-                **calc_modes_kwargs,
+    # The pipeline is split in stages (modes -> mode list -> binning -> broadening),
+    # each memoised in the cache with the subset of parameters it depends on: changing
+    # a downstream parameter (e.g. the broadening) does not rerun the upstream stages.
+    if cache is None:
+        cache = StageCache()
+
+    def compute_modes():
+        path_indices = None
+        if isinstance(data, ForceConstants):
+            # print("Getting band path...")
+            # HERE we add the custom path generation:
+            qpts, x_tick_labels, split_args = _path_qpts(fc, args, linear_path)
+            # check that the path fits in the memory budget before diagonalising (only
+            # the frequencies are computed on the seekpath path for the DOS weighting;
+            # euphonic diagonalises in double precision).
+            _path_chunk_size(
+                len(qpts),
+                fc.crystal,
+                args,
+                eigenvectors=not frequencies_only
+                or bool(linear_path or args.get("path_tolerance")),
+                precision="double",
             )
-
+            if args.get("path_tolerance"):
+                # adaptive density of q-points: only a subset of the points of the path
+                # is computed (see interpolation.py); path_indices are their indices.
+                modes, path_indices = adaptive_path_modes(
+                    fc, qpts, args.path_tolerance, **calc_modes_kwargs
+                )
+                x_tick_labels = [
+                    (int(np.searchsorted(path_indices, i)), label)
+                    for i, label in x_tick_labels
+                ]
+                split_args = {
+                    "indices": [
+                        int(np.searchsorted(path_indices, i))
+                        for i in split_args["indices"]
+                    ]
+                }
+            elif linear_path:
+                # 3. compute the corresponding phonons (only once for the q-points
+                # equal up to a reciprocal lattice vector, see qpoint_symmetry.py).
+                if args.get("zone_reduction", True):
+                    modes = calculate_qpoint_phonon_modes_zone_reduced(
+                        fc, qpts, **calc_modes_kwargs
+                    )
+                else:
+                    modes = fc.calculate_qpoint_phonon_modes(
+                        qpts,
+                        reduce_qpts=False,
+                        **calc_modes_kwargs,
+                    )
+
+            elif frequencies_only:
+                # seekpath path (qpts from _path_qpts, as _bands_from_force_constants).
+                modes = fc.calculate_qpoint_frequencies(
+                    qpts, reduce_qpts=False, **calc_modes_kwargs
+                )
+            else:
+                modes = fc.calculate_qpoint_phonon_modes(
+                    qpts, reduce_qpts=False, **calc_modes_kwargs
+                )
         else:
-            # Use seekpath.
-            (modes, x_tick_labels, split_args) = _bands_from_force_constants(
-                data,
-                q_distance=q_spacing,
-                # insert_gamma=False,
-                insert_gamma=True,
-                frequencies_only=frequencies_only,
-                **calc_modes_kwargs,
+            modes = data
+            x_tick_labels = get_qpoint_labels(
+                modes.qpts, cell=modes.crystal.to_spglib_cell()
             )
-    else:
-        modes = data
-        x_tick_labels = get_qpoint_labels(
-            modes.qpts, cell=modes.crystal.to_spglib_cell()
-        )
+            split_args = None
+        # (the eigenvectors in the precision of the parameters, see kernels.py.)
+        modes = with_precision(modes, args.get("precision", "double"))
+        return modes, x_tick_labels, split_args, path_indices
+
+    modes_key = (
+        data,
+        linear_path,
+        frequencies_only,
+        args.q_spacing,
+        args.length_unit,
+        args.asr,
+        args.dipole_parameter,
+        args.get("zone_reduction", True),
+        args.get("path_tolerance"),
+        args.get("precision", "double"),
+    )
+    modes, x_tick_labels, split_args, path_indices = cache.get(
+        "modes", modes_key, compute_modes
+    )
 
     # duplication from euphonic/cli/utils.py
     if args.e_min is None:
@@ -290,35 +436,141 @@ def produce_bands_weigthed_data(
 
     # print("Computing intensities and generating 2D maps")
 
-    if args.weighting.lower() == "coherent":
-        if args.temperature is not None:
-            temperature = args.temperature * ureg("K")
-            dw = _get_debye_waller(
+    def compute_debye_waller():
+        if args.temperature is None:
+            return None
+        return get_debye_waller(
+            args.temperature * ureg("K"),
+            data,
+            grid=args.grid,
+            grid_spacing=(args.grid_spacing * recip_length_unit),
+            **calc_modes_kwargs,
+        )
+
+    def compute_mode_list():
+        # the per-mode intensities (structure factor and Bose factor), computed in chunks
+        # of q-points within the memory budget (see kernels.py); all the maps from one
+        # pass over the eigenvectors for the partial maps.
+        chunk_size = _path_chunk_size(modes.n_qpts, modes.crystal, args)
+        if args.get("partials"):
+            intensities = partial_mode_intensities(
+                modes,
+                partial_groups(modes.crystal, args.partials),
+                dw=compute_debye_waller(),
+                cross_terms=args.get("partial_cross_terms", True),
+                chunk_size=chunk_size,
+            )
+        else:
+            intensities = mode_intensities(
+                modes, dw=compute_debye_waller(), chunk_size=chunk_size
+            )
+        mode_list = ModeList.from_mode_intensities(
+            intensities, str(modes.frequencies.units)
+        )
+        return mode_list, intensities.get("partials")
+
+    def compute_partials():
+        mode_list, partials = cache.get("mode_list", mode_list_key, compute_mode_list)
+        x_data, qpt_labels = modes._get_qpt_axis_and_labels()
+        return [
+            euphonic.Spectrum2D(
+                x_data,
+                ebins,
+                z_data,
+                x_tick_labels=qpt_labels,
+                metadata={"partial": partial},
+            )
+            for z_data, partial in zip(mode_list.bin(ebins), partials)
+        ]
+
+    def compute_temperature_series():
+        # the temperature-independent parts are computed once for all the temperatures
+        # (see kernels.py); the grid modes of the Debye-Waller factors are cached (cache.py).
+        temps = np.array(temperatures, dtype=float) * ureg("K")
+        dws = [
+            get_debye_waller(
                 temperature,
                 data,
                 grid=args.grid,
                 grid_spacing=(args.grid_spacing * recip_length_unit),
                 **calc_modes_kwargs,
             )
-        else:
-            dw = None
-
-        spectrum = modes.calculate_structure_factor(dw=dw).calculate_sqw_map(ebins)
+            for temperature in temps
+        ]
+        z_data = calculate_sqw_map_series(
+            modes,
+            ebins,
+            temps,
+            dws=dws,
+            chunk_size=_path_chunk_size(modes.n_qpts, modes.crystal, args),
+        )
+        x_data, qpt_labels = modes._get_qpt_axis_and_labels()
+        return [
+            euphonic.Spectrum2D(x_data, ebins, z, x_tick_labels=qpt_labels)
+            for z in z_data
+        ]
+
+    def compute_binning():
+        return _store_precision(compute_maps(), args.get("precision", "double"))
+
+    def compute_maps():
+        if temperatures:
+            return compute_temperature_series()
+        elif args.get("partials"):
+            return compute_partials()
+        elif args.weighting.lower() == "coherent":
+            # only binned here: a new number of bins, energy range or energy unit does
+            # not recompute the structure factors (see mode_list.py).
+            mode_list, _ = cache.get("mode_list", mode_list_key, compute_mode_list)
+            x_data, qpt_labels = modes._get_qpt_axis_and_labels()
+            return euphonic.Spectrum2D(
+                x_data, ebins, mode_list.bin(ebins), x_tick_labels=qpt_labels
+            )
+        elif args.weighting.lower() == "dos":
+            return modes.calculate_dos_map(ebins)
 
-    elif args.weighting.lower() == "dos":
-        spectrum = modes.calculate_dos_map(ebins)
+    def compute_broadening():
+        spectrum = cache.get("binning", binning_key, compute_binning)
+        if isinstance(spectrum, list):
+            spectrum = [_broaden_path_spectrum(s, args) for s in spectrum]
+        else:
+            spectrum = _broaden_path_spectrum(spectrum, args)
+        return _store_precision(spectrum, args.get("precision", "double"))
 
-    if args.q_broadening or args.energy_broadening:
-        spectrum = spectrum.broaden(
-            x_width=(
-                args.q_broadening * recip_length_unit if args.q_broadening else None
-            ),
-            y_width=(
-                args.energy_broadening * ebins.units if args.energy_broadening else None
-            ),
-            shape=args.shape,
-            method="convolve",
-        )
+    structure_factor_key = modes_key + (
+        args.temperature,
+        args.grid,
+        args.grid_spacing,
+    )
+    mode_list_key = structure_factor_key + (
+        args.get("partials"),
+        args.get("partial_cross_terms", True),
+    )
+    binning_key = mode_list_key + (
+        temperatures,
+        args.weighting,
+        args.energy_unit,
+        args.ebins,
+        args.e_min,
+        args.e_max,
+    )
+    broadening_key = binning_key + (
+        args.q_broadening,
+        args.energy_broadening,
+        args.shape,
+    )
+    spectrum = cache.get("broadening", broadening_key, compute_broadening)
+    if path_indices is not None:
+        # the position of each point of the map on the (uniform) path, for the plots.
+        for s in spectrum if isinstance(spectrum, list) else [spectrum]:
+            s.metadata["path_indices"] = path_indices.tolist()
+
+    if isinstance(spectrum, list):
+        for s in spectrum:
+            if x_tick_labels:
+                s.x_tick_labels = x_tick_labels
+        enablePrint()
+        return spectrum, copy.deepcopy(params)
 
     # print("Plotting figure")
     plot_label_kwargs = _plot_label_kwargs(
@@ -350,176 +602,291 @@ def produce_bands_weigthed_data(
     return spectra, copy.deepcopy(params)
 
 
-########################
-################################ START POWDER
-########################
+def _path_qpts(fc, args, linear_path=None):
+    """The q-points of the path (custom if linear_path is given, seekpath otherwise),
+    with the x tick labels and the split arguments, without computing the modes."""
+    if linear_path:
+        # 1. get the rl_norm list for conversion delta_q ==> Nq in the join_q_paths
+        bandpath = get_explicit_k_path(fc)
+
+        rl = bandpath["reciprocal_primitive_lattice"]
+        rl_norm = []
+        for G in range(3):
+            rl_norm.append(np.linalg.norm(np.array(rl[G])))
+
+        # 2. compute the path via delta_q
+        return join_q_paths(
+            coordinates=linear_path["coordinates"],
+            labels=linear_path["labels"],
+            delta_q=linear_path["delta_q"],
+            G=rl_norm,
+        )
 
+    # as in euphonic.cli.utils._bands_from_force_constants (with insert_gamma=True),
+    # memoised per force constants and q spacing.
+    reference_distance = float(
+        _get_q_distance(args.length_unit, args.q_spacing).to("1 / angstrom").magnitude
+    )
 
-# parameters_powder = AttrDict(par_dict_powder)
+    def compute():
+        bandpath = seekpath.get_explicit_k_path(
+            fc.crystal.to_spglib_cell(), reference_distance=reference_distance
+        )
+        _insert_gamma(bandpath)
+        return (
+            bandpath["explicit_kpoints_rel"],
+            _get_tick_labels(bandpath),
+            _get_break_points(bandpath),
+        )
 
+    qpts, x_tick_labels, break_points = derived_cache(fc).get(
+        ("seekpath_qpts", reference_distance), compute
+    )
+    return qpts, list(x_tick_labels), {"indices": list(break_points)}
+
+
+def _path_chunk_size(n_qpts, crystal, args, eigenvectors=True, precision=None):
+    """The number of q-points of the path whose structure factors are computed at once,
+    within the memory budget (raises MemoryBudgetError if the path does not fit). The
+    precision is the one of the parameters if not given."""
+    n_maps = 1
+    if args.get("temperatures"):
+        n_maps = len(args.temperatures)
+    elif args.get("partials"):
+        n_groups = len(partial_groups(crystal, args.partials))
+        n_maps = (
+            n_groups * (n_groups + 1) // 2
+            if args.get("partial_cross_terms", True)
+            else n_groups
+        )
+    held, per_qpt = structure_factor_memory(
+        n_qpts,
+        crystal.n_atoms,
+        args.ebins,
+        n_maps=n_maps,
+        eigenvectors=eigenvectors,
+        precision=precision or args.get("precision", "double"),
+    )
+    return memory_chunk_size(held, per_qpt, n_qpts, args.get("memory_budget"))
 
-def produce_powder_data(
+
+def _store_precision(spectrum, precision="double"):
+    """Store the map of the spectrum (or of each spectrum of a list) in the given precision:
+    euphonic creates (and broadens) the maps in double precision."""
+    real, _ = precision_dtypes(precision)
+    for s in spectrum if isinstance(spectrum, list) else [spectrum]:
+        if s.z_data.dtype != real:
+            s.z_data = s.z_data.astype(real)
+    return spectrum
+
+
+def _broaden_path_spectrum(spectrum, args):
+    """Apply the q and energy broadening of the parameters to a map along a path."""
+    if args.q_broadening or args.energy_broadening:
+        recip_length_unit = _get_q_distance(args.length_unit, args.q_spacing).units
+        spectrum = spectrum.broaden(
+            x_width=(
+                args.q_broadening * recip_length_unit if args.q_broadening else None
+            ),
+            y_width=(
+                args.energy_broadening * spectrum.y_data.units
+                if args.energy_broadening
+                else None
+            ),
+            shape=args.shape,
+            method="convolve",
+        )
+    return spectrum
+
+
+@uses_execution_policy
+def produce_bands_preview(
     params: Optional[List[str]] = None,
     fc: ForceConstants = None,
-    plot=False,
     linear_path=None,
-) -> None:
-    blockPrint()
-    """Read the description of the produce_bands_weigthed_data function for more details.
-    """
+    cache=None,
+    coarsening=PREVIEW_COARSENING,
+    n_check=PREVIEW_CHECK_POINTS,
+):
+    """Fast, interpolated, preview of produce_bands_weigthed_data (see interpolation.py).
 
+    The modes are computed only every `coarsening` points of the path, and at `n_check`
+    check points where the error of the interpolation is estimated. The temperature series
+    is not previewed (the map is at the temperature parameter).
+
+    Returns:
+        the Spectrum2D, with the error estimate in the metadata (preview_qpts: the number
+        of computed q-points; preview_frequency_error, in the energy units;
+        preview_intensity_error, relative), and the parameters.
+    """
+    blockPrint()
     if not params:
-        args = AttrDict(copy.deepcopy(parameters_powder))
+        args = AttrDict(copy.deepcopy(parameters_single_crystal))
     else:
         args = AttrDict(params)
-
-    # redundancy with args
     calc_modes_kwargs = _calc_modes_kwargs(args)
-
-    # Make sure we get an error if accessing NPTS inappropriately
-    if args.npts_density is not None:
-        args.npts = None
-
-    """fc = load_data_from_file(args.filename, verbose=True)"""
-
-    if not isinstance(fc, ForceConstants):
-        raise TypeError(
-            "Force constants are required to use the " "euphonic-powder-map tool"
+    calc_modes_kwargs["n_threads"] = get_execution_policy(args.get("n_threads"))[
+        "n_threads"
+    ]
+    if cache is None:
+        cache = StageCache()
+
+    qpts, x_tick_labels, split_args = _path_qpts(fc, args, linear_path)
+    coarse = coarse_path_indices(path_segments(qpts), coarsening)
+    checks = check_path_indices(coarse, len(qpts), qpts, n_check)
+
+    def compute_modes():
+        return calculate_qpoint_phonon_modes_zone_reduced(
+            fc, qpts[np.concatenate([coarse, checks])], **calc_modes_kwargs
         )
-    if args.pdos is not None and args.weighting == "coherent":
-        raise ValueError(
-            '"--pdos" is only compatible with ' '"--weighting" options that include dos'
-        )
-    # print("Setting up dimensions...")
 
-    q_min = _get_q_distance(args.length_unit, args.q_min)
-    q_max = _get_q_distance(args.length_unit, args.q_max)
-    recip_length_unit = q_min.units
+    preview_key = (
+        fc,
+        linear_path,
+        args.q_spacing,
+        args.length_unit,
+        args.asr,
+        args.dipole_parameter,
+        coarsening,
+        n_check,
+    )
+    modes = cache.get("preview", preview_key, compute_modes)
+    modes.frequencies_unit = args.energy_unit
 
-    n_q_bins = ceil((args.q_max - args.q_min) / args.q_spacing)
-    q_bin_edges = (
-        np.linspace(q_min.magnitude, q_max.magnitude, n_q_bins + 1, endpoint=True)
-        * recip_length_unit
+    dw = None
+    if args.weighting.lower() == "coherent" and args.temperature is not None:
+        recip_length_unit = _get_q_distance(args.length_unit, args.q_spacing).units
+        dw = get_debye_waller(
+            args.temperature * ureg("K"),
+            fc,
+            grid=args.grid,
+            grid_spacing=(args.grid_spacing * recip_length_unit),
+            **calc_modes_kwargs,
+        )
+    intensities = mode_intensities(modes, dw=dw, weighting=args.weighting.lower())
+    coarse_intensities, check_intensities = (
+        {
+            name: value[selection] if name != "units" else value
+            for name, value in intensities.items()
+        }
+        for selection in (slice(0, len(coarse)), slice(len(coarse), None))
+    )
+    path_intensities = interpolate_mode_intensities(
+        coarse_intensities, modes.eigenvectors[: len(coarse)], coarse, len(qpts)
     )
-    q_bin_centers = (q_bin_edges[:-1] + q_bin_edges[1:]) / 2
 
-    # Use X-point modes to estimate frequency range, set up energy bins
-    # (Not Gamma in case there are only 3 branches; value would be zero!)
-    modes = fc.calculate_qpoint_frequencies(
-        np.array([[0.0, 0.0, 0.5]]),
-        **calc_modes_kwargs,
+    frequencies = QpointFrequencies(
+        fc.crystal,
+        qpts,
+        path_intensities["frequencies"] * modes.frequencies.units,
     )
-    modes.frequencies_unit = args.energy_unit
+    e_min, e_max = args.e_min, args.e_max
+    if e_min is None:
+        # as in produce_bands_weigthed_data.
+        emin_room = 1e-5 * ureg("meV").to(modes.frequencies.units).magnitude
+        e_min = min(np.min(frequencies.frequencies.magnitude - emin_room), 0.0)
+    if e_max is None:
+        e_max = np.max(frequencies.frequencies.magnitude) * 1.05
+    ebins = _get_energy_bins(frequencies, args.ebins + 1, emin=e_min, emax=e_max)
+
+    z_data = bin_mode_intensities(path_intensities, ebins.magnitude)
+    frequency_error, intensity_error = interpolation_errors(
+        check_intensities,
+        {
+            name: value[checks] if name != "units" else value
+            for name, value in path_intensities.items()
+        },
+        ebins.magnitude,
+        broadening=args.energy_broadening,
+    )
+    x_data, _ = frequencies._get_qpt_axis_and_labels()
+    spectrum = euphonic.Spectrum2D(
+        x_data,
+        ebins,
+        z_data * (ureg(path_intensities["units"]) / ebins.units),
+        x_tick_labels=x_tick_labels,
+        metadata={
+            "preview_qpts": len(coarse) + len(checks),
+            "preview_frequency_error": frequency_error,
+            "preview_intensity_error": intensity_error,
+        },
+    )
+    spectrum = _broaden_path_spectrum(spectrum, args)
+    enablePrint()
+    return spectrum, copy.deepcopy(params)
 
-    if args.e_i is not None and args.e_max is None:
-        emax = args.e_i
-    else:
-        emax = args.e_max
 
-    energy_bins = _get_energy_bins(
-        modes, args.ebins + 1, emin=args.e_min, emax=emax, headroom=1.2
-    )  # Generous headroom as we only checked one q-point
+def produce_temperature_series(
+    params: Optional[List[str]] = None,
+    fc: ForceConstants = None,
+    temperatures=None,
+    linear_path=None,
+    cache=None,
+):
+    """S(Q,w) maps along the path for several temperatures (in K).
 
-    if args.weighting in ("coherent",):
-        # Compute Debye-Waller factor once for re-use at each mod(q)
-        # (If temperature is not set, this will be None.)
-        if args.temperature is not None:
-            temperature = args.temperature * ureg("K")
-            dw = _get_debye_waller(
-                temperature,
-                fc,
-                grid=args.grid,
-                grid_spacing=(args.grid_spacing * recip_length_unit),
-                **calc_modes_kwargs,
-            )
-        else:
-            temperature = None
-            dw = None
+    The eigenvectors, the temperature-independent part of the structure factor and the grid
+    modes of the Debye-Waller factor are computed once; the Debye-Waller exponents and the
+    Bose occupations are applied to all the temperatures in one pass (see kernels.py).
+    The other parameters are as in produce_bands_weigthed_data (the temperature one is ignored).
 
-    # print(f"Sampling {n_q_bins} |q| shells between {q_min:~P} and {q_max:~P}")
+    Returns:
+        the stacked (T, q, E) intensities (Quantity), the list of Spectrum2D and the parameters.
+    """
+    if not params:
+        params = copy.deepcopy(parameters_single_crystal)
+    params = dict(params, temperatures=list(temperatures), weighting="coherent")
+    spectra, parameters = produce_bands_weigthed_data(
+        params=params, fc=fc, linear_path=linear_path, cache=cache
+    )
+    z_data = np.stack([s.z_data.magnitude for s in spectra]) * spectra[0].z_data.units
+    return z_data, spectra, parameters
 
-    z_data = np.empty((n_q_bins, len(energy_bins) - 1))
 
-    # for q_index in tqdm(range(n_q_bins)):
-    for q_index in range(n_q_bins):
-        q = q_bin_centers[q_index]
+########################
+################################ START POWDER
+########################
 
-        if args.npts_density is not None:
-            npts = ceil(args.npts_density * (q / recip_length_unit) ** 2)
-            npts = max(args.npts_min, min(args.npts_max, npts))
-        else:
-            npts = args.npts
-
-        if args.weighting == "dos" and args.pdos is None:
-            spectrum_1d = sample_sphere_dos(
-                fc,
-                q,
-                npts=npts,
-                sampling=args.sampling,
-                jitter=args.jitter,
-                energy_bins=energy_bins,
-                **calc_modes_kwargs,
-            )
-        elif "dos" in args.weighting:
-            spectrum_1d_col = sample_sphere_pdos(
-                fc,
-                q,
-                npts=npts,
-                sampling=args.sampling,
-                jitter=args.jitter,
-                energy_bins=energy_bins,
-                weighting=_get_pdos_weighting(args.weighting),
-                **calc_modes_kwargs,
-            )
-            spectrum_1d = _arrange_pdos_groups(spectrum_1d_col, args.pdos)
-        elif args.weighting == "coherent":
-            spectrum_1d = sample_sphere_structure_factor(
-                fc,
-                q,
-                dw=dw,
-                temperature=temperature,
-                sampling=args.sampling,
-                jitter=args.jitter,
-                npts=npts,
-                energy_bins=energy_bins,
-                **calc_modes_kwargs,
-            )
 
-        z_data[q_index, :] = spectrum_1d.y_data.magnitude
+# parameters_powder = AttrDict(par_dict_powder)
 
-    # print(f"Final npts: {npts}")
 
-    spectrum = euphonic.Spectrum2D(
-        q_bin_edges, energy_bins, z_data * spectrum_1d.y_data.units
-    )
+@uses_execution_policy
+def produce_powder_data(
+    params: Optional[List[str]] = None,
+    fc: ForceConstants = None,
+    plot=False,
+    linear_path=None,
+    cache=None,
+    disk_cache=None,
+) -> None:
+    blockPrint()
+    """Read the description of the produce_bands_weigthed_data function for more details.
 
-    if args.q_broadening or args.energy_broadening:
-        spectrum = spectrum.broaden(
-            x_width=(
-                args.q_broadening * recip_length_unit if args.q_broadening else None
-            ),
-            y_width=(
-                args.energy_broadening * energy_bins.units
-                if args.energy_broadening
-                else None
-            ),
-            shape=args.shape,
-        )
+    The map is computed by stream_powder_data; this only collects its final result (and plots it).
+    """
 
-    if not (args.e_i is None and args.e_f is None):
-        # print("Applying kinematic constraints")
-        energy_unit = args.energy_unit
-        e_i = args.e_i * ureg(energy_unit) if (args.e_i is not None) else None
-        e_f = args.e_f * ureg(energy_unit) if (args.e_f is not None) else None
-        spectrum = apply_kinematic_constraints(
-            spectrum, e_i=e_i, e_f=e_f, angle_range=args.angle_range
-        )
+    if not params:
+        args = AttrDict(copy.deepcopy(parameters_powder))
+    else:
+        args = AttrDict(params)
+
+    for spectrum, _ in stream_powder_data(
+        params=params,
+        fc=fc,
+        cache=cache,
+        disk_cache=None if plot else disk_cache,
+    ):
+        pass
+    if isinstance(spectrum, list):  # partial maps, not plotted
+        return spectrum, copy.deepcopy(params)
+    blockPrint()
 
     # print(f"Plotting figure: max intensity "
     # f"{np.nanmax(spectrum.z_data.magnitude) * spectrum.z_data.units:~P}")
     plot_label_kwargs = _plot_label_kwargs(
         args,
-        default_xlabel=f"|q| / {q_min.units:~P}",
+        default_xlabel=f"|q| / {spectrum.x_data.units:~P}",
         default_ylabel=f"Energy / {spectrum.y_data.units:~P}",
     )
 
@@ -579,6 +946,294 @@ def produce_powder_data(
     matplotlib_save_or_show(save_filename=args.save_to)
 
 
+@uses_execution_policy
+def stream_powder_data(
+    params: Optional[List[str]] = None,
+    fc: ForceConstants = None,
+    cache=None,
+    disk_cache=None,
+):
+    """Generator version of produce_powder_data (without plotting), to show the map while it is computed.
+
+    Yields (spectrum, q_index): each time a |q| shell is sampled, the Spectrum2D filled so far
+    (NaN for the shells not sampled yet, no broadening) and the index of the new shell.
+    The last item is the final spectrum (broadening and kinematic constraints applied,
+    the same returned by produce_powder_data) with q_index None. If the map is already
+    in the cache or in the disk cache, this is the only item.
+    """
+    if not params:
+        args = AttrDict(copy.deepcopy(parameters_powder))
+    else:
+        args = AttrDict(params)
+
+    disk_key = None
+    if disk_cache is not None and isinstance(fc, ForceConstants):
+        disk_key = disk_cache.key("powder", fc, args)
+        cached = disk_cache.load(disk_key)
+        if cached is not None:
+            yield spectra_from_arrays(*cached), None
+            return
+
+    blockPrint()
+    try:
+        spectrum = yield from _stream_powder_spectrum(args, fc, cache)
+    finally:
+        enablePrint()
+
+    if disk_key is not None:
+        disk_cache.store(disk_key, *spectra_to_arrays(spectrum), kind="powder")
+    yield spectrum, None
+
+
+def _stream_powder_spectrum(args, fc, cache=None):
+    """Body of stream_powder_data: yields the partial maps, returns the final spectrum.
+
+    Prints are blocked while computing, and enabled while the caller handles the yielded items.
+    """
+    # redundancy with args
+    calc_modes_kwargs = _calc_modes_kwargs(args)
+    calc_modes_kwargs["n_threads"] = get_execution_policy(args.get("n_threads"))[
+        "n_threads"
+    ]
+
+    # Make sure we get an error if accessing NPTS inappropriately
+    if args.npts_density is not None:
+        args.npts = None
+
+    """fc = load_data_from_file(args.filename, verbose=True)"""
+
+    if not isinstance(fc, ForceConstants):
+        raise TypeError(
+            "Force constants are required to use the " "euphonic-powder-map tool"
+        )
+    if args.pdos is not None and args.weighting == "coherent":
+        raise ValueError(
+            '"--pdos" is only compatible with ' '"--weighting" options that include dos'
+        )
+    if args.get("partials") and args.weighting != "coherent":
+        raise ValueError(
+            "The partial maps are only available for the coherent weighting."
+        )
+    # print("Setting up dimensions...")
+
+    q_min = _get_q_distance(args.length_unit, args.q_min)
+    q_max = _get_q_distance(args.length_unit, args.q_max)
+    recip_length_unit = q_min.units
+
+    n_q_bins = ceil((args.q_max - args.q_min) / args.q_spacing)
+    q_bin_edges = (
+        np.linspace(q_min.magnitude, q_max.magnitude, n_q_bins + 1, endpoint=True)
+        * recip_length_unit
+    )
+    q_bin_centers = (q_bin_edges[:-1] + q_bin_edges[1:]) / 2
+
+    # Use X-point modes to estimate frequency range, set up energy bins
+    # (Not Gamma in case there are only 3 branches; value would be zero!)
+    modes = fc.calculate_qpoint_frequencies(
+        np.array([[0.0, 0.0, 0.5]]),
+        **calc_modes_kwargs,
+    )
+    modes.frequencies_unit = args.energy_unit
+
+    if args.e_i is not None and args.e_max is None:
+        emax = args.e_i
+    else:
+        emax = args.e_max
+
+    energy_bins = _get_energy_bins(
+        modes, args.ebins + 1, emin=args.e_min, emax=emax, headroom=1.2
+    )  # Generous headroom as we only checked one q-point
+
+    if cache is None:
+        cache = StageCache()
+
+    def stream_shells():
+        temperature = None
+        dw = None
+        if args.weighting in ("coherent",):
+            # Compute Debye-Waller factor once for re-use at each mod(q)
+            # (If temperature is not set, this will be None.)
+            if args.temperature is not None:
+                temperature = args.temperature * ureg("K")
+                dw = get_debye_waller(
+                    temperature,
+                    fc,
+                    grid=args.grid,
+                    grid_spacing=(args.grid_spacing * recip_length_unit),
+                    **calc_modes_kwargs,
+                )
+
+        # print(f"Sampling {n_q_bins} |q| shells between {q_min:~P} and {q_max:~P}")
+
+        report = {}
+        shells = []
+        for q_index in range(n_q_bins):
+            q = q_bin_centers[q_index]
+
+            if args.npts_density is not None:
+                npts = ceil(args.npts_density * (q / recip_length_unit) ** 2)
+                npts = max(args.npts_min, min(args.npts_max, npts))
+            else:
+                npts = args.npts
+
+            shells.append((q, npts))
+
+        # the shells are sampled by the engine selected in the parameters (see powder.py),
+        # and the map filled so far is yielded each time a shell is done.
+        z_data = None
+        for q_index, row, z_unit, _ in iter_sample_shells(
+            fc,
+            shells,
+            energy_bins,
+            options={
+                "weighting": args.weighting,
+                "pdos": args.pdos,
+                "sampling": args.sampling,
+                "jitter": args.jitter,
+                "seed": args.get("seed"),
+                "symmetry_reduction": args.get("symmetry_reduction", False),
+                "npts_tolerance": args.get("npts_tolerance"),
+                "npts_batch": args.get("npts_batch"),
+                "npts_max": args.get("npts_max"),
+                "partials": args.get("partials"),
+                "partial_cross_terms": args.get("partial_cross_terms", True),
+                "grid": args.grid,
+                "grid_spacing": args.grid_spacing * recip_length_unit,
+                "calc_modes_kwargs": calc_modes_kwargs,
+            },
+            dw=dw,
+            temperature=temperature,
+            engine=args.get("powder_engine", "serial"),
+            n_workers=args.get("n_workers"),
+            batch_size=args.get("batch_size"),
+            q_bin_edges=q_bin_edges,
+            report=report,
+        ):
+            if z_data is None:
+                # (n_q_bins, n_partials, n_energy_bins) for the partial maps.
+                z_data = np.full(
+                    (n_q_bins,) + np.shape(row),
+                    np.nan,
+                    dtype=precision_dtypes(args.get("precision", "double"))[0],
+                )
+            z_data[q_index] = row
+            enablePrint()
+            # (the total of the partial maps while they are computed.)
+            yield (
+                euphonic.Spectrum2D(
+                    q_bin_edges,
+                    energy_bins,
+                    (z_data if z_data.ndim == 2 else z_data.sum(axis=1)) * z_unit,
+                ),
+                q_index,
+            )
+            blockPrint()
+
+        # print(f"Final npts: {npts}")
+
+        # the sampling information of the engine (points per shell, convergence)
+        # is kept in the metadata.
+        if args.get("partials"):
+            labels = partial_labels(
+                partial_groups(fc.crystal, args.partials),
+                cross_terms=args.get("partial_cross_terms", True),
+            )
+            spectrum = [
+                euphonic.Spectrum2D(
+                    q_bin_edges,
+                    energy_bins,
+                    z_data[:, p] * z_unit,
+                    metadata=dict(report, partial=partial),
+                )
+                for p, partial in enumerate(labels)
+            ]
+        else:
+            spectrum = euphonic.Spectrum2D(
+                q_bin_edges, energy_bins, z_data * z_unit, metadata=report
+            )
+        return _store_precision(spectrum, args.get("precision", "double"))
+
+    def compute_broadening():
+        spectrum = cache.lookup("shells", shells_key)
+        if isinstance(spectrum, list):  # partial maps
+            spectrum = [broaden(partial) for partial in spectrum]
+        else:
+            spectrum = broaden(spectrum)
+        return _store_precision(spectrum, args.get("precision", "double"))
+
+    def broaden(spectrum):
+        if args.q_broadening or args.energy_broadening:
+            spectrum = spectrum.broaden(
+                x_width=(
+                    args.q_broadening * recip_length_unit if args.q_broadening else None
+                ),
+                y_width=(
+                    args.energy_broadening * energy_bins.units
+                    if args.energy_broadening
+                    else None
+                ),
+                shape=args.shape,
+            )
+
+        if not (args.e_i is None and args.e_f is None):
+            # print("Applying kinematic constraints")
+            energy_unit = args.energy_unit
+            e_i = args.e_i * ureg(energy_unit) if (args.e_i is not None) else None
+            e_f = args.e_f * ureg(energy_unit) if (args.e_f is not None) else None
+            spectrum = apply_kinematic_constraints(
+                spectrum, e_i=e_i, e_f=e_f, angle_range=args.angle_range
+            )
+        return spectrum
+
+    # same staging as in produce_bands_weigthed_data: the sampling of the shells
+    # (modes, structure factor and binning) and then broadening and kinematic constraints.
+    shells_key = (
+        fc,
+        args.q_min,
+        args.q_max,
+        args.q_spacing,
+        args.length_unit,
+        args.npts,
+        args.npts_density,
+        args.get("npts_min"),
+        args.get("npts_max"),
+        args.weighting,
+        args.pdos,
+        args.temperature,
+        args.grid,
+        args.grid_spacing,
+        args.sampling,
+        args.jitter,
+        args.get("seed"),
+        args.get("symmetry_reduction", False),
+        args.get("npts_tolerance"),
+        args.get("npts_batch"),
+        args.get("partials"),
+        args.get("partial_cross_terms", True),
+        args.get("precision", "double"),
+        # the grid engine does not sample the spheres (the others give the same map).
+        args.get("powder_engine") == "grid",
+        args.energy_unit,
+        args.ebins,
+        args.e_min,
+        emax,
+        args.asr,
+        args.dipole_parameter,
+    )
+    broadening_key = shells_key + (
+        args.q_broadening,
+        args.energy_broadening,
+        args.shape,
+        args.e_i,
+        args.e_f,
+        args.get("angle_range"),
+    )
+    if cache.lookup("shells", shells_key) is None:
+        cache.store("shells", shells_key, (yield from stream_shells()))
+    return cache.get("broadening", broadening_key, compute_broadening)
+
+
+@uses_execution_policy
 def produce_Q_section_modes(
     fc,
     h,
@@ -589,6 +1244,11 @@ def produce_Q_section_modes(
     h_extension=1,
     k_extension=1,
     temperature=0,
+    n_threads=None,
+    symmetry_reduction=True,
+    zone_reduction=True,
+    memory_budget=None,
+    precision="double",
 ):
     from euphonic import ureg
 
@@ -597,40 +1257,68 @@ def produce_Q_section_modes(
     # k: array vector
     # Q0: "point" in Q-space used to build the portion of plane, using also the two vectors h and k.
     # n_h, n_k: number of points along the two directions. or better, the two vectors.
+    # symmetry_reduction: diagonalise only the symmetry- and translation-unique q-points,
+    # mapping the modes back to the plane (see qpoint_symmetry.py).
+    # zone_reduction: without symmetry_reduction, diagonalise only the q-points unique up to
+    # a reciprocal lattice vector.
+    # memory_budget (MB): the plane is checked to fit in it before diagonalising
+    # (MemoryBudgetError otherwise, see execution.py).
+    # precision: "single" to store the eigenvectors (and then compute the intensities)
+    # in single precision, see kernels.py.
 
     def get_Q_section(h, k, Q0, n_h, n_k, h_extension, k_extension):
-        # every point in the space is Q=Q0+dv1*h+dv2*k, which
-
-        q_list = []
-        h_list = []
-        k_list = []
-
-        for dv1 in np.linspace(-h_extension, h_extension, n_h):
-            for dv2 in np.linspace(-k_extension, k_extension, n_k):
-                p = Q0 + dv1 * h + dv2 * k
-                q_list.append(p)  # Q list
-                h_list.append(dv1)  # *h[0])
-                k_list.append(dv2)  # *k[1])
-
-        return np.array(q_list), np.array(h_list), np.array(k_list)
+        # every point in the space is Q=Q0+dv1*h+dv2*k (dv2 running fastest).
+        dv1, dv2 = np.meshgrid(
+            np.linspace(-h_extension, h_extension, n_h),
+            np.linspace(-k_extension, k_extension, n_k),
+            indexing="ij",
+        )
+        h_list, k_list = dv1.ravel(), dv2.ravel()
+        q_list = (
+            np.asarray(Q0, dtype=float)
+            + h_list[:, np.newaxis] * np.asarray(h, dtype=float)
+            + k_list[:, np.newaxis] * np.asarray(k, dtype=float)
+        )
+        return q_list, h_list, k_list
 
     q_array, h_array, k_array = get_Q_section(
         h, k, Q0, n_h + 1, n_k + 1, h_extension, k_extension
     )
 
-    modes = fc.calculate_qpoint_phonon_modes(
-        qpts=q_array,
-        reduce_qpts=False,
-        asr="reciprocal",
-    )
+    n_threads = get_execution_policy(n_threads)["n_threads"]
+    _plane_chunk_size(len(q_array), fc.crystal.n_atoms, memory_budget)
+
+    if symmetry_reduction:
+        modes = calculate_qpoint_phonon_modes_reduced(
+            fc,
+            q_array,
+            asr="reciprocal",
+            n_threads=n_threads,
+        )
+    elif zone_reduction:
+        modes = calculate_qpoint_phonon_modes_zone_reduced(
+            fc,
+            q_array,
+            asr="reciprocal",
+            n_threads=n_threads,
+        )
+    else:
+        modes = fc.calculate_qpoint_phonon_modes(
+            qpts=q_array,
+            reduce_qpts=False,
+            asr="reciprocal",
+            n_threads=n_threads,
+        )
+    modes = with_precision(modes, precision)
 
     if temperature > 0:
         blockPrint()
-        dw = _get_debye_waller(
+        dw = get_debye_waller(
             temperature * ureg("K"),
             fc,
             # grid_spacing=(args.grid_spacing * recip_length_unit),
             # **calc_modes_kwargs,
+            n_threads=n_threads,
         )
         enablePrint()
     else:
@@ -645,6 +1333,42 @@ def produce_Q_section_modes(
     return modes, q_array, h_array, k_array, labels, dw
 
 
+@uses_execution_policy
+def produce_Q_section_intensities(
+    modes, spectrum_type="coherent", dw=None, memory_budget=None
+):
+    """Per-mode intensities of the Q-plane (see kernels.mode_intensities).
+
+    They do not depend on the energy cut: keep them to produce other cuts
+    (produce_Q_section_spectrum, produce_Q_section_energy_stack) without recomputing them.
+    The structure factors are computed in chunks of q-points within memory_budget (MB), in
+    the precision of the eigenvectors of the modes.
+    """
+    chunk_size = _plane_chunk_size(
+        modes.n_qpts,
+        modes.crystal.n_atoms,
+        memory_budget,
+        precision="single" if real_dtype(modes) == np.float32 else "double",
+    )
+    blockPrint()
+    intensities = mode_intensities(
+        modes, dw=dw, weighting=spectrum_type, chunk_size=chunk_size
+    )
+    enablePrint()
+    return intensities
+
+
+def _plane_chunk_size(n_qpts, n_atoms, memory_budget=None, precision="double"):
+    """The number of q-points of a Q-plane whose structure factors are computed at once,
+    within the memory budget (raises MemoryBudgetError if the plane does not fit)."""
+    held, per_qpt = structure_factor_memory(n_qpts, n_atoms, 0, precision=precision)
+    # the per-mode intensities of the plane (frequencies, +w and -w) are kept too, and
+    # are built from as many per-mode arrays (structure factors, Bose factors).
+    held += 6 * 8 * n_qpts * 3 * n_atoms
+    return memory_chunk_size(held, per_qpt, n_qpts, memory_budget)
+
+
+@uses_execution_policy
 def produce_Q_section_spectrum(
     modes,
     q_array,
@@ -652,40 +1376,38 @@ def produce_Q_section_spectrum(
     k_array,
     ecenter,
     deltaE=0.5,
-    bins=10,
+    bins=None,
     spectrum_type="coherent",
     dw=None,
     labels=None,
+    intensities=None,
 ):
-    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
-        blockPrint,
-        enablePrint,
-    )
+    # the intensity of each Q point is the average of the S(Q,w) (or DOS) over the window
+    # ecenter - deltaE, ecenter + deltaE, with Gaussian weights. By default (bins=None) it is
+    # evaluated directly on the modes (see kernels.energy_window_intensities); otherwise,
+    # the S(Q,w) is binned in `bins` energy bins and the bins are averaged (kernels.energy_cuts).
+    # If the per-mode intensities of the plane are given (see produce_Q_section_intensities),
+    # modes, spectrum_type and dw are not used.
+    if intensities is None:
+        intensities = produce_Q_section_intensities(
+            modes, spectrum_type=spectrum_type, dw=dw
+        )
+    av_spec = produce_Q_section_energy_stack(
+        intensities, [ecenter], deltaE=deltaE, bins=bins
+    )[0]
 
-    # bins = 10 # hard coded beacuse here it does not change anything.
-    ebins = _get_energy_bins(
-        modes, bins + 1, emin=ecenter - deltaE, emax=ecenter + deltaE
-    )
+    return av_spec, q_array, h_array, k_array, labels
 
-    blockPrint()
-    if (
-        spectrum_type == "coherent"
-    ):  # Temperature?? For now let's drop it otherwise it is complicated.
-        spectrum = modes.calculate_structure_factor(dw=dw).calculate_sqw_map(ebins)
-    elif spectrum_type == "dos":
-        spectrum = modes.calculate_dos_map(ebins)
-
-    mu = ecenter
-    sigma = (deltaE) / 2
-
-    # Gaussian weights.
-    weights = np.exp(-((spectrum.y_data.magnitude - mu) ** 2) / 2 * sigma**2) / np.sqrt(
-        2 * np.pi * sigma**2
-    )
-    av_spec = np.average(spectrum.z_data.magnitude, axis=1, weights=weights[:-1])
-    enablePrint()
 
-    return av_spec, q_array, h_array, k_array, labels
+def produce_Q_section_energy_stack(intensities, ecenters, deltaE=0.5, bins=None):
+    """The (n_cuts, n_Q) intensities of the Q-plane at each energy of `ecenters` (e.g. for an
+    energy scan), from the per-mode intensities of produce_Q_section_intensities.
+
+    See produce_Q_section_spectrum for the meaning of bins.
+    """
+    if bins is None:
+        return energy_window_intensities(intensities, ecenters, deltaE=deltaE)
+    return energy_cuts(intensities, ecenters, deltaE=deltaE, bins=bins)
 
 
 def generated_curated_data(spectra):
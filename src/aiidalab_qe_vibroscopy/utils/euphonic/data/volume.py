@@ -0,0 +1,293 @@
+"""S(Q,E) over volumes of the reciprocal space, stored in chunks on disk.
+
+The volume is the grid of points Q = Q0 + a*h + b*k + c*l (as the Q-planes, with a third
+vector l), with n_h + 1, n_k + 1, n_l + 1 points along h, k, l, and the S(Q,E) (or DOS) map
+is computed in energy bins for each point. compute_volume computes the grid one block of
+points at a time and writes each block to an HDF5 file, in a chunked and compressed
+(n_h + 1, n_k + 1, n_l + 1, n_E) dataset: the peak memory is given by the block, not by the
+size of the grid.
+
+SpectrumVolume reads the file lazily: only the chunks needed by a plane, a line or a
+constant-E slice are read from the disk and decompressed.
+"""
+
+import os
+import uuid
+
+import h5py
+import numpy as np
+from euphonic import ureg
+from euphonic.cli.utils import _get_energy_bins
+
+from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import get_debye_waller
+from aiidalab_qe_vibroscopy.utils.euphonic.data.execution import (
+    get_execution_policy,
+    memory_chunk_size,
+    uses_execution_policy,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.kernels import (
+    bin_mode_intensities,
+    mode_intensities,
+    precision_dtypes,
+    structure_factor_memory,
+    with_precision,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.qpoint_symmetry import (
+    calculate_qpoint_phonon_modes_reduced,
+)
+from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+    blockPrint,
+    enablePrint,
+)
+
+VOLUME_FORMAT_VERSION = 1
+
+# shape of the chunks of the dataset (h, k, l, E): a block of q-points is computed at once
+# for each chunk along h, k, l (16**3 q-points, a few tens of MB for small cells).
+DEFAULT_CHUNKS = (16, 16, 16, 32)
+
+
+def volume_axes(n_h, n_k, n_l, h_extension=1, k_extension=1, l_extension=1):
+    """The coefficients of h, k, l of the points of the volume (see the module docstring)."""
+    return [
+        np.linspace(-extension, extension, n + 1)
+        for n, extension in [(n_h, h_extension), (n_k, k_extension), (n_l, l_extension)]
+    ]
+
+
+@uses_execution_policy
+def compute_volume(
+    path,
+    fc,
+    h,
+    k,
+    l,  # noqa: E741
+    Q0=np.array([0, 0, 0]),
+    n_h=50,
+    n_k=50,
+    n_l=50,
+    h_extension=1,
+    k_extension=1,
+    l_extension=1,
+    ebins=200,
+    e_min=None,
+    e_max=None,
+    temperature=0,
+    spectrum_type="coherent",
+    chunks=DEFAULT_CHUNKS,
+    n_threads=None,
+    symmetry_reduction=True,
+    memory_budget=None,
+    precision="double",
+):
+    """Compute the S(Q,E) (spectrum_type "coherent") or the DOS map ("dos") over the volume
+    and store it in the HDF5 file `path` (see the module docstring).
+
+    The energies are in meV; without e_max, the energy range is estimated from the X-point modes
+    (as for the powder). The file is written under a temporary name and renamed at the end, so
+    an interrupted calculation does not leave a partial volume. The structure factors of each
+    block are computed in chunks of q-points within memory_budget (MB, see execution.py); a
+    MemoryBudgetError is raised before computing if the modes of a block do not fit (use
+    smaller chunks). With precision "single", the intensities are computed and stored in
+    single precision (see kernels.py): the file takes about half the space.
+
+    Returns:
+        SpectrumVolume: the volume, opened for reading.
+    """
+    vectors = np.array([h, k, l], dtype=float)
+    Q0 = np.asarray(Q0, dtype=float)
+    axes = volume_axes(n_h, n_k, n_l, h_extension, k_extension, l_extension)
+    shape = tuple(len(axis) for axis in axes)
+    n_threads = get_execution_policy(n_threads)["n_threads"]
+
+    modes = fc.calculate_qpoint_frequencies(
+        np.array([[0.0, 0.0, 0.5]]), asr="reciprocal", n_threads=n_threads
+    )
+    modes.frequencies_unit = "meV"
+    e_bins = _get_energy_bins(
+        modes, ebins + 1, emin=e_min, emax=e_max, headroom=1.2
+    ).magnitude
+
+    if temperature > 0 and spectrum_type == "coherent":
+        blockPrint()
+        dw = get_debye_waller(temperature * ureg("K"), fc, n_threads=n_threads)
+        enablePrint()
+    else:
+        dw = None
+
+    chunks = tuple(min(c, n) for c, n in zip(chunks, shape + (ebins,)))
+    n_block = int(np.prod(chunks[:3]))
+    chunk_size = memory_chunk_size(
+        *structure_factor_memory(n_block, fc.crystal.n_atoms, ebins),
+        n_block,
+        memory_budget,
+    )
+    tmp = f"{path}.tmp-{uuid.uuid4().hex}"
+    try:
+        with h5py.File(tmp, "w") as handle:
+            data = handle.create_dataset(
+                "intensity",
+                shape=shape + (ebins,),
+                dtype=precision_dtypes(precision)[0],
+                chunks=chunks,
+                compression="gzip",
+                shuffle=True,
+            )
+            units = None
+            for block in _blocks(shape, chunks[:3]):
+                block_axes = [axis[b] for axis, b in zip(axes, block)]
+                a, b, c = np.meshgrid(*block_axes, indexing="ij")
+                qpts = (
+                    Q0 + np.stack([a.ravel(), b.ravel(), c.ravel()], axis=1) @ vectors
+                )
+                if symmetry_reduction:
+                    block_modes = calculate_qpoint_phonon_modes_reduced(
+                        fc, qpts, asr="reciprocal", n_threads=n_threads
+                    )
+                else:
+                    block_modes = fc.calculate_qpoint_phonon_modes(
+                        qpts, reduce_qpts=False, asr="reciprocal", n_threads=n_threads
+                    )
+                block_modes = with_precision(block_modes, precision)
+                block_modes.frequencies_unit = "meV"
+                blockPrint()
+                intensities = mode_intensities(
+                    block_modes, dw=dw, weighting=spectrum_type, chunk_size=chunk_size
+                )
+                enablePrint()
+                units = intensities["units"]
+                data[block] = bin_mode_intensities(intensities, e_bins).reshape(
+                    a.shape + (ebins,)
+                )
+
+            handle.attrs.update(
+                {
+                    "version": VOLUME_FORMAT_VERSION,
+                    "vectors": vectors,
+                    "Q0": Q0,
+                    "h_axis": axes[0],
+                    "k_axis": axes[1],
+                    "l_axis": axes[2],
+                    "energy_bins": e_bins,
+                    "energy_unit": "meV",
+                    "units": str((ureg(units) / ureg("meV")).units),
+                    "temperature": temperature,
+                    "spectrum_type": spectrum_type,
+                }
+            )
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return SpectrumVolume(path)
+
+
+def _blocks(shape, block_shape):
+    """The slices of the blocks (one per chunk) covering the grid of the given shape."""
+    for i in range(0, shape[0], block_shape[0]):
+        for j in range(0, shape[1], block_shape[1]):
+            for k in range(0, shape[2], block_shape[2]):
+                yield (
+                    slice(i, i + block_shape[0]),
+                    slice(j, j + block_shape[1]),
+                    slice(k, k + block_shape[2]),
+                )
+
+
+class SpectrumVolume:
+    """Lazy view of a volume stored by compute_volume.
+
+    Indexing (volume[i, j, k, e], with numpy basic slicing) reads only the chunks of the
+    selection. The file stays open until close() (or the end of a with block).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = h5py.File(path, "r")
+        self._data = self._file["intensity"]
+        attrs = self._file.attrs
+        self.vectors = attrs["vectors"]
+        self.Q0 = attrs["Q0"]
+        self.axes = [attrs["h_axis"], attrs["k_axis"], attrs["l_axis"]]
+        self.energy_bins = attrs["energy_bins"]
+        self.energy_unit = str(attrs["energy_unit"])
+        self.units = str(attrs["units"])
+        self.temperature = float(attrs["temperature"])
+        self.spectrum_type = str(attrs["spectrum_type"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def shape(self):
+        """(n_h + 1, n_k + 1, n_l + 1, n_E)."""
+        return self._data.shape
+
+    @property
+    def energies(self):
+        """The centers of the energy bins."""
+        return (self.energy_bins[:-1] + self.energy_bins[1:]) / 2
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def qpts(self, i, j, k):
+        """The (fractional) q-points of the grid indices i, j, k (integers or arrays)."""
+        coefficients = np.stack(
+            np.broadcast_arrays(self.axes[0][i], self.axes[1][j], self.axes[2][k]),
+            axis=-1,
+        )
+        return self.Q0 + coefficients @ self.vectors
+
+    def energy_index(self, energy):
+        """The index of the energy bin of `energy` (clipped to the energy range)."""
+        index = np.searchsorted(self.energy_bins, energy, side="right") - 1
+        return int(np.clip(index, 0, self.shape[3] - 1))
+
+    def energy_slice(self, energy):
+        """The (n_h + 1, n_k + 1, n_l + 1) intensities in the energy bin of `energy`."""
+        return self._data[:, :, :, self.energy_index(energy)]
+
+    def plane(self, axis, index, energy=None):
+        """The plane of the grid at `index` along `axis` (0, 1, 2 for h, k, l).
+
+        Returns the (n_a, n_b, n_E) intensities of the two other axes, or (n_a, n_b) at
+        the energy bin of `energy` if given.
+        """
+        key = [slice(None)] * 4
+        key[axis] = index
+        if energy is not None:
+            key[3] = self.energy_index(energy)
+        return self._data[tuple(key)]
+
+    def line(self, start, stop, n=100):
+        """The intensities along the line from the (fractional) q-point `start` to `stop`.
+
+        Each of the `n` points of the line takes the intensities of the nearest grid point
+        (the points outside the volume are NaN), reading only the chunks along the line.
+
+        Returns:
+            qpts: (n, 3) q-points of the line.
+            intensities: (n, n_E) array.
+        """
+        qpts = np.linspace(start, stop, n)
+        coefficients = np.linalg.solve(self.vectors.T, (qpts - self.Q0).T).T
+        indices = []
+        for axis, coefficient in zip(self.axes, coefficients.T):
+            step = axis[1] - axis[0] if len(axis) > 1 else 1
+            indices.append(np.rint((coefficient - axis[0]) / step).astype(int))
+        indices = np.stack(indices, axis=1)
+        inside = np.all((indices >= 0) & (indices < np.array(self.shape[:3])), axis=1)
+
+        intensities = np.full((n, self.shape[3]), np.nan)
+        unique, inverse = np.unique(indices[inside], axis=0, return_inverse=True)
+        values = np.array([self._data[i, j, k, :] for i, j, k in unique])
+        if len(unique):
+            intensities[inside] = values[inverse.ravel()]
+        return qpts, intensities
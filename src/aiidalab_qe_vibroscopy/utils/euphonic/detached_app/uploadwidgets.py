@@ -9,6 +9,9 @@ import ipywidgets as ipw
 # from ..euphonic.bands_pdos import *
 
 
+from aiidalab_qe_vibroscopy.utils.euphonic.data.native_format import (
+    force_constants_from_npz,
+)
 from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
     generate_force_constant_from_phonopy,
 )
@@ -20,7 +23,7 @@ from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
 class UploadPhonopyYamlWidget(ipw.FileUpload):
     def __init__(self, **kwargs):
         super().__init__(
-            description="upload phonopy YAML file",
+            description="upload phonopy YAML (or euphonic npz) file",
             multiple=False,
             layout={"width": "initial"},
         )
@@ -60,6 +63,13 @@ class UploadPhonopyWidget(ipw.HBox):
     def _read_phonopy_files(self, fname, phonopy_yaml_content, fc_hdf5_content=None):
         suffix = "".join(pathlib.Path(fname).suffixes)
 
+        if suffix.endswith(".npz"):
+            # force constants already in the euphonic layout (see DownloadYamlHdf5Widget).
+            try:
+                return force_constants_from_npz(phonopy_yaml_content)
+            except (ValueError, KeyError):
+                return None
+
         with tempfile.NamedTemporaryFile(suffix=suffix) as temp_yaml:
             temp_yaml.write(phonopy_yaml_content)
             temp_yaml.flush()
@@ -119,11 +129,15 @@ class DownloadYamlHdf5Widget(ipw.HBox):
 
     def _download_data(self, _=None):
         """
-        Download both the phonopy.yaml and fc.hdf5 files.
+        Download both the phonopy.yaml and fc.hdf5 files, and the force constants
+        in the euphonic layout (fc_euphonic.npz), which is faster to load in the detached app.
         """
         phonopy_yaml, fc_hdf5 = self._model.produce_phonopy_files()
         self._download(payload=phonopy_yaml, filename="phonopy" + ".yaml")
         self._download(payload=fc_hdf5, filename="fc" + ".hdf5")
+        self._download(
+            payload=self._model.produce_euphonic_file(), filename="fc_euphonic.npz"
+        )
 
     @staticmethod
     def _download(payload, filename):
@@ -2,7 +2,7 @@
 
 from aiida import orm
 from aiida.common import AttributeDict
-from aiida.engine import WorkChain
+from aiida.engine import WorkChain, calcfunction
 from aiida.orm import Dict, StructureData
 from aiida.plugins import WorkflowFactory, CalculationFactory
 from aiida.engine import if_
@@ -125,6 +125,36 @@ def generate_2d_path(symmetry_type, eta=None, nu=None):
         raise ValueError("Invalid symmetry type")
 
 
+@calcfunction
+def generate_euphonic_force_constants(
+    phonopy_data=None, force_constants=None, settings=None
+):
+    """Force constants in the euphonic-native layout, from the inputs of a PhonopyCalculation.
+
+    The conversion (produce_force_constants and phases of the force constants) is done
+    here once, so that the INS results can be loaded directly from the output ArrayData.
+    """
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.native_format import (
+        force_constants_to_array_data,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
+        generate_force_constant_from_phonopy_instance,
+        get_phonopy_instance_from_inputs,
+    )
+
+    inputs = {
+        "phonopy_data": phonopy_data,
+        "force_constants": force_constants,
+        "settings": settings,
+    }
+    ph, _ = get_phonopy_instance_from_inputs(
+        {key: node for key, node in inputs.items() if node is not None}
+    )
+    return force_constants_to_array_data(
+        generate_force_constant_from_phonopy_instance(ph)
+    )
+
+
 def determine_symmetry_path(structure):
     # Tolerance for checking equality
     cell_lengths = structure.cell_lengths
@@ -265,6 +295,12 @@ class VibroWorkChain(WorkChain):
             required=False,
             help="Settings for phonopy pdos calculation.",
         )
+        spec.input(
+            "export_euphonic_force_constants",
+            valid_type=orm.Bool,
+            required=False,
+            help="Store the force constants in the euphonic-native layout (for the INS results).",
+        )
         ###
         spec.outline(
             cls.setup,
@@ -329,6 +365,12 @@ class VibroWorkChain(WorkChain):
             required=False,
             help="Calculated thermal properties.",
         )
+        spec.output(
+            "euphonic_force_constants",
+            valid_type=orm.ArrayData,
+            required=False,
+            help="Force constants in the euphonic-native layout.",
+        )
         ###
         spec.exit_code(400, "ERROR_WORKCHAIN_FAILED", message="The workchain failed.")
 
@@ -823,5 +865,32 @@ class VibroWorkChain(WorkChain):
                 self.report("the child thermo PhonopyCalculation failed")
                 failed = True
 
+            if (
+                self.inputs.get("export_euphonic_force_constants", orm.Bool(False))
+                and self.ctx["bands"].is_finished_ok
+            ):
+                self.export_euphonic_force_constants()
+
         if failed:
             return self.exit_codes.ERROR_WORKCHAIN_FAILED
+
+    def export_euphonic_force_constants(self):
+        """Output the force constants in the euphonic-native layout, from the inputs of the bands calculation.
+
+        This is not critical: if it fails, the INS results are obtained from the phonopy data as before.
+        """
+        bands_inputs = self.ctx["bands"].inputs
+        inputs = {
+            key: bands_inputs[key]
+            for key in ["phonopy_data", "force_constants", "settings"]
+            if key in bands_inputs
+        }
+        try:
+            euphonic_fc = generate_euphonic_force_constants(
+                **inputs,
+                metadata={"call_link_label": "generate_euphonic_force_constants"},
+            )
+        except Exception as exc:
+            self.report(f"the euphonic force constants could not be generated: {exc}")
+        else:
+            self.out("euphonic_force_constants", euphonic_fc)
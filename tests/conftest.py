@@ -113,6 +113,64 @@ def generate_structure_data():
     return _generate_structure_data
 
 
+@pytest.fixture
+def generate_phonopy_instance():
+    """Return a small `Phonopy` instance (diamond-like silicon) with forces from a harmonic pair model."""
+
+    def _generate_phonopy_instance(supercell=2):
+        import numpy as np
+        from phonopy import Phonopy
+        from phonopy.structure.atoms import PhonopyAtoms
+
+        a = 5.43
+        unitcell = PhonopyAtoms(
+            symbols=["Si", "Si"],
+            cell=[[0, a / 2, a / 2], [a / 2, 0, a / 2], [a / 2, a / 2, 0]],
+            scaled_positions=[[0, 0, 0], [0.25, 0.25, 0.25]],
+        )
+        ph = Phonopy(unitcell, supercell_matrix=np.eye(3, dtype=int) * supercell)
+        ph.generate_displacements(distance=0.01)
+
+        # nearest-neighbours springs (k = 1 eV/A^2, rest length 2.3 A).
+        shifts = np.array(
+            [[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+        )
+        forces = []
+        for cell in ph.supercells_with_displacements:
+            images = cell.positions[None, :, :] + (shifts @ cell.cell)[:, None, :]
+            d = images[:, None, :, :] - cell.positions[None, :, None, :]
+            r = np.linalg.norm(d, axis=-1)
+            mask = (r > 1e-6) & (r < 2.5)
+            r = np.where(mask, r, 1.0)
+            f = np.where(mask[..., None], (r - 2.3)[..., None] * d / r[..., None], 0)
+            forces.append(f.sum(axis=(0, 2)))
+        ph.forces = np.array(forces)
+        return ph
+
+    return _generate_phonopy_instance
+
+
+@pytest.fixture
+def generate_force_constants(generate_phonopy_instance):
+    """Return the euphonic `ForceConstants` of the `generate_phonopy_instance` fixture."""
+
+    def _generate_force_constants(supercell=2):
+        import euphonic
+
+        ph = generate_phonopy_instance(supercell=supercell)
+        ph.produce_force_constants()
+        with tempfile.TemporaryDirectory() as dirpath:
+            ph.save(
+                pathlib.Path(dirpath) / "phonopy.yaml",
+                settings={"force_constants": True},
+            )
+            return euphonic.ForceConstants.from_phonopy(
+                path=dirpath, summary_name="phonopy.yaml"
+            )
+
+    return _generate_force_constants
+
+
 @pytest.fixture
 def generate_xy_data():
     """Return an ``XyData`` instance."""
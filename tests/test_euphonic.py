@@ -0,0 +1,913 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def powder_parameters():
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_powder,
+    )
+
+    return dict(parameters_powder, q_min=0.1, q_max=0.5, q_spacing=0.1, npts=20)
+
+
+def test_powder_parallel_engine(generate_force_constants, powder_parameters):
+    """The parallel engine should reproduce the serial one bit for bit, given a seed."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_powder_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    z_data = {}
+    for engine in ["serial", "parallel"]:
+        parameters = dict(powder_parameters, seed=42, powder_engine=engine, n_workers=2)
+        spectrum, _ = produce_powder_data(params=parameters, fc=fc)
+        enablePrint()
+        z_data[engine] = spectrum.z_data.magnitude
+
+    assert z_data["serial"].shape == (4, 200)
+    assert np.array_equal(z_data["serial"], z_data["parallel"])
+
+
+@pytest.mark.parametrize("weighting", ["coherent", "dos"])
+def test_powder_batched_engine(generate_force_constants, powder_parameters, weighting):
+    """The batched engine should reproduce the serial one, also when splitting the shells in batches."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_powder_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    z_data = {}
+    for engine, batch_size in [("serial", None), ("batched", None), ("batched", 30)]:
+        parameters = dict(
+            powder_parameters,
+            seed=42,
+            weighting=weighting,
+            temperature=100,
+            powder_engine=engine,
+            batch_size=batch_size,
+        )
+        spectrum, _ = produce_powder_data(params=parameters, fc=fc)
+        enablePrint()
+        z_data[(engine, batch_size)] = spectrum.z_data.magnitude
+
+    reference = z_data.pop(("serial", None))
+    for data in z_data.values():
+        assert np.allclose(data, reference, rtol=1e-10, atol=0)
+
+
+def test_execution_policy(monkeypatch):
+    """The threads come from the parameter, set_execution_policy, the environment variable
+    or the available cores, in this order; the INS functions run with limited BLAS threads."""
+    from contextlib import contextmanager
+
+    from aiidalab_qe_vibroscopy.utils.euphonic.data import execution
+
+    monkeypatch.delenv(execution.NUM_THREADS_ENV_VAR, raising=False)
+    policy = execution.get_execution_policy()
+    assert policy["n_threads"] == execution.available_cpus()
+    assert policy["source"] in ["cgroup quota", "CPU affinity"]
+
+    monkeypatch.setenv(execution.NUM_THREADS_ENV_VAR, "3")
+    policy = execution.get_execution_policy()
+    assert (policy["n_threads"], policy["source"]) == (3, execution.NUM_THREADS_ENV_VAR)
+
+    blas_limits = []
+
+    @contextmanager
+    def threadpool_limits(limits=None, user_api=None):
+        blas_limits.append((limits, user_api))
+        yield
+
+    monkeypatch.setattr(execution, "threadpool_limits", threadpool_limits)
+
+    @execution.uses_execution_policy
+    def calculation():
+        return execution.get_execution_policy()["n_threads"]
+
+    @execution.uses_execution_policy
+    def streamed_calculation():
+        yield execution.get_execution_policy(n_threads=5)["n_threads"]
+
+    try:
+        execution.set_execution_policy(n_threads=2, blas_threads=4)
+        assert execution.get_execution_policy()["source"] == "app/API"
+        assert calculation() == 2
+        assert list(streamed_calculation()) == [5]
+        assert execution.get_execution_policy(n_threads=5)["source"] == "parameters"
+    finally:
+        execution.set_execution_policy()
+    # also while the generators run.
+    assert len(blas_limits) >= 2 and set(blas_limits) == {(4, "blas")}
+
+
+def test_powder_symmetry_reduction(generate_force_constants, powder_parameters):
+    """The wedge sampling uses the point group, leaving the intensities unchanged."""
+    from euphonic import ureg
+    from euphonic.powder import _qpts_cart_to_frac
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.powder import (
+        point_group_rotations,
+        point_group_wedge,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_powder_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    rotations = point_group_rotations(fc)
+    assert len(rotations) == 48
+    assert np.allclose(rotations[0], np.eye(3))
+
+    # the structure factor is the same on all the images of a q-point.
+    qpts = np.einsum("nij,j->ni", rotations, [0.31, 0.12, 0.05]) * ureg("1/angstrom")
+    modes = fc.calculate_qpoint_phonon_modes(
+        _qpts_cart_to_frac(qpts, fc.crystal), asr="reciprocal"
+    )
+    structure_factors = np.sort(
+        modes.calculate_structure_factor().structure_factors.magnitude, axis=1
+    )
+    assert np.allclose(structure_factors, structure_factors[0])
+
+    # each point is in exactly one image of the wedge.
+    points = np.random.default_rng(0).normal(size=(1000, 3))
+    images = np.einsum("nij,kj->nki", rotations, points)
+    assert np.all(
+        np.sum([point_group_wedge(image, rotations) for image in images], axis=0) == 1
+    )
+
+    parameters = dict(powder_parameters, seed=42, npts=200, symmetry_reduction=True)
+    serial, _ = produce_powder_data(params=parameters, fc=fc)
+    batched, _ = produce_powder_data(
+        params=dict(parameters, powder_engine="batched"), fc=fc
+    )
+    enablePrint()
+    assert np.allclose(serial.z_data.magnitude, batched.z_data.magnitude)
+
+
+def test_powder_grid_engine(generate_force_constants, powder_parameters):
+    """The grid engine reproduces the sphere-sampled map (for thin shells) and reports its convergence."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_powder_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    parameters = dict(
+        powder_parameters,
+        q_min=1.0,
+        q_max=1.5,
+        q_spacing=0.1,
+        temperature=100,
+        energy_broadening=3,
+        ebins=50,
+        seed=42,
+    )
+    reference, _ = produce_powder_data(params=dict(parameters, npts=1000), fc=fc)
+    spectrum, _ = produce_powder_data(
+        params=dict(parameters, powder_engine="grid", grid_spacing=0.1), fc=fc
+    )
+    enablePrint()
+
+    assert spectrum.z_data.units == reference.z_data.units
+    assert np.allclose(
+        spectrum.z_data.magnitude.sum(axis=1),
+        reference.z_data.magnitude.sum(axis=1),
+        rtol=0.05,
+    )
+    difference = spectrum.z_data.magnitude - reference.z_data.magnitude
+    assert np.linalg.norm(difference) < 0.1 * np.linalg.norm(reference.z_data.magnitude)
+    assert 0 < spectrum.metadata["grid_convergence"] < 1
+    assert spectrum.metadata["grid_min_points_per_shell"] > 0
+
+
+def test_powder_adaptive_sampling(generate_force_constants, powder_parameters):
+    """The adaptive sampling converges to the spherical average and reports the points per shell."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_powder_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    parameters = dict(
+        powder_parameters, seed=42, npts_tolerance=0.01, npts_batch=50, npts_max=500
+    )
+    reference, _ = produce_powder_data(
+        params=dict(powder_parameters, seed=42, npts=3000), fc=fc
+    )
+    serial, _ = produce_powder_data(params=parameters, fc=fc)
+    parallel, _ = produce_powder_data(
+        params=dict(parameters, powder_engine="parallel", n_workers=2), fc=fc
+    )
+    enablePrint()
+
+    npts = serial.metadata["npts"]
+    assert len(npts) == serial.z_data.shape[0]
+    assert all(100 <= n <= 500 for n in npts)
+    assert parallel.metadata["npts"] == npts
+    assert np.allclose(parallel.z_data.magnitude, serial.z_data.magnitude)
+    difference = serial.z_data.magnitude - reference.z_data.magnitude
+    assert np.linalg.norm(difference) < 0.02 * np.linalg.norm(
+        reference.z_data.magnitude
+    )
+
+    with pytest.raises(ValueError, match="adaptive"):
+        produce_powder_data(params=dict(parameters, powder_engine="batched"), fc=fc)
+    enablePrint()
+
+
+def test_powder_stage_cache(generate_force_constants, powder_parameters):
+    """Changing only the broadening should not resample the |q| shells."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import StageCache
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_powder_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    cache = StageCache()
+    parameters = dict(powder_parameters, seed=42)
+    produce_powder_data(params=parameters, fc=fc, cache=cache)
+    shells = cache._stages["shells"][1]
+
+    parameters["energy_broadening"] = 2.0
+    spectrum, _ = produce_powder_data(params=parameters, fc=fc, cache=cache)
+    enablePrint()
+    assert cache._stages["shells"][1] is shells
+
+    reference, _ = produce_powder_data(params=parameters, fc=fc)
+    enablePrint()
+    assert np.array_equal(spectrum.z_data.magnitude, reference.z_data.magnitude)
+
+
+def test_powder_stream(generate_force_constants, powder_parameters):
+    """The streamed map is filled shell by shell, and ends with the produce_powder_data one."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import StageCache
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_powder_data,
+        stream_powder_data,
+    )
+
+    fc = generate_force_constants()
+    cache = StageCache()
+    parameters = dict(powder_parameters, seed=42)
+    items = list(stream_powder_data(params=parameters, fc=fc, cache=cache))
+    reference, _ = produce_powder_data(params=parameters, fc=fc)
+
+    *partial, (spectrum, last) = items
+    assert last is None
+    assert [q_index for _, q_index in partial] == list(range(len(partial)))
+    assert len(partial) == reference.z_data.shape[0]
+    filled = np.isfinite(partial[1][0].z_data.magnitude).all(axis=1)
+    assert filled.tolist() == [True, True] + [False] * (len(partial) - 2)
+    assert np.allclose(spectrum.z_data.magnitude, reference.z_data.magnitude)
+
+    # the cached map is yielded at once.
+    assert [q_index for _, q_index in stream_powder_data(parameters, fc, cache)] == [
+        None
+    ]
+
+
+def test_q_section_symmetry_reduction(generate_force_constants):
+    """The Q-plane from the symmetry-unique q-points is the one diagonalising all of them."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.qpoint_symmetry import reduce_qpts
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_Q_section_modes,
+        produce_Q_section_spectrum,
+    )
+
+    fc = generate_force_constants()
+    plane = dict(h=[1, 1, 1], k=[1, -1, 0], Q0=[0.1, 0, 0], n_h=30, n_k=20)
+    sections = []
+    for symmetry_reduction in [False, True]:
+        modes, q_array, h_array, k_array, labels, dw = produce_Q_section_modes(
+            fc, temperature=100, symmetry_reduction=symmetry_reduction, **plane
+        )
+        sections.append(
+            produce_Q_section_spectrum(
+                modes, q_array, h_array, k_array, ecenter=15, deltaE=5, dw=dw
+            )
+        )
+
+    assert q_array.shape == (31 * 21, 3)
+    assert np.allclose(
+        q_array[22],
+        [0.1, 0, 0] + (-1 + 2 / 30) * np.ones(3) - 0.9 * np.array([1, -1, 0]),
+    )
+    assert len(reduce_qpts(fc, q_array)[0]) < len(q_array) / 4
+    assert np.nanmax(sections[0][0]) > 0
+    assert np.allclose(sections[1][0], sections[0][0], rtol=1e-6, atol=1e-12)
+
+
+def test_q_section_energy_cuts(generate_force_constants):
+    """The energy cuts from the per-mode intensities are the averages of the S(Q,w) maps,
+    and the direct mode sum is their limit for many energy bins."""
+    from euphonic.cli.utils import _get_energy_bins
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.kernels import energy_cut_weights
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_Q_section_energy_stack,
+        produce_Q_section_intensities,
+        produce_Q_section_modes,
+        produce_Q_section_spectrum,
+    )
+
+    # the window ecenter +- deltaE is +- 2 standard deviations.
+    weights = energy_cut_weights(np.array([10.0, 15.0, 20.0]), 15, deltaE=5)
+    assert np.isclose(weights[0] / weights[1], np.exp(-2))
+
+    fc = generate_force_constants()
+    modes, q_array, h_array, k_array, labels, dw = produce_Q_section_modes(
+        fc, h=[1, 1, 1], k=[1, -1, 0], Q0=[0.1, 0, 0], n_h=10, n_k=10, temperature=100
+    )
+    ecenters = [-5, 10, 15, 18]
+    for spectrum_type in ["coherent", "dos"]:
+        intensities = produce_Q_section_intensities(modes, spectrum_type, dw=dw)
+        stack = produce_Q_section_energy_stack(intensities, ecenters, deltaE=5, bins=10)
+        for ecenter, cut in zip(ecenters, stack):
+            ebins = _get_energy_bins(modes, 11, emin=ecenter - 5, emax=ecenter + 5)
+            if spectrum_type == "coherent":
+                spectrum = modes.calculate_structure_factor(dw=dw).calculate_sqw_map(
+                    ebins
+                )
+            else:
+                spectrum = modes.calculate_dos_map(ebins)
+            sigma = 5 / 2
+            weights = np.exp(
+                -((spectrum.y_data.magnitude - ecenter) ** 2) / (2 * sigma**2)
+            ) / np.sqrt(2 * np.pi * sigma**2)
+            reference = np.average(
+                spectrum.z_data.magnitude, axis=1, weights=weights[:-1]
+            )
+            assert np.allclose(cut, reference)
+            assert np.allclose(
+                produce_Q_section_spectrum(
+                    modes,
+                    q_array,
+                    h_array,
+                    k_array,
+                    ecenter,
+                    deltaE=5,
+                    bins=10,
+                    spectrum_type=spectrum_type,
+                    dw=dw,
+                )[0],
+                reference,
+            )
+        assert np.max(stack) > 0
+
+        direct = produce_Q_section_energy_stack(intensities, ecenters, deltaE=5)
+        binned = produce_Q_section_energy_stack(
+            intensities, ecenters, deltaE=5, bins=5000
+        )
+        assert np.allclose(direct, binned, rtol=1e-2, atol=1e-3 * np.max(direct))
+
+
+def test_volume(generate_force_constants, tmp_path):
+    """The chunked S(Q,E) volume is the S(Q,w) map of its q-points, and its slices are
+    the ones of the full array."""
+    from euphonic import ureg
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import get_debye_waller
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.volume import compute_volume
+
+    fc = generate_force_constants()
+    path = tmp_path / "volume.h5"
+    volume = compute_volume(
+        path,
+        fc,
+        h=[1, 0, 0],
+        k=[0, 1, 0],
+        l=[0, 0, 1],
+        Q0=[0.1, 0.2, 0],
+        n_h=4,
+        n_k=3,
+        n_l=2,
+        ebins=20,
+        temperature=100,
+        chunks=(2, 2, 2, 8),
+    )
+    with volume:
+        assert volume.shape == (5, 4, 3, 20)
+        full = volume[...]
+        i, j, k = np.meshgrid(range(5), range(4), range(3), indexing="ij")
+        qpts = volume.qpts(i.ravel(), j.ravel(), k.ravel())
+        modes = fc.calculate_qpoint_phonon_modes(qpts, asr="reciprocal")
+        dw = get_debye_waller(100 * ureg("K"), fc)
+        reference = (
+            modes.calculate_structure_factor(dw=dw)
+            .calculate_sqw_map(volume.energy_bins * ureg("meV"))
+            .z_data
+        )
+        assert str(reference.units) == volume.units
+        assert np.allclose(full.reshape(-1, 20), reference.magnitude)
+        assert np.max(full) > 0
+
+        assert np.allclose(volume.plane(1, 2), full[:, 2])
+        assert np.allclose(
+            volume.plane(2, 0, energy=10), full[:, :, 0, volume.energy_index(10)]
+        )
+        assert np.allclose(volume.energy_slice(15), full[..., volume.energy_index(15)])
+        line_qpts, line = volume.line([0.1, -0.8, 1], [0.1, 1.2, 1], n=7)
+        assert np.allclose(line[0], full[2, 0, 2])
+        assert np.allclose(line[-1], full[2, 3, 2])
+        assert np.isnan(volume.line([5, 5, 5], [6, 6, 6], n=2)[1]).all()
+
+
+def test_spectrum_disk_cache(generate_force_constants, powder_parameters, tmp_path):
+    """A spectrum stored in the disk cache is loaded back (also by a new fc object)."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.disk_cache import (
+        SpectrumDiskCache,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_powder_data,
+    )
+
+    disk_cache = SpectrumDiskCache(directory=tmp_path)
+    parameters = dict(powder_parameters, seed=42)
+    spectrum, _ = produce_powder_data(
+        params=parameters, fc=generate_force_constants(), disk_cache=disk_cache
+    )
+    assert len(disk_cache.entries()) == 1
+
+    # the execution parameters do not change the key.
+    parameters["n_threads"] = 2
+    fc = generate_force_constants()
+    key = disk_cache.key("powder", fc, parameters)
+    assert key == disk_cache.entries()[0]["key"]
+    cached, _ = produce_powder_data(params=parameters, fc=fc, disk_cache=disk_cache)
+    assert np.array_equal(cached.z_data.magnitude, spectrum.z_data.magnitude)
+    assert cached.z_data.units == spectrum.z_data.units
+
+    # nor does the state of the widgets (model traits) which are not parameters.
+    ui_state = dict(
+        parameters,
+        info_legend_text="<p>4 threads</p>",
+        intensity_filter=[10, 50],
+        energy_units="THz",
+    )
+    assert disk_cache.key("powder", fc, ui_state) == key
+    assert disk_cache.key("powder", fc, dict(parameters, npts=21)) != key
+
+    # metadata which is not JSON-serialisable is not stored, without raising.
+    disk_cache.store("unserialisable", {"z": np.zeros(2)}, {"fc": fc})
+    assert disk_cache.load("unserialisable") is None
+
+    # LRU eviction.
+    disk_cache.max_bytes = 0
+    disk_cache.evict()
+    assert disk_cache.entries() == []
+
+
+def test_derived_cache(generate_force_constants):
+    """The Debye-Waller factor is computed once per force constants and settings."""
+    from euphonic import ureg
+    from euphonic.cli.utils import _get_debye_waller
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import (
+        derived_cache,
+        get_debye_waller,
+    )
+
+    fc = generate_force_constants()
+    dw = get_debye_waller(100 * ureg("K"), fc, grid=[4, 4, 4], asr="reciprocal")
+    assert get_debye_waller(100 * ureg("K"), fc, grid=[4, 4, 4], asr="reciprocal") is dw
+    # the grid modes are reused for another temperature.
+    get_debye_waller(200 * ureg("K"), fc, grid=[4, 4, 4], asr="reciprocal")
+    assert len(derived_cache(fc)._entries) == 3
+
+    reference = _get_debye_waller(100 * ureg("K"), fc, grid=[4, 4, 4], asr="reciprocal")
+    assert np.allclose(
+        dw.debye_waller.magnitude, reference.debye_waller.magnitude, rtol=1e-12
+    )
+
+    derived_cache(fc).max_bytes = 0
+    derived_cache(fc).clear()
+    get_debye_waller(100 * ureg("K"), fc, grid=[4, 4, 4], asr="reciprocal")
+    assert not derived_cache(fc)._entries
+
+
+def test_derived_cache_threads():
+    """Two threads using the same DerivedCache compute each value once, and evicting
+    entries in one thread does not break the lookups of the other."""
+    import threading
+    import time
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import DerivedCache
+
+    cache = DerivedCache(max_bytes=4 * 8 * 100)  # 4 arrays of 100 float64.
+    calls = []
+
+    def compute(key):
+        calls.append(key)
+        time.sleep(0.05 if key == -1 else 0)
+        return np.full(100, key, dtype=float)
+
+    errors = []
+
+    def run():
+        try:
+            for key in [-1] + list(range(200)):
+                assert cache.get(key, lambda: compute(key))[0] == key
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert calls.count(-1) == 1
+    assert cache.nbytes <= cache.max_bytes
+
+
+def test_temperature_series(generate_force_constants):
+    """The temperature series should reproduce the maps computed one temperature at a time."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_single_crystal,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_bands_weigthed_data,
+        produce_temperature_series,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    parameters = dict(parameters_single_crystal, q_spacing=0.05)
+    temperatures = [0, 50, 300]
+    z_data, spectra, _ = produce_temperature_series(parameters, fc, temperatures)
+    enablePrint()
+    assert z_data.shape == (3, spectra[0].z_data.shape[0], 200)
+
+    for i, temperature in enumerate(temperatures):
+        spectrum, _ = produce_bands_weigthed_data(
+            dict(parameters, temperature=temperature), fc
+        )
+        enablePrint()
+        assert np.allclose(
+            z_data[i].magnitude, spectrum.z_data.magnitude, rtol=1e-10, atol=1e-12
+        )
+
+
+@pytest.mark.parametrize("engine", ["serial", "batched"])
+def test_partial_maps(generate_force_constants, powder_parameters, engine):
+    """The atom-resolved partial maps (with the cross terms) should add up to the total map,
+    along the path and for the powder."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_single_crystal,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_bands_weigthed_data,
+        produce_powder_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    parameters = dict(parameters_single_crystal, q_spacing=0.05, temperature=100)
+    powder = dict(powder_parameters, seed=42, temperature=100, powder_engine=engine)
+    for produce, params in [
+        (produce_bands_weigthed_data, parameters),
+        (produce_powder_data, powder),
+    ]:
+        total, _ = produce(params, fc)
+        partials, _ = produce(dict(params, partials="atoms"), fc)
+        enablePrint()
+        assert [spectrum.metadata["partial"] for spectrum in partials] == [
+            ["Si0"],
+            ["Si1"],
+            ["Si0", "Si1"],
+        ]
+        assert partials[0].z_data.units == total.z_data.units
+        assert np.allclose(
+            sum(spectrum.z_data.magnitude for spectrum in partials),
+            total.z_data.magnitude,
+            rtol=1e-10,
+            atol=1e-12,
+        )
+
+
+def test_mode_list(generate_force_constants):
+    """The mode list should bin as calculate_sqw_map, in any energy bins and units, and
+    a new binning of the path map should not recompute the structure factors."""
+    from euphonic import ureg
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.cache import (
+        StageCache,
+        get_debye_waller,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.kernels import mode_intensities
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.mode_list import ModeList
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_single_crystal,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_bands_weigthed_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    rng = np.random.default_rng(0)
+    modes = fc.calculate_qpoint_phonon_modes(rng.random((20, 3)), asr="reciprocal")
+    modes.frequencies_unit = "meV"
+    dw = get_debye_waller(100 * ureg("K"), fc, grid=[4, 4, 4], asr="reciprocal")
+    for temperature_dw in [None, dw]:
+        structure_factor = modes.calculate_structure_factor(dw=temperature_dw)
+        mode_list = ModeList.from_mode_intensities(
+            mode_intensities(modes, dw=temperature_dw), "meV"
+        )
+        for e_bins in [
+            np.linspace(-60, 60, 201) * ureg("meV"),
+            np.linspace(-10, 15, 51) * ureg("THz"),
+        ]:
+            reference = structure_factor.calculate_sqw_map(e_bins).z_data
+            z_data = mode_list.bin(e_bins)
+            assert z_data.units == reference.units
+            assert np.allclose(
+                z_data.magnitude, reference.magnitude, rtol=1e-10, atol=1e-12
+            )
+    # at T=0 only the phonon creation (+w) is stored.
+    dw_0 = get_debye_waller(0 * ureg("K"), fc, grid=[4, 4, 4], asr="reciprocal")
+    assert (
+        len(ModeList.from_mode_intensities(mode_intensities(modes, dw_0), "meV"))
+        <= 6 * 20
+    )
+    window = mode_list.energy_window(0 * ureg("meV"), 30 * ureg("meV"))
+    assert np.all((window.energies >= 0) & (window.energies < 30))
+
+    cache = StageCache()
+    parameters = dict(parameters_single_crystal, q_spacing=0.05, temperature=100)
+    produce_bands_weigthed_data(parameters, fc, cache=cache)
+    cached = cache._stages["mode_list"][1]
+    spectrum, _ = produce_bands_weigthed_data(
+        dict(parameters, ebins=300), fc, cache=cache
+    )
+    enablePrint()
+    assert cache._stages["mode_list"][1] is cached
+    assert spectrum.z_data.shape[1] == 300
+
+
+def test_single_precision(generate_force_constants):
+    """The single precision maps should be float32, within the error bound of kernels.py."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_single_crystal,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_bands_weigthed_data,
+        produce_Q_section_intensities,
+        produce_Q_section_modes,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    parameters = dict(parameters_single_crystal, q_spacing=0.05, temperature=100)
+    double, _ = produce_bands_weigthed_data(parameters, fc)
+    single, _ = produce_bands_weigthed_data(dict(parameters, precision="single"), fc)
+    enablePrint()
+    assert single.z_data.dtype == np.float32
+    error = np.max(np.abs(single.z_data.magnitude - double.z_data.magnitude))
+    assert error < 1e-5 * np.max(double.z_data.magnitude)
+
+    intensities = {}
+    for precision in ["double", "single"]:
+        modes, *_, dw = produce_Q_section_modes(
+            fc,
+            h=[1, 0, 0],
+            k=[0, 1, 0],
+            n_h=20,
+            n_k=20,
+            temperature=100,
+            precision=precision,
+        )
+        intensities[precision] = produce_Q_section_intensities(modes, dw=dw)["positive"]
+    assert intensities["single"].dtype == np.float32
+    error = np.max(np.abs(intensities["single"] - intensities["double"]))
+    assert error < 1e-5 * np.max(intensities["double"])
+
+
+def test_custom_path_zone_reduction(generate_force_constants):
+    """A path through several Brillouin zones diagonalises only the q-points of one zone,
+    and gives the map of the full diagonalisation."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_single_crystal,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.qpoint_symmetry import (
+        reduce_qpts_to_zone,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_bands_weigthed_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    linear_path = {
+        "coordinates": [[(0, 0, 0), (3, 3, 3)]],
+        "labels": ["$\\Gamma$", "(3,3,3)"],
+        "delta_q": 0.1,
+    }
+    spectra = []
+    for zone_reduction in [False, True]:
+        parameters = dict(
+            parameters_single_crystal, temperature=100, zone_reduction=zone_reduction
+        )
+        spectrum, _ = produce_bands_weigthed_data(
+            parameters, fc, linear_path=linear_path
+        )
+        enablePrint()
+        spectra.append(spectrum.z_data.magnitude)
+
+    assert np.max(spectra[0]) > 0
+    # (at the last point, Q = G, the acoustic frequencies are numerically zero and the
+    # intensity with the Bose factor is not defined.)
+    assert np.allclose(spectra[1][:-1], spectra[0][:-1], rtol=1e-8, atol=1e-10)
+    qpts = np.linspace(0, 3, 31)[:, None] * np.ones(3)
+    assert len(reduce_qpts_to_zone(qpts)[0]) == 10
+
+
+def test_bands_preview(generate_force_constants):
+    """The interpolated preview is the exact map if all the points are computed, and close
+    to it otherwise, with the error estimated at the check points."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_single_crystal,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_bands_preview,
+        produce_bands_weigthed_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    parameters = dict(parameters_single_crystal, q_spacing=0.02, temperature=100)
+    exact, _ = produce_bands_weigthed_data(parameters, fc)
+    enablePrint()
+    full, _ = produce_bands_preview(parameters, fc, coarsening=1)
+    enablePrint()
+    assert np.allclose(full.x_data.magnitude, exact.x_data.magnitude)
+    assert np.allclose(full.z_data.magnitude, exact.z_data.magnitude)
+    assert full.metadata["preview_intensity_error"] == 0
+
+    preview, _ = produce_bands_preview(parameters, fc, coarsening=5)
+    enablePrint()
+    assert preview.metadata["preview_qpts"] < len(exact.x_data) / 4
+    error = np.sum(np.abs(preview.z_data - exact.z_data).magnitude) / np.sum(
+        exact.z_data.magnitude
+    )
+    assert error < 0.05
+    assert 0 < preview.metadata["preview_frequency_error"] < 0.1
+    assert 0 < preview.metadata["preview_intensity_error"] < 0.05
+
+    # the exact map computed in a background thread (as after a preview in the app)
+    # leaves the stdout of the main thread alone.
+    import sys
+    import threading
+
+    stdout = sys.stdout
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(produce_bands_weigthed_data(parameters, fc)[0])
+    )
+    thread.start()
+    thread.join()
+    assert sys.stdout is stdout
+    assert np.allclose(results[0].z_data.magnitude, exact.z_data.magnitude)
+
+
+def test_bands_adaptive_path(generate_force_constants):
+    """The adaptive path computes a subset of the points of the uniform path, and the map
+    at these points is the one of the uniform path."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_single_crystal,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_bands_weigthed_data,
+        enablePrint,
+    )
+
+    fc = generate_force_constants()
+    parameters = dict(parameters_single_crystal, q_spacing=0.01, temperature=100)
+    uniform, _ = produce_bands_weigthed_data(parameters, fc)
+    enablePrint()
+    adaptive, _ = produce_bands_weigthed_data(dict(parameters, path_tolerance=0.01), fc)
+    enablePrint()
+    path_indices = adaptive.metadata["path_indices"]
+    assert len(path_indices) < len(uniform.x_data) / 2
+    assert path_indices[0] == 0 and path_indices[-1] == len(uniform.x_data) - 1
+    assert np.allclose(
+        adaptive.z_data.magnitude, uniform.z_data.magnitude[path_indices]
+    )
+    assert [(path_indices[i], label) for i, label in adaptive.x_tick_labels] == [
+        (i, label) for i, label in uniform.x_tick_labels
+    ]
+
+
+def test_structure_factor_memory_budget(generate_force_constants, monkeypatch):
+    """The structure factors computed in chunks within the memory budget are the same, and a
+    path which does not fit in the budget raises a MemoryBudgetError before computing; the
+    seekpath path is computed once per force constants and q spacing."""
+    import seekpath
+    from euphonic.cli.utils import _bands_from_force_constants, _get_q_distance
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.execution import (
+        MemoryBudgetError,
+        memory_chunk_size,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.kernels import (
+        structure_factor_memory,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.parameters import (
+        parameters_single_crystal,
+    )
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.structure_factors import (
+        produce_bands_weigthed_data,
+        enablePrint,
+    )
+
+    seekpath_calls = []
+    get_explicit_k_path = seekpath.get_explicit_k_path
+
+    def counted_get_explicit_k_path(*args, **kwargs):
+        seekpath_calls.append(kwargs.get("reference_distance"))
+        return get_explicit_k_path(*args, **kwargs)
+
+    monkeypatch.setattr(seekpath, "get_explicit_k_path", counted_get_explicit_k_path)
+
+    fc = generate_force_constants()
+    parameters = dict(parameters_single_crystal, q_spacing=0.05, temperature=100)
+    reference, _ = produce_bands_weigthed_data(parameters, fc)
+    enablePrint()
+    # the same path and modes as euphonic's.
+    modes, _, _ = _bands_from_force_constants(
+        fc, _get_q_distance("angstrom", 0.05), asr="reciprocal"
+    )
+    assert len(reference.x_data) == len(modes.qpts)
+    assert len(seekpath_calls) == 2  # (including the one of euphonic.)
+    produce_bands_weigthed_data(dict(parameters, energy_broadening=2), fc)
+    enablePrint()
+    assert len(seekpath_calls) == 2
+
+    n_qpts = len(reference.x_data)
+    held, per_qpt = structure_factor_memory(
+        n_qpts, fc.crystal.n_atoms, parameters["ebins"]
+    )
+    budget = (held + 7.5 * per_qpt) / 1024**2  # MB: 7 q-points at a time.
+    assert memory_chunk_size(held, per_qpt, n_qpts, budget) == 7
+    chunked, _ = produce_bands_weigthed_data(dict(parameters, memory_budget=budget), fc)
+    enablePrint()
+    assert np.allclose(chunked.z_data.magnitude, reference.z_data.magnitude)
+
+    with pytest.raises(MemoryBudgetError, match="memory budget"):
+        produce_bands_weigthed_data(
+            dict(parameters, memory_budget=held / 2 / 1024**2), fc
+        )
+    enablePrint()
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_force_constants_from_phonopy_instance(
+    generate_phonopy_instance, generate_force_constants, compact
+):
+    """The in-memory conversion should give the force constants read from the phonopy files."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.phonopy_interface import (
+        generate_force_constant_from_phonopy_instance,
+    )
+
+    ph = generate_phonopy_instance(supercell=3)
+    ph.produce_force_constants(calculate_full_force_constants=not compact)
+    fc = generate_force_constant_from_phonopy_instance(ph)
+    reference = generate_force_constants(supercell=3)
+
+    assert np.array_equal(fc.cell_origins, reference.cell_origins)
+    assert np.array_equal(fc.sc_matrix, reference.sc_matrix)
+    assert np.allclose(
+        fc.force_constants.magnitude,
+        reference.force_constants.magnitude,
+        rtol=1e-12,
+        atol=1e-14,
+    )
+    qpts = np.random.default_rng(0).random((10, 3))
+    assert np.allclose(
+        fc.calculate_qpoint_phonon_modes(qpts).frequencies.magnitude,
+        reference.calculate_qpoint_phonon_modes(qpts).frequencies.magnitude,
+    )
+
+
+def test_native_format_round_trip(generate_force_constants):
+    """The force constants stored in the euphonic-native .npz are loaded unchanged."""
+    from aiidalab_qe_vibroscopy.utils.euphonic.data.native_format import (
+        force_constants_from_npz,
+        force_constants_to_npz,
+    )
+
+    fc = generate_force_constants()
+    loaded = force_constants_from_npz(force_constants_to_npz(fc))
+
+    assert np.array_equal(
+        loaded.force_constants.magnitude, fc.force_constants.magnitude
+    )
+    assert np.array_equal(loaded.cell_origins, fc.cell_origins)
+    assert np.array_equal(loaded.sc_matrix, fc.sc_matrix)
+    assert list(loaded.crystal.atom_type) == list(fc.crystal.atom_type)
+    assert np.allclose(
+        loaded.crystal.cell_vectors.magnitude, fc.crystal.cell_vectors.magnitude
+    )
+    qpts = np.random.default_rng(0).random((5, 3))
+    assert np.allclose(
+        loaded.calculate_qpoint_phonon_modes(qpts).frequencies.magnitude,
+        fc.calculate_qpoint_phonon_modes(qpts).frequencies.magnitude,
+    )